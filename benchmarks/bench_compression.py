@@ -0,0 +1,106 @@
+"""Compare plain and compressed queue entries.
+
+Run with pyramid_mailer installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_compression.py [--messages N]
+
+Every backend queues ``--messages`` messages with a text report and an
+image attached, without compression and with each of
+``queue_compression``'s methods, in a temporary directory.  Reported are
+the bytes the queue takes on disk, the messages queued per second and the
+messages per second a :class:`pyramid_mailer.queue.QueueProcessor` takes
+out of the queue, streaming them to a mailer which discards them.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import transaction
+
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Attachment
+from pyramid_mailer.message import Message
+from pyramid_mailer.queue import MaildirQueue
+from pyramid_mailer.queue import QueueProcessor
+
+REPORT = b''.join(
+    b'%d,order-%d,shipped,%d.%02d EUR\n' % (index, index * 7, index % 300,
+                                            index % 100)
+    for index in range(5000))
+IMAGE = os.urandom(20000)
+
+
+class NullMailer(object):
+
+    def send(self, fromaddr, toaddrs, message):
+        if not isinstance(message, bytes):
+            for chunk in message:
+                pass
+        return {}
+
+
+def make_message(index):
+    return Message(
+        subject='Your monthly report', sender='shop@example.com',
+        recipients=['customer%d@example.com' % index],
+        body='Please find your report attached.\n',
+        attachments=[Attachment('report.csv', 'text/csv', REPORT),
+                     Attachment('logo.png', 'image/png', IMAGE)])
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=500,
+                        help='messages queued per run')
+    args = parser.parse_args()
+
+    print('%-10s %-12s %12s %12s %12s' % (
+        'backend', 'compression', 'MB on disk', 'queued/s', 'sent/s'))
+    for backend in ('maildir', 'sqlite'):
+        for compression in (None, 'zlib', 'lzma'):
+            tempdir = tempfile.mkdtemp()
+            try:
+                path = os.path.join(tempdir, 'queue')
+                tm = transaction.TransactionManager()
+                mailer = Mailer(
+                    queue_path=path, queue_backend=backend,
+                    queue_compression=compression, transaction_manager=tm)
+                start = time.perf_counter()
+                for index in range(args.messages):
+                    tm.begin()
+                    mailer.send_to_queue(make_message(index))
+                    tm.commit()
+                queued = time.perf_counter() - start
+                size = disk_usage(path)
+
+                if backend == 'sqlite':
+                    queue = mailer.sqlite_queue
+                else:
+                    queue = MaildirQueue(path)
+                processor = QueueProcessor(
+                    NullMailer(), queue, batch_size=50, stream=True)
+                start = time.perf_counter()
+                sent = processor.send_messages()
+                elapsed = time.perf_counter() - start
+                assert sent == args.messages
+            finally:
+                shutil.rmtree(tempdir)
+            print('%-10s %-12s %12.1f %12.0f %12.0f' % (
+                backend, compression or 'none', size / 1e6,
+                args.messages / queued, sent / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Compare ``Message.personalize`` with building one ``Message`` per recipient.
+
+Run with pyramid_mailer installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_personalize.py [--recipients N]
+
+Each recipient gets a message with a personal greeting in the text body
+and the same HTML body and attachments, rendered with ``to_bytes``.  The
+shared encoded-part cache is disabled, so the "fresh" column shows the cost
+of re-encoding every part for every recipient.
+"""
+import argparse
+import os
+import time
+
+from pyramid_mailer.message import Attachment
+from pyramid_mailer.message import Message
+from pyramid_mailer.message import encoded_part_cache
+
+TEXT = (
+    'This month in the shop: new arrivals, an autumn sale and more.\n'
+) * 20
+
+HTML = '<html><body>%s</body></html>' % (
+    '<p>This month in the shop: <b>new arrivals</b>.</p>\n' * 200)
+
+ATTACHMENTS = [
+    Attachment('catalogue.pdf', 'application/pdf', os.urandom(100000)),
+    Attachment('logo.png', 'image/png', os.urandom(8000)),
+    ]
+
+
+def greeting(index):
+    return 'Dear customer %d,\n\n%s' % (index, TEXT)
+
+
+def fresh(recipients):
+    for index, recipient in enumerate(recipients):
+        Message(
+            subject='Newsletter', sender='shop@example.com',
+            recipients=[recipient], body=greeting(index), html=HTML,
+            attachments=list(ATTACHMENTS)).to_bytes()
+
+
+def personalized(recipients):
+    template = Message(
+        subject='Newsletter', sender='shop@example.com',
+        html=HTML, attachments=list(ATTACHMENTS))
+    for index, recipient in enumerate(recipients):
+        template.personalize(recipient, body=greeting(index)).to_bytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--recipients', type=int, default=10000,
+                        help='number of personalized messages')
+    args = parser.parse_args()
+
+    encoded_part_cache.max_size = 0
+    recipients = ['customer%d@example.com' % index
+                  for index in range(args.recipients)]
+
+    print('%-14s %10s %14s' % ('method', 'seconds', 'messages/s'))
+    for name, func in [('fresh', fresh), ('personalize', personalized)]:
+        start = time.perf_counter()
+        func(recipients)
+        elapsed = time.perf_counter() - start
+        print('%-14s %10.2f %14.0f' % (
+            name, elapsed, args.recipients / elapsed))
+
+
+if __name__ == '__main__':
+    main()
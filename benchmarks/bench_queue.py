@@ -0,0 +1,96 @@
+"""Compare the enqueue throughput of the maildir and SQLite queues.
+
+Run with pyramid_mailer installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_queue.py [--messages N] [--per-transaction N]
+        [--threads N] [--commit-latency SECONDS]
+
+Messages are added with ``Mailer.send_to_queue`` by ``--threads`` threads,
+each committing every ``--per-transaction`` messages, in a temporary
+directory.  Every backend is run with one sync per commit and with group
+commit (``queue_commit_latency``); the maildir queue also without syncing
+at all, its default.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import transaction
+
+from pyramid_mailer.mailer import Mailer
+from pyramid_mailer.message import Message
+from pyramid_mailer.queue import GroupCommit
+from pyramid_mailer.queue import sync_directories
+
+
+def make_message(index):
+    return Message(
+        subject='Password reset', sender='shop@example.com',
+        recipients=['customer%d@example.com' % index],
+        body='Follow this link to reset your password.\n' * 5)
+
+
+def enqueue(mailer, count, per_transaction):
+    tm = transaction.TransactionManager()
+    mailer = mailer.bind(transaction_manager=tm)
+    for start in range(0, count, per_transaction):
+        tm.begin()
+        for index in range(start, min(start + per_transaction, count)):
+            mailer.send_to_queue(make_message(index))
+        tm.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages added per backend')
+    parser.add_argument('--per-transaction', type=int, default=1,
+                        help='messages committed together')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='threads adding messages at the same time')
+    parser.add_argument('--commit-latency', type=float, default=0.002,
+                        help='queue_commit_latency in seconds')
+    args = parser.parse_args()
+
+    per_thread = args.messages // args.threads
+    total = per_thread * args.threads
+    print('%-10s %-14s %10s %14s' % (
+        'backend', 'commit', 'seconds', 'messages/s'))
+    group = 'group %gs' % args.commit_latency
+    for backend, commit in [('maildir', 'none'), ('maildir', 'each'),
+                            ('maildir', group), ('sqlite', 'each'),
+                            ('sqlite', group)]:
+        kw = {}
+        if commit == 'each' and backend == 'maildir':
+            # a group of one: every commit syncs the directory
+            kw['queue_committer'] = GroupCommit(
+                sync_directories, max_size=1)
+        elif commit == group:
+            kw['queue_commit_latency'] = args.commit_latency
+        tempdir = tempfile.mkdtemp()
+        try:
+            mailer = Mailer(
+                queue_path=os.path.join(tempdir, 'queue'),
+                queue_backend=backend, **kw)
+            threads = [
+                threading.Thread(
+                    target=enqueue,
+                    args=(mailer, per_thread, args.per_transaction))
+                for index in range(args.threads)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(tempdir)
+        print('%-10s %-14s %10.2f %14.0f' % (
+            backend, commit, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main()
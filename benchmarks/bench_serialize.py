@@ -0,0 +1,82 @@
+"""Compare ``Message.to_bytes()`` with the ``email.generator`` path.
+
+Run with pyramid_mailer installed (e.g. ``pip install -e .``)::
+
+    python benchmarks/bench_serialize.py [--number N]
+
+Every round builds a fresh ``Message``, so neither path benefits from the
+per-message rendering cache; the shared encoded-part cache is disabled.
+"""
+import argparse
+import os
+import timeit
+
+from repoze.sendmail.encoding import encode_message
+
+from pyramid_mailer.message import Attachment
+from pyramid_mailer.message import Message
+from pyramid_mailer.message import encoded_part_cache
+
+TEXT = (
+    'Dear customer,\n\n'
+    'Your order has been shipped and should arrive within three days.\n'
+) * 20
+
+HTML = '<html><body>%s</body></html>' % (
+    '<p>Your order has been <b>shipped</b>.</p>\n' * 40)
+
+ATTACHMENTS = [os.urandom(size) for size in (200000, 50000, 50000, 10000)]
+
+
+def text_message():
+    return Message(
+        subject='Your order', sender='shop@example.com',
+        recipients=['customer@example.com'], body=TEXT)
+
+
+def html_message():
+    return Message(
+        subject='Your order', sender='shop@example.com',
+        recipients=['customer@example.com'], body=TEXT, html=HTML)
+
+
+def attachment_message():
+    message = html_message()
+    for index, data in enumerate(ATTACHMENTS):
+        message.attach(Attachment(
+            'invoice-%d.pdf' % index, 'application/pdf', data))
+    return message
+
+
+def via_generator(factory):
+    return encode_message(factory().to_message())
+
+
+def via_to_bytes(factory):
+    return factory().to_bytes()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=200,
+                        help='messages rendered per measurement')
+    args = parser.parse_args()
+
+    encoded_part_cache.max_size = 0
+
+    print('%-12s %12s %12s %8s' % ('message', 'generator', 'to_bytes',
+                                   'speedup'))
+    for name, factory in [('text', text_message),
+                          ('html', html_message),
+                          ('attachments', attachment_message)]:
+        timings = []
+        for func in (via_generator, via_to_bytes):
+            timings.append(min(timeit.repeat(
+                lambda: func(factory), number=args.number, repeat=3)))
+        generator, to_bytes = [t / args.number * 1e6 for t in timings]
+        print('%-12s %10.1fus %10.1fus %7.2fx' % (
+            name, generator, to_bytes, generator / to_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import atexit
+
 from pyramid_mailer.mailer import Mailer
 from pyramid_mailer.interfaces import IMailer
 
@@ -15,12 +17,17 @@ def includeme(config):
     """
     Registers a mailer instance.
 
+    The mailer's ``shutdown`` method is registered to run at interpreter
+    exit, so background deliveries are drained and pooled connections
+    closed.
+
     :versionadded: 0.4
     """
     settings = config.registry.settings
     prefix = settings.get('pyramid_mailer.prefix', 'mail.')
     mailer = mailer_factory_from_settings(settings, prefix=prefix)
     _set_mailer(config, mailer)
+    atexit.register(mailer.shutdown)
 
 
 def _set_mailer(config, mailer):
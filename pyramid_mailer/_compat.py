@@ -7,6 +7,33 @@ except ImportError:  # pragma: no cover
     SMTP_SSL = None
 
 
+try:
+    from repoze.sendmail.mailer import EHLO_Error
+    from repoze.sendmail.mailer import ESMTP_NotSupported
+    from repoze.sendmail.mailer import HAVE_SSL
+    from repoze.sendmail.mailer import TLS_NotAvailable
+except ImportError:  # pragma: no cover
+    # repoze.sendmail < 4.5 raises plain RuntimeErrors
+    HAVE_SSL = SMTP_SSL is not None
+
+    class TLS_NotAvailable(RuntimeError):
+        def __init__(self):
+            super(TLS_NotAvailable, self).__init__(
+                'TLS is not available but TLS is required')
+
+    class EHLO_Error(RuntimeError):
+        def __init__(self, code, response):
+            super(EHLO_Error, self).__init__(
+                'Error sending EHLO to the SMTP server '
+                '(code=%s, response=%s)' % (code, response))
+
+    class ESMTP_NotSupported(RuntimeError):
+        def __init__(self):
+            super(ESMTP_NotSupported, self).__init__(
+                'Mailhost does not support ESMTP but a username is '
+                'configured')
+
+
 # Patch broken _qencode in Py3 (_qencode was not ported properly and
 # still wants to use str instead of bytes to do space replacement)
 def _qencode(s):
@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import transaction
+
+from pyramid_mailer.mailer import Mailer
+
+
+class AsyncMailer(object):
+    """Sends email from asyncio code without blocking the event loop.
+
+    Mirrors the immediate (non-transactional) sending methods of
+    :class:`pyramid_mailer.mailer.Mailer` as coroutines.  The SMTP
+    exchanges run in a thread pool of ``concurrency`` workers sharing the
+    wrapped mailer's connection pool, so a single event loop can drive
+    many deliveries at the same time.
+
+    :param mailer: the :class:`~pyramid_mailer.mailer.Mailer` (or
+           ``DebugMailer``/``DummyMailer``) doing the actual work.
+    :param concurrency: the maximum number of deliveries in progress at
+           the same time, defaults to 10.
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, mailer, concurrency=10, executor=None):
+        self.mailer = mailer
+        self.concurrency = concurrency
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.executor = executor
+
+    @classmethod
+    def from_settings(cls, settings, prefix='mail.'):
+        """Create a new instance of 'AsyncMailer' from settings dict.
+
+        Accepts the same settings as
+        :meth:`pyramid_mailer.mailer.Mailer.from_settings`, plus
+        ``async_concurrency``.  Unless ``pool_size`` is given, the mailer
+        keeps one SMTP connection per worker open.
+
+        :param settings: a settings dict-like
+        :param prefix: prefix separating 'pyramid_mailer' settings
+        """
+        settings = dict(settings or {})
+        concurrency = int(settings.get(prefix + 'async_concurrency', 10))
+        settings.setdefault(prefix + 'pool_size', concurrency)
+        mailer = Mailer.from_settings(settings, prefix)
+        return cls(mailer, concurrency=concurrency)
+
+    def bind(self, **kw):
+        """Get an async mailer with the same server configuration but with
+        different delivery options, sharing the worker threads.
+
+        :param default_sender: default "from" address
+        """
+        return self.__class__(
+            self.mailer.bind(**kw),
+            concurrency=self.concurrency,
+            executor=self.executor,
+        )
+
+    def _run(self, func, *args, **kw):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args, **kw))
+
+    async def send_immediately(self, message, fail_silently=False):
+        """Send a message immediately.
+
+        See :meth:`pyramid_mailer.mailer.Mailer.send_immediately`.
+        """
+        return await self._run(
+            self.mailer.send_immediately, message, fail_silently)
+
+    async def send_many(self, messages):
+        """Send several messages immediately over a single SMTP session.
+
+        See :meth:`pyramid_mailer.mailer.Mailer.send_many_immediately`.
+        """
+        return await self._run(
+            self.mailer.send_many_immediately, list(messages))
+
+    async def send_immediately_sendmail(self, message, fail_silently=False):
+        """Send a message immediately using the local sendmail binary.
+
+        See :meth:`pyramid_mailer.mailer.Mailer.send_immediately_sendmail`.
+        """
+        return await self._run(
+            self.mailer.send_immediately_sendmail, message, fail_silently)
+
+    async def send_to_queue(self, message, priority=None, not_before=None):
+        """Add a message to the maildir queue.
+
+        Unlike :meth:`pyramid_mailer.mailer.Mailer.send_to_queue` this does
+        not wait for a transaction; the message is committed to the queue
+        right away.
+        """
+        return await self._run(
+            self._send_to_queue, message, priority, not_before)
+
+    def _send_to_queue(self, message, priority, not_before):
+        tm = transaction.TransactionManager()
+        mailer = self.mailer.bind(transaction_manager=tm)
+        with tm:
+            return mailer.send_to_queue(
+                message, priority=priority, not_before=not_before)
+
+    def close(self):
+        """Wait for pending deliveries and close pooled connections."""
+        self.executor.shutdown(wait=True)
+        pool = getattr(self.mailer, 'smtp_pool', None)
+        if pool is not None:
+            pool.close()
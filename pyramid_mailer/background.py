@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class BackgroundSender(object):
+    """Runs deliveries on a bounded pool of worker threads.
+
+    At most ``queue_size`` deliveries may be pending or in progress at any
+    time; :meth:`submit` blocks until a slot becomes free, which keeps a
+    slow mail server from piling up an unbounded backlog in memory.
+
+    :param workers: the number of worker threads
+    :param queue_size: the maximum number of pending deliveries
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, workers=1, queue_size=1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(queue_size)
+
+    def submit(self, func, *args):
+        """Schedule ``func(*args)`` and return a
+        :class:`concurrent.futures.Future` for its result.
+        """
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def _release_slot(self, future):
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        """Stop accepting deliveries; if ``wait`` is true, block until the
+        pending ones are done.
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,417 @@
+from email.header import Header
+from email.message import Message
+from email.utils import formatdate
+from email.utils import make_msgid
+import logging
+import os
+import random
+import socket
+import time
+
+from repoze.sendmail import encoding
+from repoze.sendmail.delivery import MailDataManager
+from repoze.sendmail.delivery import QueuedMailDelivery
+from repoze.sendmail.delivery import copy_message
+from repoze.sendmail.maildir import MaildirTransactionalMessage
+import transaction
+
+from pyramid_mailer.queue import compress_queued
+from pyramid_mailer.queue import compressing
+from pyramid_mailer.queue import open_maildir
+from pyramid_mailer.queue import scheduled_path
+from pyramid_mailer.queue import shard_index
+from pyramid_mailer.queue import shard_path
+
+log = logging.getLogger(__name__)
+
+
+def prepare_message(message):
+    """Prepare an ``email.message.Message`` for transactional delivery.
+
+    Cleans up the headers and adds the ``Message-Id`` and ``Date`` headers
+    if they are missing, just like
+    :class:`repoze.sendmail.delivery.DirectMailDelivery` does.  Returns the
+    message id.
+    """
+    encoding.cleanup_message(message)
+    messageid = message['Message-Id']
+    if messageid is None:
+        messageid = message['Message-Id'] = make_msgid('repoze.sendmail')
+    if message['Date'] is None:
+        message['Date'] = formatdate()
+    return messageid
+
+
+class BatchMailDelivery(object):
+    """Transactional delivery sending messages in batches.
+
+    All messages handed to one instance during a transaction are collected
+    and delivered with a single call to the mailer's ``send_many`` method
+    once the transaction commits, i.e. over a single SMTP session when
+    ``mailer`` is a :class:`pyramid_mailer.pool.SMTPConnectionPool`.
+
+    Messages which could not be delivered do not prevent the rest of the
+    batch from being sent; the first error is raised afterwards.
+
+    :param mailer: a mailer providing ``send_many``
+    :param transaction_manager: the transaction manager to join
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, mailer, transaction_manager=None):
+        self.mailer = mailer
+        if transaction_manager is None:
+            transaction_manager = transaction.manager
+        self.transaction_manager = transaction_manager
+
+    def send(self, fromaddr, toaddrs, message):
+        return self.send_many([(fromaddr, toaddrs, message)])[0]
+
+    def send_many(self, envelopes):
+        """Schedule ``(fromaddr, toaddrs, message)`` envelopes for delivery.
+
+        Returns the list of message ids.
+        """
+        messageids = []
+        batch = self._get_batch()
+        for fromaddr, toaddrs, message in envelopes:
+            messageids.append(prepare_message(message))
+            batch.append((fromaddr, toaddrs, self._render(message)))
+        return messageids
+
+    def _render(self, message):
+        return message
+
+    def _get_batch(self):
+        txn = self.transaction_manager.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            batch = []
+            managed = MailDataManager(
+                self._deliver,
+                args=(batch,),
+                transaction_manager=self.transaction_manager)
+            managed.join_transaction(txn)
+            txn.set_data(self, batch)
+            return batch
+
+    def _deliver(self, envelopes):
+        results = self.mailer.send_many(envelopes)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+
+class BackgroundMailDelivery(BatchMailDelivery):
+    """Transactional delivery handing messages to a background sender.
+
+    Works like :class:`BatchMailDelivery`, but messages are encoded when
+    they are sent and, once the transaction commits, the batch is only
+    submitted to ``background_sender``; the SMTP session happens in a
+    worker thread and the commit does not wait for the mail server.
+    Delivery errors are logged.
+
+    :param mailer: a mailer providing ``send_many``
+    :param background_sender: a
+           :class:`pyramid_mailer.background.BackgroundSender`
+    :param transaction_manager: the transaction manager to join
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, mailer, background_sender, transaction_manager=None):
+        super(BackgroundMailDelivery, self).__init__(
+            mailer, transaction_manager=transaction_manager)
+        self.background_sender = background_sender
+
+    def _render(self, message):
+        return message.as_string().encode('ascii')
+
+    def _deliver(self, envelopes):
+        self.background_sender.submit(self._deliver_logged, envelopes)
+
+    def _deliver_logged(self, envelopes):
+        results = self.mailer.send_many(envelopes)
+        for (fromaddr, toaddrs, message), result in zip(envelopes, results):
+            if isinstance(result, Exception):
+                log.error(
+                    'Error while sending mail from %s to %s: %s',
+                    fromaddr, ', '.join(toaddrs), result)
+        return results
+
+
+def _open_unique(directory):
+    # a maildir file name unique to this host, process and moment
+    while True:
+        name = '%d.%d.%s.%d' % (
+            time.time(), os.getpid(), socket.gethostname(),
+            random.randrange(0x7fffffff))
+        try:
+            return open(os.path.join(directory, name), 'xb'), name
+        except FileExistsError:
+            continue
+
+
+def _queue_headers(message):
+    # the Message-Id and Date headers prepare_message adds, for a
+    # pyramid_mailer message
+    present = dict(
+        (name.lower(), value)
+        for name, value in dict(message.extra_headers).items())
+    messageid = message.message_id
+    headers = []
+    if messageid is None:
+        messageid = make_msgid('repoze.sendmail')
+        headers.append(('Message-Id', messageid))
+    if 'date' not in present:
+        headers.append(('Date', formatdate()))
+    return messageid, headers
+
+
+class StreamingQueuedMailDelivery(QueuedMailDelivery):
+    """Transactional delivery adding messages to a maildir queue.
+
+    Accepts :class:`pyramid_mailer.message.Message` instances as well as
+    ``email.message.Message`` ones.  The former are written to the queue
+    file with :meth:`~pyramid_mailer.message.Message.write_to`, so large
+    file attachments are encoded a chunk at a time instead of being held
+    in memory.  The file is moved into the queue when the transaction
+    commits, just like with
+    :class:`repoze.sendmail.delivery.QueuedMailDelivery`.
+
+    If ``shards`` is given, ``queuePath`` holds that many maildirs and
+    each message is written to the one chosen by a hash of its
+    ``Message-Id``, see :class:`pyramid_mailer.queue.ShardedMaildirQueue`.
+
+    If ``committer`` is given, queued messages are made durable when the
+    transaction commits, by ``committer``, a
+    :class:`pyramid_mailer.queue.GroupCommit` flushing with
+    :func:`pyramid_mailer.queue.sync_directories`: the files of all
+    messages of the transaction are submitted at once, as a tuple, and
+    synced before they are moved into the queue, then the directories
+    they were moved to are.  Transactions committing at the same time
+    share the syncs, and nothing is synced for a transaction which is
+    aborted.
+
+    ``send`` takes an optional ``not_before`` timestamp; until then the
+    message is kept out of the queue, in the ``scheduled`` directory of
+    the maildir (see :meth:`pyramid_mailer.queue.MaildirQueue.promote`).
+
+    If ``dedup`` is given, a message whose ``Message-Id`` has been queued
+    recently is dropped: it is not written if the id is in the index when
+    it is sent, and not moved into the queue if another transaction has
+    recorded the id by the time this one commits.  Ids are only recorded
+    on commit, so a transaction which is retried after an abort queues
+    its messages.  Messages sent without a ``Message-Id`` are given a
+    random one, which is neither looked up nor recorded.
+
+    If ``compression`` is given, queue files are compressed as they are
+    written, see :func:`pyramid_mailer.queue.compressing`.  Only
+    :class:`pyramid_mailer.queue.QueueProcessor` reads such a queue.
+
+    If ``counters`` are given, the messages moved into the queue are
+    counted, see :class:`pyramid_mailer.queue.QueueCounters`.
+
+    :param queuePath: the path of the maildir
+    :param transaction_manager: the transaction manager to join
+    :param shards: the number of maildirs to spread the messages over
+    :param committer: the group commit syncing the queue directory
+    :param dedup: a :class:`pyramid_mailer.queue.DedupIndex`
+    :param compression: ``zlib``, ``lzma`` or ``None``
+    :param counters: a :class:`pyramid_mailer.queue.QueueCounters`
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, queuePath, transaction_manager=None, shards=None,
+                 committer=None, dedup=None, compression=None,
+                 counters=None):
+        super(StreamingQueuedMailDelivery, self).__init__(
+            queuePath, transaction_manager=transaction_manager)
+        self.shards = shards
+        self.committer = committer
+        self.dedup = dedup
+        self.compression = compression
+        self.counters = counters
+
+    def _maildir(self, messageid):
+        path = self.queuePath
+        if self.shards:
+            path = shard_path(path, shard_index(messageid, self.shards))
+        return open_maildir(path)
+
+    def _is_duplicate(self, messageid):
+        if messageid is None or self.dedup is None:
+            return False
+        if messageid in self.dedup:
+            log.info('Dropped duplicate message %s.', messageid)
+            return True
+        return False
+
+    def _add(self, maildir, write, dedupid, not_before=None):
+        # write a file to tmp/ and add it to the transaction's batch, to be
+        # moved to new/ on commit, or to scheduled/ until not_before;
+        # dedupid is the id recorded in the dedup index, if any
+        fp, name = _open_unique(str(maildir.subdir_tmp))
+        try:
+            with fp:
+                if self.compression is None:
+                    write(fp)
+                else:
+                    with compressing(fp, self.compression) as out:
+                        write(out)
+        except Exception:
+            os.unlink(fp.name)
+            raise
+        target = str(maildir.subdir_new / name)
+        if not_before is not None and not_before > time.time():
+            target = scheduled_path(str(maildir.path), not_before, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        tx_message = MaildirTransactionalMessage(
+            maildir.subdir_tmp / name, target)
+        self._get_batch().append((tx_message, fp.name, target, dedupid))
+
+    def _get_batch(self):
+        # the messages of the current transaction, moved into the queue by
+        # a single data manager, so the transaction syncs the directories
+        # once however many messages it queues
+        txn = self.transaction_manager.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            batch = []
+            managed = MailDataManager(
+                self._commit, args=(batch,),
+                onAbort=lambda: self._abort(batch),
+                transaction_manager=self.transaction_manager)
+            managed.join_transaction(txn)
+            txn.set_data(self, batch)
+            return batch
+
+    def _commit(self, batch):
+        kept = []
+        for entry in batch:
+            tx_message, path, target, dedupid = entry
+            if (dedupid is not None and self.dedup is not None and
+                    not self.dedup.add(dedupid)):
+                log.info('Dropped duplicate message %s.', dedupid)
+                tx_message.abort()
+                continue
+            kept.append(entry)
+        if self.committer is not None and kept:
+            # the files are durable before they appear in the queue
+            self.committer.submit(tuple(entry[1] for entry in kept))
+        moves = []
+        directories = []
+        for tx_message, path, target, dedupid in kept:
+            try:
+                tx_message.commit()
+            except FileNotFoundError:
+                # a processor removed the past bucket of a message whose
+                # transaction took that long
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tx_message.commit()
+            moves.append((os.path.basename(path), None, 'queued'))
+            directory = os.path.dirname(target)
+            if directory not in directories:
+                directories.append(directory)
+        if self.counters is not None and moves:
+            self.counters.move(moves)
+        if self.committer is not None and directories:
+            self.committer.submit(tuple(directories))
+
+    def _abort(self, batch):
+        for tx_message, path, target, dedupid in batch:
+            tx_message.abort()
+
+    def _add_message(self, fromaddr, toaddrs, message, dedupid,
+                     not_before=None):
+        # QueuedMailDelivery.createDataManager, writing to the shard
+        message = copy_message(message)
+        message['X-Actually-From'] = Header(fromaddr, 'utf-8')
+        message['X-Actually-To'] = Header(','.join(toaddrs), 'utf-8')
+        self._add(
+            self._maildir(message['Message-Id']),
+            lambda fp: fp.write(message.as_bytes()), dedupid, not_before)
+
+    def send(self, fromaddr, toaddrs, message, not_before=None):
+        if isinstance(message, Message):
+            dedupid = message['Message-Id']
+            messageid = prepare_message(message)
+            if self._is_duplicate(dedupid):
+                return messageid
+            self._add_message(fromaddr, toaddrs, message, dedupid, not_before)
+            return messageid
+
+        dedupid = message.message_id
+        messageid, headers = _queue_headers(message)
+        if self._is_duplicate(dedupid):
+            return messageid
+        headers.append(('X-Actually-From', Header(fromaddr, 'utf-8')))
+        headers.append(('X-Actually-To', Header(','.join(toaddrs), 'utf-8')))
+
+        maildir = self._maildir(messageid)
+        self._add(
+            maildir, lambda fp: message.write_to(fp, headers), dedupid,
+            not_before)
+        return messageid
+
+
+class SQLiteQueuedMailDelivery(BatchMailDelivery):
+    """Transactional delivery adding messages to a SQLite queue.
+
+    Messages are rendered when they are sent; once the transaction
+    commits, all messages sent during it are added to ``queue`` in a single
+    SQLite transaction.  Accepts :class:`pyramid_mailer.message.Message`
+    instances as well as ``email.message.Message`` ones.
+
+    If ``compression`` is given, messages are stored compressed, see
+    :func:`pyramid_mailer.queue.compress_queued`.
+
+    :param queue: a :class:`pyramid_mailer.queue.SQLiteQueue`
+    :param transaction_manager: the transaction manager to join
+    :param compression: ``zlib``, ``lzma`` or ``None``
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, queue, transaction_manager=None, compression=None):
+        super(SQLiteQueuedMailDelivery, self).__init__(
+            queue, transaction_manager=transaction_manager)
+        self.queue = queue
+        self.compression = compression
+
+    def send(self, fromaddr, toaddrs, message, not_before=None):
+        return self.send_many(
+            [(fromaddr, toaddrs, message)], not_before=not_before)[0]
+
+    def send_many(self, envelopes, not_before=None):
+        """Schedule ``(fromaddr, toaddrs, message)`` envelopes for delivery,
+        not before the timestamp ``not_before`` if given.
+
+        Returns the list of message ids.
+        """
+        messageids = []
+        batch = self._get_batch()
+        for fromaddr, toaddrs, message in envelopes:
+            # only the ids chosen by the caller are recorded to drop
+            # duplicates, a generated one cannot recur
+            if isinstance(message, Message):
+                dedupid = message['Message-Id']
+                messageid = prepare_message(message)
+                data = encoding.encode_message(message)
+            else:
+                dedupid = message.message_id
+                messageid, headers = _queue_headers(message)
+                data = message.to_bytes(headers=headers)
+            if self.compression is not None:
+                data = compress_queued(data, self.compression)
+            messageids.append(messageid)
+            batch.append((messageid, fromaddr, list(toaddrs), data,
+                          not_before, dedupid))
+        return messageids
+
+    def _deliver(self, messages):
+        self.queue.add_many(messages)
@@ -1,4 +1,6 @@
+import copy
 from datetime import datetime
+from email.utils import make_msgid
 from os import makedirs
 from os.path import exists
 from os.path import join
@@ -10,10 +12,26 @@ from pyramid.settings import aslist
 from repoze.sendmail.mailer import SMTPMailer
 from repoze.sendmail.mailer import SendmailMailer
 from repoze.sendmail.delivery import DirectMailDelivery
-from repoze.sendmail.delivery import QueuedMailDelivery
 import transaction
 
 from pyramid_mailer._compat import SMTP_SSL
+from pyramid_mailer.background import BackgroundSender
+from pyramid_mailer.delivery import BackgroundMailDelivery
+from pyramid_mailer.delivery import BatchMailDelivery
+from pyramid_mailer.delivery import SQLiteQueuedMailDelivery
+from pyramid_mailer.delivery import StreamingQueuedMailDelivery
+from pyramid_mailer.pool import MultiHostPool
+from pyramid_mailer.pool import SMTPConnectionPool
+from pyramid_mailer.queue import COMPRESSIONS
+from pyramid_mailer.queue import DEFAULT_LANE
+from pyramid_mailer.queue import DedupIndex
+from pyramid_mailer.queue import GroupCommit
+from pyramid_mailer.queue import QueueCounters
+from pyramid_mailer.queue import SQLiteQueue
+from pyramid_mailer.queue import lane_path
+from pyramid_mailer.queue import mailer_queues
+from pyramid_mailer.queue import sync_directories
+from pyramid_mailer.routing import RecipientRouter
 
 
 def _check_bind_options(kw):
@@ -84,16 +102,32 @@ class DebugMailer(object):
         if self.include_bcc:
             message.extra_headers['Bcc'] = ', '.join(message.bcc)
 
-        with open(filename, 'w') as fd:
+        with open(filename, 'wb') as fd:
             if not message.sender:
                 message.sender = 'nobody'
-            fd.write(str(message.to_message()))
+            message.write_to(fd)
+
+    def _send_many(self, messages):
+        """Save each message to a file for debugging
+        """
+        for message in messages:
+            self._send(message)
+
+    def send_to_queue(self, message, priority=None, not_before=None):
+        """Save message to a file for debugging
+
+        :param message: a 'Message' instance.
+        :param priority: ignored
+        :param not_before: ignored
+        """
+        self._send(message)
 
     send = _send
     send_immediately = _send
-    send_to_queue = _send
     send_sendmail = _send
     send_immediately_sendmail = _send
+    send_many = _send_many
+    send_many_immediately = _send_many
 
 
 class DummyMailer(object):
@@ -144,12 +178,38 @@ class DummyMailer(object):
         """
         self.outbox.append(message)
 
-    def send_to_queue(self, message):
+    def send_many(self, messages):
+        """Mock sending several transactional messages via SMTP.
+
+        The messages are appended to the 'outbox' list.
+
+        :versionadded: 0.16
+
+        :param messages: a sequence of 'Message' instances.
+        """
+        self.outbox.extend(messages)
+
+    def send_many_immediately(self, messages):
+        """Mock sending several immediate (non-transactional) messages.
+
+        The messages are appended to the 'outbox' list.
+
+        :versionadded: 0.16
+
+        :param messages: a sequence of 'Message' instances.
+        """
+        messages = list(messages)
+        self.outbox.extend(messages)
+        return [{} for message in messages]
+
+    def send_to_queue(self, message, priority=None, not_before=None):
         """Mock sending to a maildir queue.
 
         The message is appended to the 'queue' list.
 
         :param message: a 'Message' instance.
+        :param priority: ignored
+        :param not_before: ignored
         """
         self.queue.append(message)
 
@@ -198,6 +258,49 @@ class SMTP_SSLMailer(SMTPMailer):
         return connection
 
 
+def _parse_host(address, port):
+    # "host", "host:port", "[ipv6]" or "[ipv6]:port"
+    host, sep, host_port = address.rpartition(':')
+    if not sep or (host.startswith('[') and not host.endswith(']')) or (
+            not host.startswith('[') and ':' in host):
+        host, host_port = address, None
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    if host_port:
+        port = int(host_port)
+    return host, port
+
+
+def _pooled(mailer):
+    # whether sends to ``mailer`` go through an SMTPConnectionPool, which
+    # also takes rendered messages
+    return isinstance(mailer, SMTPConnectionPool) or hasattr(
+        mailer, 'smtp_factory')
+
+
+def _smtp_mailer(host, port, username=None, password=None, tls=False,
+                 ssl=False, keyfile=None, certfile=None, debug=0):
+    if ssl:
+        return SMTP_SSLMailer(
+            hostname=host,
+            port=port,
+            username=username,
+            password=password,
+            no_tls=not(tls),
+            force_tls=tls,
+            debug_smtp=debug,
+            keyfile=keyfile,
+            certfile=certfile)
+    return SMTPMailer(
+        hostname=host,
+        port=port,
+        username=username,
+        password=password,
+        no_tls=not(tls),
+        force_tls=tls,
+        debug_smtp=debug)
+
+
 class Mailer(object):
     """Manages sending of email messages.
 
@@ -210,6 +313,29 @@ class Mailer(object):
     :param keyfile: SSL key file
     :param certfile: SSL certificate file
     :param queue_path: path to maildir for queued messages
+    :param queue_shards: spread queued messages over this many maildirs
+           below ``queue_path`` (see
+           :class:`pyramid_mailer.queue.ShardedMaildirQueue`)
+    :param queue_backend: ``maildir`` (the default) or ``sqlite``, which
+           keeps the queue in the SQLite database at ``queue_path`` (see
+           :class:`pyramid_mailer.queue.SQLiteQueue`)
+    :param queue_lanes: ``(name, weight)`` pairs of the priority lanes
+           messages can be queued in, highest priority first (see
+           :meth:`send_to_queue` and
+           :class:`pyramid_mailer.queue.LaneQueue`); a ``default`` lane of
+           weight 1 is added last unless given
+    :param queue_dedup_ttl: drop messages queued with the ``Message-Id``
+           of a message queued less than this many seconds before (see
+           :attr:`pyramid_mailer.message.Message.message_id`)
+    :param queue_counters: count the messages of the maildir queue as
+           they change state, for :meth:`queue_stats` (see
+           :class:`pyramid_mailer.queue.QueueCounters`)
+    :param queue_compression: store queued messages compressed with
+           ``zlib`` or ``lzma`` (see
+           :func:`pyramid_mailer.queue.compressing`)
+    :param queue_commit_latency: sync queued messages to disk, letting
+           transactions committing within this many seconds of each other
+           share one sync (see :class:`pyramid_mailer.queue.GroupCommit`)
     :param default_sender: default "from" address
     :param sendmail_app: path to "sendmail" binary.
            repoze defaults to "/usr/sbin/sendmail"
@@ -218,42 +344,101 @@ class Mailer(object):
     :param transaction_manager: a transaction manager to join with when
            sending transactional emails
     :param debug: SMTP debug level
+    :param pool_size: keep up to this many SMTP connections open between
+           sends (see :class:`pyramid_mailer.pool.SMTPConnectionPool`).
+           By default every message uses a new connection.
+    :param pool_idle_timeout: seconds after which an unused pooled
+           connection is closed, defaults to 60
+    :param hosts: send through several SMTP servers, given as ``host`` or
+           ``host:port`` (``port`` is the default), instead of ``host``,
+           failing over between them (see
+           :class:`pyramid_mailer.pool.MultiHostPool`)
+    :param hosts_strategy: how connections are spread over ``hosts``:
+           ``round_robin`` (the default) or ``least_outstanding``
+    :param hosts_max_failures: failures in a row after which a host is
+           skipped, defaults to 3
+    :param hosts_retry_after: seconds a failing host is skipped, defaults
+           to 30
+    :param routes: ``(pattern, transport)`` pairs sending the recipients
+           whose domain matches ``pattern`` (see
+           :class:`pyramid_mailer.routing.RecipientRouter`) through
+           ``transport``: ``smtp:host[:port][,host[:port]...]``,
+           ``sendmail``, ``queue`` or ``queue:<lane>``; all other
+           recipients, and those routed to ``default``, are sent through
+           the SMTP server configured above.  Applies to :meth:`send` and
+           :meth:`send_immediately`.
+    :param transactional_delivery: how :meth:`send` delivers messages when
+           the transaction commits: ``direct`` (the default) sends each
+           message over its own connection, ``batch`` sends all messages
+           of the transaction over a single SMTP session, ``background``
+           hands that session to the background threads configured with
+           ``async_workers`` and ``queue`` writes the messages to the
+           maildir queue.
+    :param async_workers: deliver messages passed to
+           :meth:`send_immediately` and :meth:`send_many_immediately` from
+           this many background threads instead of the calling thread.
+    :param async_queue_size: the maximum number of messages waiting for
+           a background thread, defaults to 1000
     """
 
     def __init__(self, **kw):
         smtp_mailer = kw.pop('smtp_mailer', None)
+        hosts = kw.pop('hosts', None)
+        hosts_strategy = kw.pop('hosts_strategy', 'round_robin')
+        hosts_max_failures = kw.pop('hosts_max_failures', 3)
+        hosts_retry_after = kw.pop('hosts_retry_after', 30)
+        pool_size = kw.pop('pool_size', None)
+        pool_idle_timeout = kw.pop('pool_idle_timeout', 60)
+        port = 25
+        smtp_options = {}
         if smtp_mailer is None:
             host = kw.pop('host', 'localhost')
             port = kw.pop('port', 25)
-            username = kw.pop('username', None)
-            password = kw.pop('password', None)
-            tls = kw.pop('tls', False)
-            ssl = kw.pop('ssl', False)
-            keyfile = kw.pop('keyfile', None)
-            certfile = kw.pop('certfile', None)
-            debug = kw.pop('debug', 0)
-            if ssl:
-                smtp_mailer = SMTP_SSLMailer(
-                    hostname=host,
-                    port=port,
-                    username=username,
-                    password=password,
-                    no_tls=not(tls),
-                    force_tls=tls,
-                    debug_smtp=debug,
-                    keyfile=keyfile,
-                    certfile=certfile)
+            for key in ('username', 'password', 'tls', 'ssl', 'keyfile',
+                        'certfile', 'debug'):
+                if key in kw:
+                    smtp_options[key] = kw.pop(key)
+
+        def make_pool(addresses):
+            return MultiHostPool(
+                [_smtp_mailer(*_parse_host(address, port), **smtp_options)
+                 for address in addresses],
+                size=pool_size or 0, idle_timeout=pool_idle_timeout,
+                strategy=hosts_strategy, max_failures=hosts_max_failures,
+                retry_after=hosts_retry_after)
+
+        if smtp_mailer is None:
+            if hosts:
+                smtp_mailer = make_pool(hosts)
             else:
-                smtp_mailer = SMTPMailer(
-                    hostname=host,
-                    port=port,
-                    username=username,
-                    password=password,
-                    no_tls=not(tls),
-                    force_tls=tls,
-                    debug_smtp=debug)
+                smtp_mailer = _smtp_mailer(host, port, **smtp_options)
+
+        if pool_size and not isinstance(smtp_mailer, SMTPConnectionPool):
+            smtp_mailer = SMTPConnectionPool(
+                smtp_mailer, size=pool_size, idle_timeout=pool_idle_timeout)
         self.smtp_mailer = smtp_mailer
 
+        self.routes = list(kw.pop('routes', None) or ())
+        self.route_mailers = kw.pop('route_mailers', None)
+        self.route_sender = kw.pop('route_sender', None)
+        router = kw.pop('router', None)
+        if self.routes and self.route_mailers is None:
+            # one pool per SMTP transport, shared by its routes
+            self.route_mailers = {}
+            for pattern, transport in self.routes:
+                name, sep, addresses = transport.partition(':')
+                addresses = addresses.split(',')
+                if name != 'smtp' or transport in self.route_mailers:
+                    continue
+                if not all(addresses):
+                    raise ValueError(
+                        'invalid route transport: %s' % transport)
+                self.route_mailers[transport] = make_pool(addresses)
+        if self.routes and self.route_sender is None:
+            self.route_sender = BackgroundSender(
+                workers=len(set(transport for pattern, transport
+                                in self.routes)) + 1)
+
         sendmail_mailer = kw.pop('sendmail_mailer', None)
         if sendmail_mailer is None:
             sendmail_mailer = SendmailMailer(
@@ -263,8 +448,55 @@ class Mailer(object):
         self.sendmail_mailer = sendmail_mailer
 
         self.queue_path = kw.pop('queue_path', None)
+        self.queue_shards = kw.pop('queue_shards', None)
+        self.queue_backend = kw.pop('queue_backend', 'maildir')
+        if self.queue_backend not in ('maildir', 'sqlite'):
+            raise ValueError('invalid queue_backend: %s' % self.queue_backend)
+        if self.queue_backend == 'sqlite' and self.queue_shards:
+            raise ValueError("queue_shards requires the 'maildir' backend")
+        self.queue_lanes = list(kw.pop('queue_lanes', None) or ())
+        for lane, weight in self.queue_lanes:
+            lane_path('', lane)
+            if weight < 1:
+                raise ValueError('invalid weight of queue lane %s: %s' % (
+                    lane, weight))
+        if DEFAULT_LANE not in dict(self.queue_lanes):
+            self.queue_lanes.append((DEFAULT_LANE, 1))
+        self.sqlite_queues = kw.pop('sqlite_queues', None)
+        self.queue_commit_latency = kw.pop('queue_commit_latency', None)
+        self.queue_dedup_ttl = kw.pop('queue_dedup_ttl', None)
+        self.queue_dedup = kw.pop('queue_dedup', None)
+        self.queue_compression = kw.pop('queue_compression', None) or None
+        self.queue_counters = kw.pop('queue_counters', False)
+        self.lane_counters = kw.pop('lane_counters', None)
+        if (self.queue_compression is not None and
+                self.queue_compression not in COMPRESSIONS):
+            raise ValueError(
+                'invalid queue_compression: %s' % self.queue_compression)
+        self.queue_committer = kw.pop('queue_committer', None)
         self.default_sender = kw.pop('default_sender', None)
 
+        background_sender = kw.pop('background_sender', None)
+        async_workers = kw.pop('async_workers', None)
+        async_queue_size = kw.pop('async_queue_size', 1000)
+        if background_sender is None and async_workers:
+            background_sender = BackgroundSender(
+                workers=async_workers, queue_size=async_queue_size)
+        self.background_sender = background_sender
+
+        transactional_delivery = kw.pop('transactional_delivery', 'direct')
+        if transactional_delivery not in (
+                'direct', 'batch', 'background', 'queue'):
+            raise ValueError(
+                'invalid transactional_delivery: %s' % transactional_delivery)
+        if transactional_delivery == 'background' and not background_sender:
+            raise ValueError(
+                "transactional_delivery 'background' requires async_workers")
+        if transactional_delivery == 'queue' and not self.queue_path:
+            raise ValueError(
+                "transactional_delivery 'queue' requires queue_path")
+        self.transactional_delivery = transactional_delivery
+
         transaction_manager = kw.pop('transaction_manager', None)
         if transaction_manager is None:
             transaction_manager = transaction.manager
@@ -277,15 +509,78 @@ class Mailer(object):
         self.direct_delivery = DirectMailDelivery(
             self.smtp_mailer, transaction_manager=transaction_manager)
 
-        if self.queue_path:
-            self.queue_delivery = QueuedMailDelivery(
-                self.queue_path, transaction_manager=transaction_manager)
+        if isinstance(self.smtp_mailer, SMTPConnectionPool):
+            self.smtp_pool = self.smtp_mailer
+        else:
+            # a pool which keeps no idle connections still sends a whole
+            # batch over one session
+            self.smtp_pool = SMTPConnectionPool(self.smtp_mailer, size=0)
+
+        self.batch_delivery = BatchMailDelivery(
+            self.smtp_pool, transaction_manager=transaction_manager)
+
+        if self.background_sender is not None:
+            self.background_delivery = BackgroundMailDelivery(
+                self.smtp_pool, self.background_sender,
+                transaction_manager=transaction_manager)
         else:
-            self.queue_delivery = None
+            self.background_delivery = None
+
+        # one delivery per priority lane
+        self.queue_deliveries = {}
+        self.sqlite_queue = None
+        if self.queue_path and self.queue_backend == 'sqlite':
+            if self.sqlite_queues is None:
+                self.sqlite_queues = dict(
+                    (lane, SQLiteQueue(
+                        self.queue_path,
+                        commit_latency=self.queue_commit_latency,
+                        lane=lane, dedup_ttl=self.queue_dedup_ttl))
+                    for lane, weight in self.queue_lanes)
+            self.sqlite_queue = self.sqlite_queues[DEFAULT_LANE]
+            for lane, weight in self.queue_lanes:
+                self.queue_deliveries[lane] = SQLiteQueuedMailDelivery(
+                    self.sqlite_queues[lane],
+                    transaction_manager=transaction_manager,
+                    compression=self.queue_compression)
+        elif self.queue_path:
+            if (self.queue_committer is None and
+                    self.queue_commit_latency is not None):
+                self.queue_committer = GroupCommit(
+                    sync_directories, self.queue_commit_latency)
+            if self.queue_counters and self.lane_counters is None:
+                self.lane_counters = dict(
+                    (lane, QueueCounters(
+                        join(lane_path(self.queue_path, lane), 'counts.db')))
+                    for lane, weight in self.queue_lanes)
+            if self.queue_dedup is None and self.queue_dedup_ttl:
+                self.queue_dedup = DedupIndex(
+                    join(self.queue_path, 'ids'), self.queue_dedup_ttl)
+            for lane, weight in self.queue_lanes:
+                self.queue_deliveries[lane] = StreamingQueuedMailDelivery(
+                    lane_path(self.queue_path, lane),
+                    transaction_manager=transaction_manager,
+                    shards=self.queue_shards, committer=self.queue_committer,
+                    dedup=self.queue_dedup,
+                    compression=self.queue_compression,
+                    counters=(self.lane_counters or {}).get(lane))
+        self.queue_delivery = self.queue_deliveries.get(DEFAULT_LANE)
 
         self.sendmail_delivery = DirectMailDelivery(
             self.sendmail_mailer, transaction_manager=transaction_manager)
 
+        self.router = None
+        self.route_deliveries = {}
+        if self.routes:
+            for transport, mailer in self.route_mailers.items():
+                self.route_deliveries[transport] = DirectMailDelivery(
+                    mailer, transaction_manager=transaction_manager)
+            if router is None:
+                for pattern, transport in self.routes:
+                    self._check_transport(transport)
+                router = RecipientRouter(self.routes, default='default')
+            self.router = router
+
     @classmethod
     def from_settings(cls, settings, prefix='mail.'):
         """Create a new instance of 'Mailer' from settings dict.
@@ -299,28 +594,63 @@ class Mailer(object):
                        'host', 'port', 'username',
                        'password', 'tls', 'ssl', 'keyfile',
                        'certfile', 'queue_path', 'debug', 'default_sender',
-                       'sendmail_app', 'sendmail_template')]
+                       'sendmail_app', 'sendmail_template', 'pool_size',
+                       'pool_idle_timeout', 'transactional_delivery',
+                       'async_workers', 'async_queue_size',
+                       'queue_shards', 'queue_backend',
+                       'queue_commit_latency', 'queue_lanes',
+                       'queue_dedup_ttl', 'queue_compression',
+                       'queue_counters', 'hosts', 'hosts_strategy',
+                       'hosts_max_failures', 'hosts_retry_after',
+                       'routes')]
 
         size = len(prefix)
 
         kwargs = dict(((k[size:], settings[k]) for k in settings.keys() if
                         k in kwarg_names))
 
-        for key in ('tls', 'ssl'):
+        for key in ('tls', 'ssl', 'queue_counters'):
             val = kwargs.get(key)
             if val:
                 kwargs[key] = asbool(val)
 
-        for key in ('debug', 'port'):
+        for key in ('debug', 'port', 'pool_size', 'pool_idle_timeout',
+                    'async_workers', 'async_queue_size', 'queue_shards',
+                    'queue_dedup_ttl', 'hosts_max_failures'):
             val = kwargs.get(key)
             if val:
                 kwargs[key] = int(val)
 
+        for key in ('queue_commit_latency', 'hosts_retry_after'):
+            val = kwargs.get(key)
+            if val:
+                kwargs[key] = float(val)
+
         # list values
-        for key in ('sendmail_template', ):
+        for key in ('sendmail_template', 'hosts'):
             if key in kwargs:
                 kwargs[key] = aslist(kwargs.get(key))
 
+        # "name:weight" pairs, e.g. "urgent:10 default:5 bulk:1"
+        if 'queue_lanes' in kwargs:
+            lanes = []
+            for lane in aslist(kwargs['queue_lanes']):
+                name, sep, weight = lane.partition(':')
+                lanes.append((name, int(weight or 1)))
+            kwargs['queue_lanes'] = lanes
+
+        # "pattern ... = transport" lines, e.g.
+        # "example.com *.example.com = smtp:relay.example.com"
+        if 'routes' in kwargs:
+            routes = []
+            for line in aslist(kwargs['routes'], flatten=False):
+                patterns, sep, transport = line.partition('=')
+                if not sep or not patterns.split():
+                    raise ValueError('invalid route: %s' % line)
+                for pattern in patterns.split():
+                    routes.append((pattern, transport.strip()))
+            kwargs['routes'] = routes
+
         username = kwargs.pop('username', None)
         password = kwargs.pop('password', None)
         if not (username or password):
@@ -350,8 +680,25 @@ class Mailer(object):
             smtp_mailer=self.smtp_mailer,
             sendmail_mailer=self.sendmail_mailer,
             queue_path=self.queue_path,
+            queue_shards=self.queue_shards,
+            queue_backend=self.queue_backend,
+            queue_lanes=self.queue_lanes,
+            sqlite_queues=self.sqlite_queues,
+            queue_commit_latency=self.queue_commit_latency,
+            queue_dedup_ttl=self.queue_dedup_ttl,
+            queue_dedup=self.queue_dedup,
+            queue_compression=self.queue_compression,
+            queue_counters=self.queue_counters,
+            lane_counters=self.lane_counters,
+            queue_committer=self.queue_committer,
             default_sender=default_sender,
             transaction_manager=transaction_manager,
+            transactional_delivery=self.transactional_delivery,
+            background_sender=self.background_sender,
+            routes=self.routes,
+            route_mailers=self.route_mailers,
+            route_sender=self.route_sender,
+            router=self.router,
         )
 
     def send(self, message):
@@ -360,9 +707,45 @@ class Mailer(object):
         The message is handled inside a transaction, so in case of failure
         (or the message fails) the message will not be sent.
 
+        With ``transactional_delivery='batch'`` all messages sent during the
+        transaction are delivered over a single SMTP session on commit; with
+        ``'background'`` that session is handed to a background thread, so
+        the commit does not wait for the mail server; with ``'queue'`` the
+        messages are added to the maildir queue.
+
+        With ``routes``, the recipients are grouped by route and every
+        group is delivered through its transport in the same transaction;
+        only the ``default`` group is delivered as configured above.
+
         :param message: a 'Message' instance.
         """
-        return self.direct_delivery.send(*self._message_args(message))
+        if self.router is None:
+            return self._send_transactional(message, message.send_to)
+        messageid = None
+        message, groups = self._route(message)
+        for transport, toaddrs in groups:
+            messageid = self._send_transactional(message, toaddrs, transport)
+        return messageid
+
+    def _send_transactional(self, message, toaddrs, transport='default'):
+        if transport == 'default' and self.transactional_delivery == 'queue':
+            transport = 'queue'
+        name, sep, lane = transport.partition(':')
+        if name == 'queue':
+            sender, send_to, message = self._stream_args(message)
+            return self.queue_deliveries[lane or DEFAULT_LANE].send(
+                sender, toaddrs, message)
+        if transport == 'sendmail':
+            delivery = self.sendmail_delivery
+        elif transport != 'default':
+            delivery = self.route_deliveries[transport]
+        else:
+            delivery = {
+                'batch': self.batch_delivery,
+                'background': self.background_delivery,
+            }.get(self.transactional_delivery, self.direct_delivery)
+        sender, send_to, msg = self._message_args(message)
+        return delivery.send(sender, toaddrs, msg)
 
     def send_immediately(self, message, fail_silently=False):
         """Send a message immediately, outside the transaction manager.
@@ -371,30 +754,265 @@ class Mailer(object):
         be handled manually. However if you pass ``fail_silently`` the error
         will be swallowed.
 
+        Returns a dictionary of the recipients refused by the server.
+
+        If ``async_workers`` is configured, the message is rendered in the
+        calling thread and then handed to a background thread, so changing
+        it after the call has no effect on the delivery; a
+        :class:`concurrent.futures.Future` for the result of the delivery
+        is returned instead.
+
+        With ``routes``, the recipients are grouped by route and the groups
+        are delivered in parallel, each through its transport; the refused
+        recipients of all groups are returned.  Groups routed to the queue
+        are added to it right away, in a transaction of their own, whatever
+        becomes of the current one.
+
         :versionadded: 0.3
 
         :param message: a 'Message' instance.
 
         :param fail_silently: silently handle connection errors.
         """
+        args = self._stream_args(message)
+        if self.router is not None:
+            message, groups = self._route(message)
+            if [transport for transport, toaddrs in groups] != ['default']:
+                return self._send_routed(message, groups, fail_silently)
+        if self.background_sender is not None:
+            return self.background_sender.submit(
+                self._send_smtp, self._rendered_args(args), fail_silently)
+        return self._send_smtp(args, fail_silently)
+
+    def _rendered_args(self, args, pooled=None):
+        # messages handed to a background thread are rendered first, so
+        # changing them after the call does not change what is sent
+        sender, send_to, message = args
+        if pooled is None:
+            pooled = _pooled(self.smtp_mailer)
+        if pooled:
+            return (sender, send_to, message.to_bytes())
+        return (sender, send_to, message.to_message())
+
+    def _check_transport(self, transport):
+        name, sep, lane = transport.partition(':')
+        if transport in ('default', 'sendmail') or (
+                transport in self.route_mailers):
+            return
+        if name != 'queue':
+            raise ValueError('invalid route transport: %s' % transport)
+        if not self.queue_path:
+            raise ValueError(
+                'route transport %s requires queue_path' % transport)
+        if (lane or DEFAULT_LANE) not in self.queue_deliveries:
+            raise ValueError('unknown queue priority: %s' % lane)
+
+    def _route(self, message):
+        groups = self.router.split(message.send_to)
+        if len(groups) > 1 and message.message_id is None:
+            # every route sends the same message; the id is given to a
+            # copy, so the message gets a new one when it is sent again
+            message = copy.copy(message)
+            message.extra_headers = dict(message.extra_headers)
+            message.extra_headers['Message-Id'] = make_msgid()
+        return message, groups
+
+    def _route_mailer(self, transport):
+        if transport == 'default':
+            return self.smtp_mailer
+        if transport == 'sendmail':
+            return self.sendmail_mailer
+        return self.route_mailers[transport]
+
+    def _send_routed(self, message, groups, fail_silently):
+        jobs = []
+        queued = []
+        for transport, toaddrs in groups:
+            if transport.partition(':')[0] == 'queue':
+                queued.append((transport, toaddrs))
+            else:
+                jobs.append((transport, message.sender, toaddrs, message))
+        if queued:
+            # committed here, not with the transaction of the caller
+            tm = transaction.TransactionManager()
+            mailer = self.bind(transaction_manager=tm)
+            with tm:
+                for transport, toaddrs in queued:
+                    mailer._send_transactional(message, toaddrs, transport)
+        if len(jobs) > 1 or self.background_sender is not None:
+            # rendered here, once for all SMTP pools, instead of by every
+            # delivery thread
+            data = None
+            rendered = []
+            for transport, sender, toaddrs, msg in jobs:
+                if _pooled(self._route_mailer(transport)):
+                    if data is None:
+                        data = message.to_bytes()
+                    msg = data
+                else:
+                    msg = message.to_message()
+                rendered.append((transport, sender, toaddrs, msg))
+            jobs = rendered
+        if self.background_sender is not None:
+            return self.background_sender.submit(
+                self._send_routes, jobs, fail_silently)
+        return self._send_routes(jobs, fail_silently)
+
+    def _send_routes(self, jobs, fail_silently):
+        # the first route is delivered by this thread, the others in
+        # parallel by the route sender
+        futures = [
+            self.route_sender.submit(self._send_route, job, fail_silently)
+            for job in jobs[1:]]
+        results = []
+        for job in jobs[:1]:
+            try:
+                results.append(self._send_route(job, fail_silently))
+            except Exception as exc:
+                results.append(exc)
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as exc:
+                results.append(exc)
+        refused = {}
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+            refused.update(result or {})
+        return refused
+
+    def _send_route(self, job, fail_silently):
+        transport, sender, toaddrs, message = job
+        if transport == 'default':
+            return self._send_smtp((sender, toaddrs, message), fail_silently)
+        mailer = self._route_mailer(transport)
+        if not _pooled(mailer) and hasattr(message, 'to_message'):
+            message = message.to_message()
+        if transport == 'sendmail':
+            mailer.send(sender, toaddrs, message)
+            return {}
         try:
-            return self.smtp_mailer.send(*self._message_args(message))
+            return mailer.send(sender, toaddrs, message)
         except smtplib.socket.error:
             if not fail_silently:
                 raise
 
-    def send_to_queue(self, message):
+    def _send_smtp(self, args, fail_silently):
+        smtp_mailer = self.smtp_mailer
+        if hasattr(smtp_mailer, 'smtp_factory'):
+            # drive plain SMTP mailers through the pool's session handling,
+            # which pipelines commands and reports refused recipients
+            smtp_mailer = SMTPConnectionPool(smtp_mailer, size=0)
+        if not isinstance(smtp_mailer, SMTPConnectionPool) and hasattr(
+                args[2], 'to_message'):
+            sender, send_to, message = args
+            args = (sender, send_to, message.to_message())
+        try:
+            return smtp_mailer.send(*args)
+        except smtplib.socket.error:
+            if not fail_silently:
+                raise
+
+    def send_many(self, messages):
+        """Send several messages within the transaction manager.
+
+        All messages are rendered immediately and delivered over a single
+        SMTP session when the transaction is committed, together with any
+        other message sent with this method during the transaction.
+
+        :versionadded: 0.16
+
+        :param messages: a sequence of 'Message' instances.
+
+        Returns the list of message ids.
+        """
+        envelopes = [self._message_args(message) for message in messages]
+        return self.batch_delivery.send_many(envelopes)
+
+    def send_many_immediately(self, messages):
+        """Send several messages immediately, outside the transaction manager.
+
+        All messages are rendered first, then delivered over a single SMTP
+        session (or a pooled one, see ``pool_size``).
+
+        :versionadded: 0.16
+
+        :param messages: a sequence of 'Message' instances.
+
+        Returns a list with one entry per message: a dictionary of the
+        recipients refused by the server (empty if all were accepted) or
+        the exception which prevented the message from being delivered.
+        If ``async_workers`` is configured, the messages are rendered in
+        the calling thread and the batch is delivered by a
+        background thread; a :class:`concurrent.futures.Future` for
+        that list is returned instead.
+        """
+        envelopes = [self._stream_args(message) for message in messages]
+        if self.background_sender is not None:
+            envelopes = [self._rendered_args(envelope, pooled=True)
+                         for envelope in envelopes]
+            return self.background_sender.submit(
+                self.smtp_pool.send_many, envelopes)
+        return self.smtp_pool.send_many(envelopes)
+
+    def shutdown(self, wait=True):
+        """Wait for background deliveries and close pooled connections.
+
+        Registered to run at interpreter exit by
+        ``config.include('pyramid_mailer')``.
+
+        :versionadded: 0.16
+
+        :param wait: block until all pending background deliveries are done
+        """
+        if self.background_sender is not None:
+            self.background_sender.shutdown(wait=wait)
+        if self.route_sender is not None:
+            self.route_sender.shutdown(wait=wait)
+        self.smtp_pool.close()
+        for mailer in (self.route_mailers or {}).values():
+            mailer.close()
+
+    def queue_stats(self):
+        """Returns the statistics of every lane of the queue, a dictionary
+        of the lane names and the statistics of their messages, see
+        :meth:`pyramid_mailer.queue.QueueCounters.stats`.
+
+        The SQLite queue is always counted; the maildir queue only with
+        ``queue_counters``, otherwise it is listed.
+        """
+        if not self.queue_path:
+            raise RuntimeError("No queue_path provided")
+        return dict(
+            (lane, queue.stats())
+            for lane, queue, weight in mailer_queues(self))
+
+    def send_to_queue(self, message, priority=None, not_before=None):
         """Add a message to a maildir queue.
 
         In order to handle this, the setting 'mail.queue_path' must be
-        provided and must point to a valid maildir.
+        provided and must point to a valid maildir, or to the SQLite
+        database with 'mail.queue_backend = sqlite'.
 
         :param message: a 'Message' instance.
+        :param priority: the name of one of the 'queue_lanes' to add the
+               message to, instead of the 'default' lane
+        :param not_before: a 'datetime' before which the message is not
+               sent; naive ones are in local time
         """
         if not self.queue_delivery:
             raise RuntimeError("No queue_path provided")
 
-        return self.queue_delivery.send(*self._message_args(message))
+        delivery = self.queue_delivery
+        if priority not in (None, DEFAULT_LANE):
+            delivery = self.queue_deliveries.get(priority)
+        if delivery is None:
+            raise ValueError('unknown queue priority: %s' % priority)
+        args = self._stream_args(message)
+        if not_before is None:
+            return delivery.send(*args)
+        return delivery.send(*args, not_before=not_before.timestamp())
 
     def _message_args(self, message):
 
@@ -403,6 +1021,13 @@ class Mailer(object):
         msg = message.to_message()
         return (message.sender, message.send_to, msg)
 
+    def _stream_args(self, message):
+        # like _message_args, but the message is only encoded while it is
+        # written out, see Message.iter_bytes
+        message.sender = message.sender or self.default_sender
+        message.validate()
+        return (message.sender, message.send_to, message)
+
     def send_sendmail(self, message ):
         """Send a message within the transaction manager.
 
@@ -33,14 +33,31 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import base64
 import cgi
+import collections
+import copy
+import hashlib
+import itertools
 import mimetypes
+import mmap
 import os
+import pathlib
+import re
 import string
+import threading
+import uuid
+import weakref
 
+from email.charset import Charset
+from email.header import Header
 from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.multipart import MIMEMultipart
 from email._policybase import Compat32
+from email.utils import encode_rfc2231
+from email.utils import formataddr
+from email.utils import getaddresses
+from email.utils import quote
 
 from email.encoders import _bencode
 
@@ -51,15 +68,81 @@ from .exceptions import (
 
 from ._compat import _qencode
 
+# change stamps handed out to messages and attachments; globally unique, so
+# a stamp never refers to two different states
+_stamps = itertools.count()
 
-class Attachment(object):
+_marker = object()
+
+# bytes read at a time from file objects streamed into a message; a multiple
+# of 57, the number of bytes per base64 line
+STREAM_CHUNK_SIZE = 57 * 1024
+
+_STREAM_PREFIX = 'pyramid-mailer-stream-'
+
+
+class _Placeholder(str):
+    # a part body standing in for data streamed when the message is written
+
+    stream = None
+
+
+class _Tracked(object):
+    # Bumps ``_version`` whenever a public attribute is rebound to a
+    # different object, so rendered output can be cached until then.
+
+    _version = 0
+
+    def __setattr__(self, name, value):
+        if (not name.startswith('_') and
+                getattr(self, name, _marker) is not value):
+            self._changed()
+        object.__setattr__(self, name, value)
+
+    def _changed(self):
+        object.__setattr__(self, '_version', next(_stamps))
+
+
+# read-only mappings of attached files, shared by all attachments of the
+# same (unchanged) file while any of them is alive
+_mappings = weakref.WeakValueDictionary()
+_mappings_lock = threading.Lock()
+
+def map_file(path):
+    """
+    Returns a read-only ``mmap.mmap`` of the file at ``path``, or ``b''``
+    if the file is empty.
+
+    Mappings are shared: as long as one is in use, mapping the same file
+    again returns it, unless the file has been modified in the meantime.
+    """
+    return _map_file(path)[0]
+
+def _map_file(path):
+    # the mapping and the key identifying the version of the file mapped
+    path = os.path.realpath(os.fspath(path))
+    with open(path, 'rb') as fp:
+        stat = os.fstat(fp.fileno())
+        if not stat.st_size:
+            return b'', None
+        key = (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with _mappings_lock:
+            mapping = _mappings.get(key)
+            if mapping is None:
+                mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                _mappings[key] = mapping
+    return mapping, key
+
+
+class Attachment(_Tracked):
     """
     Encapsulates file attachment information.
 
     :param filename: filename of attachment (if any)
     :param content_type: file mimetype (if any, may contain extra params in
            the form "text/plain; charset='utf-8'").
-    :param data: the raw file data, either as text or a file object
+    :param data: the raw file data, either as text or a file object, or
+           the file as an ``os.PathLike`` path or a ``mmap.mmap``
     :param disposition: content-disposition (if any, may contain extra
            params in the form 'attachment; filename="fred.txt"').  If filename
            is supplied in the disposition, it will be used if no filename
@@ -68,6 +151,11 @@ class Attachment(object):
     :param transfer_encoding: content-transfer-encoding (if any, may be
            'base64' or 'quoted-printable').  If it is not supplied, it will
            default to 'base64'.
+    :param path: the path of a file to attach, used as ``data``.  The
+           file name defaults to the last part of the path.
+
+    Files given by path are memory-mapped (see :func:`map_file`) when the
+    attachment is first rendered instead of being read into memory.
     """
 
     def __init__(
@@ -78,7 +166,12 @@ class Attachment(object):
         disposition=None,
         transfer_encoding=None,
         content_id=None,
+        path=None,
         ):
+        if path is not None:
+            data = pathlib.Path(path)
+            if filename is None:
+                filename = data.name
         self.filename = filename
         self.content_type = content_type
         self.disposition = disposition or 'attachment'
@@ -86,21 +179,112 @@ class Attachment(object):
         self.content_id = content_id
         self._data = data
 
+    _start = None
+    _file_key = None
+
     @property
     def data(self):
-        if hasattr(self._data, 'read'):
+        if isinstance(self._data, os.PathLike):
+            self._data, self._file_key = _map_file(self._data)
+        elif isinstance(self._data, mmap.mmap):
+            pass
+        elif hasattr(self._data, 'read'):
+            if self._start is not None:
+                self._data.seek(self._start)
             self._data = self._data.read()
         return self._data
 
-    def to_mailbase(self, default_content_type=None):
+    def _can_stream(self):
+        # mapped files and seekable file objects are streamed, they are read
+        # once per delivery
+        if (self.transfer_encoding or 'base64').lower() != 'base64':
+            return False
+        if isinstance(self._data, (os.PathLike, mmap.mmap)):
+            return len(self.data) > 0
+        fp = self._data
+        if not (hasattr(fp, 'read') and hasattr(fp, 'seek')):
+            return False
+        if self._start is None:
+            self._start = fp.tell()
+        fp.seek(self._start)
+        empty = not fp.read(1)
+        fp.seek(self._start)
+        return not empty
+
+    def _encoded_stream(self, charset=None):
+        # the base64-encoded data, as a single chunk from the encoded part
+        # cache if the data fits in it, otherwise encoded as it is read
+        size, key = self._stream_key()
+        encoded = encoded_part_cache.encode_stream(
+            key + (charset,), size,
+            lambda: b''.join(self._iter_encoded(charset)))
+        if encoded is None:
+            return self._iter_encoded(charset)
+        return iter([encoded])
+
+    def _stream_key(self):
+        # the size of the streamed data and a key identifying it: the
+        # version of the mapped or open file, else a hash of the data
+        data = self._data
+        if isinstance(data, mmap.mmap):
+            if self._file_key is not None:
+                return len(data), self._file_key
+            return len(data), (hashlib.sha1(data).digest(),)
+        try:
+            stat = os.fstat(data.fileno())
+        except (AttributeError, OSError):
+            digest = hashlib.sha1()
+            size = 0
+            for chunk in self._iter_chunks(STREAM_CHUNK_SIZE):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8', 'surrogateescape')
+                digest.update(chunk)
+                size += len(chunk)
+            return size, (digest.digest(),)
+        return stat.st_size - self._start, (
+            stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+            self._start)
+
+    def _iter_encoded(self, charset=None, chunk_size=STREAM_CHUNK_SIZE):
+        # base64-encodes the file a chunk at a time, CRLF line endings
+        pending = b''
+        for chunk in self._iter_chunks(chunk_size):
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset or 'utf-8', 'surrogateescape')
+            pending += chunk
+            usable = len(pending) - len(pending) % 57
+            if usable:
+                yield base64.encodebytes(pending[:usable]).replace(
+                    b'\n', b'\r\n')
+                pending = pending[usable:]
+        if pending:
+            yield base64.encodebytes(pending).replace(b'\n', b'\r\n')
+
+    def _iter_chunks(self, chunk_size):
+        data = self._data
+        if isinstance(data, mmap.mmap):
+            # slicing leaves the position alone, so a mapping can be shared
+            # by messages sent at the same time
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+            return
+        data.seek(self._start)
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def to_mailbase(self, default_content_type=None, streams=None):
         filename = self.filename
-        data = self.data
+        stream = streams is not None and self._can_stream()
+        data = None if stream else self.data
         content_type = self.content_type or default_content_type
         disposition = self.disposition or 'attachment'
         transfer_encoding = self.transfer_encoding or 'base64'
         content_id = self.content_id
 
-        if not data:
+        if not (stream or data):
             raise RuntimeError('No data provided to attachment')
 
         if filename and not content_type:
@@ -123,6 +307,11 @@ class Attachment(object):
             ctparams['name'] = filename
             dparams['filename'] = filename
 
+        if stream and content_type.startswith('text/') and (
+                'charset' not in ctparams):
+            # the charset has to be guessed from the whole text
+            stream = False
+
         base = MailBase()
         base.set_content_type(content_type, ctparams)
 
@@ -133,7 +322,13 @@ class Attachment(object):
                 charset = best_charset(self.data)[0]
             ctparams['charset'] = charset
 
-        base.set_body(self.data)
+        if stream:
+            token = '%s%s' % (_STREAM_PREFIX, uuid.uuid4().hex)
+            placeholder = _Placeholder(token)
+            placeholder.stream = streams[token] = self._encoded_stream(charset)
+            base.set_body(placeholder)
+        else:
+            base.set_body(self.data)
         base.set_content_type(content_type, ctparams)
         base.set_content_disposition(disposition, dparams)
         base.set_transfer_encoding(transfer_encoding)
@@ -142,7 +337,7 @@ class Attachment(object):
 
         return base
 
-class Message(object):
+class Message(_Tracked):
     """
     Encapsulates an email message.
 
@@ -155,11 +350,23 @@ class Message(object):
     :param bcc: BCC list
     :param extra_headers: dict of extra email headers
     :param attachments: list of Attachment instances
+    :param idempotency_key: a string identifying the message, from which
+                            its ``Message-Id`` is derived unless given in
+                            ``extra_headers`` (see :attr:`message_id`)
 
     The message must have a body or html part (or both) to be successfully
     sent.
+
+    The rendered message is cached until the message is changed, be it by
+    assigning an attribute, by the ``add_*`` and ``attach`` methods or by
+    editing the recipient lists or ``extra_headers`` in place.
     """
 
+    _cached = None
+    _cache_key = None
+    _template = None
+    _shared = None
+
     def __init__(
         self,
         subject=None,
@@ -170,7 +377,8 @@ class Message(object):
         cc=None,
         bcc=None,
         extra_headers=None,
-        attachments=None
+        attachments=None,
+        idempotency_key=None,
         ):
 
         self.subject = subject or ''
@@ -183,16 +391,251 @@ class Message(object):
         self.cc = cc or []
         self.bcc = bcc or []
         self.extra_headers = extra_headers or {}
+        self.idempotency_key = idempotency_key
 
     @property
     def send_to(self):
         return set(self.recipients) | set(self.bcc or ()) | set(self.cc or ())
 
+    @property
+    def message_id(self):
+        """
+        The ``Message-Id`` given in ``extra_headers`` or derived from the
+        ``idempotency_key``, else ``None``.
+
+        A derived id only depends on the key and the domain of the sender,
+        so a message created again for the same purpose, e.g. when a
+        transaction is retried, gets the same id and a queue with
+        ``mail.queue_dedup_ttl`` set only sends it once.
+
+        :versionadded: 0.16
+        """
+        for name, value in dict(self.extra_headers).items():
+            if name.lower() == 'message-id':
+                return value
+        if self.idempotency_key is None:
+            return None
+        digest = hashlib.sha256(
+            self.idempotency_key.encode('utf-8')).hexdigest()[:32]
+        domain = (self.sender or '').rpartition('@')[2].rstrip('>')
+        return '<%s@%s>' % (digest, domain or 'pyramid_mailer')
+
+    def personalize(self, recipient, **overrides):
+        """
+        Returns a copy of this message sent to ``recipient``, for sending
+        the same message to many recipients one at a time.
+
+        The keyword arguments replace the corresponding arguments of the
+        constructor, e.g. ``body`` for a personal greeting.  Everything
+        else is shared with this message: the body, html and attachment
+        parts which are not replaced are rendered and encoded once, by
+        this message, and reused by all of its personalized copies as long
+        as they are unchanged.
+
+        An ``idempotency_key`` is extended by the recipient, so every copy
+        gets its own ``Message-Id``.
+
+        :param recipient: email address of the recipient
+        :param overrides: constructor arguments to replace
+
+        :versionadded: 0.16
+        """
+        values = dict(
+            subject=self.subject,
+            body=self.body,
+            html=self.html,
+            sender=self.sender,
+            cc=list(self.cc or ()),
+            bcc=list(self.bcc or ()),
+            extra_headers=dict(self.extra_headers),
+            attachments=list(self.attachments),
+            idempotency_key=None,
+            )
+        if self.idempotency_key is not None:
+            values['idempotency_key'] = '%s\n%s' % (
+                self.idempotency_key, recipient)
+        unknown = set(overrides) - set(values)
+        if unknown:
+            raise TypeError(
+                'personalize() got unexpected keyword arguments %s' %
+                ', '.join(sorted(unknown)))
+        values.update(overrides)
+        message = self.__class__(recipients=[recipient], **values)
+        message._template = self
+        return message
+
     def to_message(self):
         """
         Returns raw email.Message instance.  Validates message first.
+
+        The message is only rendered again if it has changed since the last
+        call; a copy of the cached result is returned, so it may be
+        modified freely.
         """
+        return copy.deepcopy(self._render())
 
+    def as_string(self):
+        """
+        Returns the rendered message as a string, cached like
+        :meth:`to_message`.
+
+        :versionadded: 0.16
+        """
+        cache = self._cache()
+        if 'string' not in cache:
+            cache['string'] = self._render().as_string()
+        return cache['string']
+
+    def to_bytes(self, fp=None, headers=()):
+        """
+        Returns the message as bytes with CRLF line endings, ready to be
+        sent.  Validates message first.
+
+        The MIME parts are written straight to bytes, without building
+        ``email.message.Message`` objects and flattening them with
+        ``email.generator``; headers are encoded as
+        ``repoze.sendmail.encoding.encode_message`` does.  The result is
+        cached like :meth:`to_message`, unless the message has streamed
+        attachments (see :meth:`iter_bytes`).
+
+        :param fp: a binary file object the message is written to instead
+               of being returned
+        :param headers: a sequence of ``(name, value)`` pairs added to the
+               message headers as they are, e.g. ``Message-Id``; values
+               may also be ``email.header.Header`` instances
+
+        :versionadded: 0.16
+        """
+        if fp is None:
+            return b''.join(self.iter_bytes(headers))
+        self.write_to(fp, headers)
+
+    def iter_bytes(self, headers=()):
+        """
+        Generates the message as :meth:`to_bytes` does, in chunks.
+
+        Attachments whose data is a seekable file object are read and
+        base64-encoded a chunk at a time while the message is generated,
+        instead of being loaded into memory; they are read again every
+        time the message is written, unless their encoded data fits in
+        :data:`encoded_part_cache`, which then keeps it.
+
+        :param headers: see :meth:`to_bytes`
+
+        :versionadded: 0.16
+        """
+        if self._has_streams():
+            head, chunks = serialize(self._build_mailbase({}))
+        else:
+            cache = self._cache()
+            if 'bytes' not in cache:
+                cache['bytes'] = serialize(self._build_mailbase())
+            head, chunks = cache['bytes']
+        # added as they are, like headers added to an email.message.Message
+        # after repoze.sendmail.encoding.cleanup_message
+        head += ''.join(
+            '%s: %s\r\n' % (name, value if isinstance(value, str) else
+                             value.encode(linesep='\r\n', maxlinelen=0))
+            for name, value in headers
+            ).encode('ascii')
+        yield head + b'\r\n'
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                yield chunk
+            else:
+                for data in chunk:
+                    yield data
+
+    def write_to(self, fp, headers=()):
+        """
+        Writes the message to the binary file object ``fp``, see
+        :meth:`iter_bytes`.
+
+        :versionadded: 0.16
+        """
+        for chunk in self.iter_bytes(headers):
+            fp.write(chunk)
+
+    def _has_streams(self):
+        parts = [self.body, self.html] + list(self.attachments)
+        return any(isinstance(part, Attachment) and part._can_stream()
+                   for part in parts)
+
+    def _render_key(self):
+        # cheap to compute compared to rendering; lists and headers are
+        # compared by value to catch in-place edits
+        return (
+            self._version,
+            tuple(self.recipients),
+            tuple(self.cc or ()),
+            tuple(self.bcc or ()),
+            tuple(dict(self.extra_headers).items()),
+            self.idempotency_key,
+            tuple(getattr(part, '_version', None)
+                  for part in [self.body, self.html] + list(self.attachments)),
+            )
+
+    def _cache(self):
+        # renderings of the current state of the message
+        key = self._render_key()
+        if self._cached is None or key != self._cache_key:
+            self._cached = {}
+            self._cache_key = key
+        return self._cached
+
+    def _render(self):
+        cache = self._cache()
+        if 'message' not in cache:
+            cache['message'] = self._build_message()
+        return cache['message']
+
+    def _build_message(self):
+        return to_message(self._build_mailbase())
+
+    def _part_mailbase(self, val, content_type=None, streams=None):
+        if streams is not None and isinstance(val, Attachment) and (
+                val._can_stream()):
+            return val.to_mailbase(content_type, streams)
+        template = self._template
+        if template is not None and template._has_part(val):
+            return template._shared_mailbase(val, content_type)
+        return self._render_part(val, content_type)
+
+    def _render_part(self, val, content_type=None):
+        if isinstance(val, Attachment):
+            return val.to_mailbase(content_type)
+        # presumed to be a textual val
+        attachment = Attachment(
+            data=val,
+            content_type=content_type,
+            transfer_encoding='quoted-printable',
+            disposition='inline'
+            )
+        return attachment.to_mailbase(content_type)
+
+    def _has_part(self, val):
+        parts = [self.body, self.html] + list(self.attachments)
+        return any(val is part for part in parts)
+
+    def _shared_mailbase(self, val, content_type):
+        # the rendered parts of a template message; its personalized
+        # copies never modify them, so the encoded bodies remembered by
+        # the MailBase instances are reused
+        if self._shared is None:
+            self._shared = {}
+        shared = self._shared
+        key = (id(val), content_type)
+        version = getattr(val, '_version', None)
+        entry = shared.get(key)
+        if entry is None or entry[0] is not val or entry[1] != version:
+            entry = (val, version, self._render_part(val, content_type))
+            for stale in [k for k, e in list(shared.items())
+                          if not self._has_part(e[0])]:
+                shared.pop(stale, None)
+            shared[key] = entry
+        return entry[2]
+
+    def _build_mailbase(self, streams=None):
         self.validate()
 
         bodies = [(self.body, 'text/plain'), (self.html, 'text/html')]
@@ -200,17 +643,8 @@ class Message(object):
         for idx, (val, content_type) in enumerate(bodies):
             if val is None:
                 bodies[idx] = None
-            elif isinstance(val, Attachment):
-                bodies[idx] = val.to_mailbase(content_type)
             else:
-                # presumed to be a textual val
-                attachment = Attachment(
-                    data=val,
-                    content_type=content_type,
-                    transfer_encoding='quoted-printable',
-                    disposition='inline'
-                    )
-                bodies[idx] = attachment.to_mailbase(content_type)
+                bodies[idx] = self._part_mailbase(val, content_type, streams)
 
         body, html = bodies
 
@@ -248,6 +682,9 @@ class Message(object):
         if self.extra_headers:
             base.update(dict(self.extra_headers))
 
+        if self.idempotency_key is not None and 'Message-Id' not in base:
+            base['Message-Id'] = self.message_id
+
         if self.attachments:
             base.set_content_type('multipart/mixed')
             altpart = MailBase()
@@ -267,10 +704,11 @@ class Message(object):
             altpart.merge_part(html)
 
         for attachment in self.attachments:
-            attachment_mailbase = attachment.to_mailbase()
+            attachment_mailbase = self._part_mailbase(
+                attachment, streams=streams)
             base.attach_part(attachment_mailbase)
 
-        return to_message(base)
+        return base
 
     def is_bad_headers(self):
         """
@@ -312,6 +750,7 @@ class Message(object):
         """
 
         self.recipients.append(recipient)
+        self._changed()
 
     def add_cc(self, recipient):
         """
@@ -321,6 +760,7 @@ class Message(object):
         """
 
         self.cc.append(recipient)
+        self._changed()
 
     def add_bcc(self, recipient):
         """
@@ -330,6 +770,7 @@ class Message(object):
         """
 
         self.bcc.append(recipient)
+        self._changed()
 
     def attach(self, attachment):
         """
@@ -339,6 +780,7 @@ class Message(object):
         """
 
         self.attachments.append(attachment)
+        self._changed()
 
 
 class MailBase(object):
@@ -350,6 +792,7 @@ class MailBase(object):
         self.headers = dict(items)
         self.parts = []
         self.body = None
+        self.encoded = {}
         self.content_encoding = {'Content-Type': (None, {}),
                                  'Content-Disposition': (None, {}),
                                  'Content-Transfer-Encoding': None}
@@ -378,6 +821,7 @@ class MailBase(object):
 
     def set_body(self, body):
         self.body = body
+        self.encoded = {}
 
     def get_body(self):
         return self.body
@@ -417,6 +861,7 @@ class MailBase(object):
     def merge_part(self, part):
         body = part.get_body()
         self.set_body(body)
+        self.encoded = part.encoded
         self.content_encoding.update(part.content_encoding)
         self.headers.update(part.headers)
         self.parts = part.parts[:]
@@ -464,10 +909,7 @@ def to_message(base):
                     charset = 'utf-8'
             body = body.encode(charset, 'surrogateescape')
         if body is not None:
-            if ctenc:
-                body = transfer_encode(ctenc, body)
-
-            body = body.decode(charset or 'ascii', 'replace')
+            body = _encode_body(base, ctenc, charset, body)
         out.set_payload(body, charset)
 
     for k in base.keys(): # returned sorted
@@ -497,6 +939,247 @@ def to_message(base):
 
     return out
 
+def _encode_body(base, ctenc, flavor, body):
+    # remembered by the MailBase, which personalized messages share with
+    # their template; ``flavor`` is ``bytes`` or the charset of the text
+    key = (ctenc, flavor)
+    encoded = base.encoded.get(key)
+    if encoded is None:
+        if flavor is bytes:
+            encoded = encoded_part_cache.encode_bytes(ctenc, body)
+        else:
+            encoded = encoded_part_cache.encode(ctenc, flavor, body)
+        base.encoded[key] = encoded
+    return encoded
+
+def serialize(base):
+    """
+    Given a MailBase, returns the encoded headers of the outermost part and
+    a list of the chunks of bytes making up the rest of the message, with
+    CRLF line endings.  Chunks which are not bytes are iterables of bytes
+    to be streamed.
+
+    The output is equivalent to flattening ``to_message(base)`` after
+    ``repoze.sendmail.encoding.cleanup_message``, but only the outermost
+    part has a ``MIME-Version`` header.
+    """
+    head, chunks = _serialize_part(base)
+    return head, chunks
+
+def _serialize_part(base, top=True):
+    ctype, ctparams = base.get_content_type()
+
+    if not ctype:
+        if base.parts:
+            ctype = 'multipart/mixed'
+        else:
+            ctype = 'text/plain'
+
+    maintype, subtype = ctype.split('/')
+    is_text = maintype == 'text'
+    is_multipart = maintype == 'multipart'
+
+    if base.parts and not is_multipart:
+        raise RuntimeError(
+            'Content type should be multipart, not %r' % ctype
+            )
+
+    params = dict(ctparams)
+    ctenc = None
+    chunks = []
+
+    if is_multipart:
+        boundary = params.get('boundary')
+        if not boundary:
+            # random enough never to occur in the parts
+            boundary = params['boundary'] = '=' * 15 + uuid.uuid4().hex + '=='
+        delimiter = ('--%s' % boundary).encode('ascii')
+        for part in base.parts:
+            head, body = _serialize_part(part, top=False)
+            chunks.append(delimiter + b'\r\n' + head + b'\r\n')
+            chunks.extend(body)
+            chunks.append(b'\r\n')
+        chunks.append(delimiter + b'--\r\n')
+    else:
+        body = base.get_body()
+        ctenc = base.get_transfer_encoding()
+        charset = ctparams.get('charset')
+        if isinstance(body, _Placeholder):
+            chunks.append(body.stream)
+        else:
+            if isinstance(body, str):
+                if not charset:
+                    if is_text:
+                        charset, _ = best_charset(body)
+                    else:
+                        charset = 'utf-8'
+                body = body.encode(charset, 'surrogateescape')
+            if body is not None:
+                chunks.append(_encode_body(base, ctenc, bytes, body))
+        if charset:
+            params['charset'] = Charset(charset).get_output_charset()
+
+    lines = ['Content-Type: %s\r\n' % format_params(ctype, params)]
+    if top:
+        lines.append('MIME-Version: 1.0\r\n')
+    if ctenc:
+        lines.append('Content-Transfer-Encoding: %s\r\n' % ctenc)
+
+    for k in base.keys(): # returned sorted
+        value = base[k]
+        if not value:
+            continue
+        lines.append(format_header(k, value))
+
+    cdisp, cdisp_params = base.get_content_disposition()
+
+    if cdisp:
+        lines.append(
+            'Content-Disposition: %s\r\n' % format_params(cdisp, cdisp_params))
+
+    return ''.join(lines).encode('ascii'), chunks
+
+def format_header(name, value):
+    """
+    Formats a header line, encoding non-ascii text according to RFC 2047;
+    only the display names of addresses are encoded.
+    """
+    if isinstance(value, str):
+        if name.lower() in ADDR_HEADERS:
+            value = ', '.join(
+                formataddr((
+                    Header(display, charset=best_charset(display)[0],
+                           header_name=name).encode(),
+                    addr))
+                for display, addr in getaddresses([value]))
+        value = Header(value, charset=best_charset(value)[0],
+                       header_name=name)
+    return '%s: %s\r\n' % (name, value.encode(linesep='\r\n'))
+
+def format_params(value, params):
+    """
+    Formats a parameterized header value such as a ``Content-Type``,
+    encoding non-ascii parameters according to RFC 2231.
+    """
+    parts = [value]
+    for name, param in params.items():
+        charset = best_charset(param)[0]
+        if charset == 'us-ascii':
+            parts.append('%s="%s"' % (name, quote(param)))
+        else:
+            parts.append('%s*=%s' % (name, encode_rfc2231(param, charset)))
+    return '; '.join(parts)
+
+def encode_payload(ctenc, charset, body):
+    """
+    Transfer-encodes the bytes ``body`` and decodes the result to text.
+    """
+    if ctenc:
+        body = transfer_encode(ctenc, body)
+    return body.decode(charset or 'ascii', 'replace')
+
+_NLCRE = re.compile(b'\r\n|\r|\n')
+
+def encode_payload_bytes(ctenc, body):
+    """
+    Transfer-encodes the bytes ``body``, with CRLF line endings.
+    """
+    if ctenc:
+        body = transfer_encode(ctenc, body)
+    return _NLCRE.sub(b'\r\n', body)
+
+class EncodedPartCache(object):
+    """
+    A thread-safe, size-bounded LRU cache of encoded MIME part payloads.
+
+    Parts are keyed by a hash of their content together with the transfer
+    encoding and charset, so the same file attached to many messages is
+    only encoded once.  Streamed attachments (see
+    :meth:`Message.iter_bytes`) are keyed by the version of their file,
+    so the file need not be read to find them.  Payloads smaller than
+    ``min_size`` bytes are not cached; the least recently used payloads
+    are evicted once more than ``max_size`` bytes are held.
+
+    ``hits`` and ``misses`` count the lookups of cacheable payloads.
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, min_size=4096):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def encode(self, ctenc, charset, body):
+        """
+        Returns ``encode_payload(ctenc, charset, body)``, from the cache if
+        possible.
+        """
+        return self._lookup(
+            (ctenc or '').lower(), charset, body, encode_payload)
+
+    def encode_bytes(self, ctenc, body):
+        """
+        Returns ``encode_payload_bytes(ctenc, body)``, from the cache if
+        possible.
+        """
+        return self._lookup(
+            (ctenc or '').lower(), bytes, body,
+            lambda ctenc, flavor, body: encode_payload_bytes(ctenc, body))
+
+    def encode_stream(self, key, size, encode):
+        """
+        Returns ``encode()``, the base64-encoded data of a streamed
+        attachment of ``size`` bytes identified by the tuple ``key``, from
+        the cache if possible.  Returns ``None`` if data of that size is
+        not cached.
+        """
+        if size < self.min_size or size > self.max_size:
+            return None
+        return self._get(('stream',) + key, encode)
+
+    def _lookup(self, ctenc, flavor, body, encode):
+        if len(body) < self.min_size or len(body) > self.max_size:
+            return encode(ctenc, flavor, body)
+        key = (hashlib.sha1(body).digest(), len(body), ctenc, flavor)
+        return self._get(key, lambda: encode(ctenc, flavor, body))
+
+    def _get(self, key, encode):
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        encoded = encode()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = encoded
+                self.size += len(encoded)
+                while self.size > self.max_size:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+        return encoded
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = 0
+
+# the process-wide cache used when rendering messages
+encoded_part_cache = EncodedPartCache()
+
 def normalize_header(header):
     return string.capwords(header.lower(), '-')
 
@@ -512,9 +1195,9 @@ def transfer_encode(encoding, payload):
             str(payload, 'ascii')
         except UnicodeDecodeError:
             raise RuntimeError('Payload contains an octet that is not 7bit safe')
-        return payload
+        return bytes(payload)
     elif encoding == '8bit':
-        return payload
+        return bytes(payload)
     else:
         raise RuntimeError('Unknown transfer encoding %s' % encoding)
 
@@ -524,8 +1207,8 @@ def best_charset(text):
 
     Prefers `us-ascii` or `iso-8859-1` and falls back to `utf-8`.
     """
-    if isinstance(text, bytes):
-        text = text.decode('ascii')
+    if isinstance(text, (bytes, mmap.mmap)):
+        text = bytes(text).decode('ascii')
     for charset in 'us-ascii', 'iso-8859-1', 'utf-8':
         try:
             encoded = text.encode(charset)
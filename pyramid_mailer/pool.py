@@ -0,0 +1,547 @@
+import smtplib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from email.message import Message
+
+from repoze.sendmail.encoding import encode_message
+
+from pyramid_mailer._compat import EHLO_Error
+from pyramid_mailer._compat import ESMTP_NotSupported
+from pyramid_mailer._compat import HAVE_SSL
+from pyramid_mailer._compat import TLS_NotAvailable
+
+# the errors of a connection which cannot be opened, see smtp_connect
+_CONNECT_ERRORS = (smtplib.SMTPException, socket.error, EHLO_Error,
+                   ESMTP_NotSupported, TLS_NotAvailable)
+
+
+def smtp_connect(mailer):
+    """Open an authenticated connection using the configuration of ``mailer``.
+
+    ``mailer`` is a :class:`repoze.sendmail.mailer.SMTPMailer` (or
+    :class:`pyramid_mailer.mailer.SMTP_SSLMailer`); the EHLO, STARTTLS
+    and AUTH steps mirror the ones it performs for every message it
+    sends.
+    """
+    connection = mailer.smtp_factory()
+
+    code, response = connection.ehlo()
+    if code < 200 or code >= 300:
+        code, response = connection.helo()
+        if code < 200 or code >= 300:
+            connection.close()
+            raise EHLO_Error(code, response)
+
+    have_tls = connection.has_extn('starttls')
+    if not have_tls and mailer.force_tls:
+        connection.close()
+        raise TLS_NotAvailable()
+
+    if have_tls and HAVE_SSL and not mailer.no_tls:
+        connection.starttls()
+        connection.ehlo()
+
+    if connection.does_esmtp:
+        if mailer.username is not None and mailer.password is not None:
+            connection.login(mailer.username, mailer.password)
+    elif mailer.username:
+        connection.close()
+        raise ESMTP_NotSupported()
+
+    return connection
+
+
+def smtp_disconnect(connection):
+    """Politely close ``connection``, ignoring a server that is already gone.
+    """
+    try:
+        connection.quit()
+    except Exception:
+        connection.close()
+
+
+def _rset(connection):
+    try:
+        connection.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def _pipeline_envelope(connection, fromaddr, toaddrs, options):
+    commands = ['mail FROM:%s%s\r\n' % (smtplib.quoteaddr(fromaddr), options)]
+    commands.extend(
+        'rcpt TO:%s\r\n' % smtplib.quoteaddr(addr) for addr in toaddrs)
+    connection.send(''.join(commands))
+
+    code, response = connection.getreply()
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            # the server still answers every pipelined RCPT command
+            for addr in toaddrs:
+                connection.getreply()
+            _rset(connection)
+        raise smtplib.SMTPSenderRefused(code, response, fromaddr)
+
+    refused = {}
+    for addr in toaddrs:
+        code, response = connection.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, response)
+        if code == 421:
+            connection.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+
+def _send_envelope(connection, fromaddr, toaddrs):
+    # the envelope part of ``smtplib.SMTP.sendmail``, one round trip per
+    # command
+    connection.ehlo_or_helo_if_needed()
+    code, response = connection.mail(fromaddr)
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            _rset(connection)
+        raise smtplib.SMTPSenderRefused(code, response, fromaddr)
+    refused = {}
+    for addr in toaddrs:
+        code, response = connection.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, response)
+        if code == 421:
+            connection.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+
+def smtp_data_stream(connection, chunks):
+    """Send the message ``chunks`` (bytes with CRLF line endings) as the
+    ``DATA`` of the current mail transaction, one chunk at a time.
+
+    Lines starting with a dot are escaped as ``smtplib.SMTP.data`` does.
+    Returns the server's reply.
+    """
+    connection.putcmd('data')
+    code, response = connection.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    at_line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk.replace(b'\n.', b'\n..')
+        if at_line_start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+        connection.send(chunk)
+        at_line_start = chunk.endswith(b'\n')
+    if at_line_start:
+        connection.send(b'.\r\n')
+    else:
+        connection.send(b'\r\n.\r\n')
+    return connection.getreply()
+
+
+def smtp_sendmail(connection, fromaddr, toaddrs, message):
+    """Send ``message`` like ``connection.sendmail`` does.
+
+    If the server advertises the PIPELINING extension (RFC 2920), the
+    ``MAIL FROM`` and all ``RCPT TO`` commands are written at once and
+    their responses read afterwards, instead of waiting for a round trip
+    per recipient.
+
+    ``message`` may also be an iterable of bytes chunks, such as
+    :meth:`pyramid_mailer.message.Message.iter_bytes` returns, which is
+    written to the connection as it is generated.
+
+    Returns a dictionary of the refused recipients; raises
+    ``smtplib.SMTPRecipientsRefused`` if all of them were refused.
+    """
+    streamed = not isinstance(message, (bytes, str))
+    pipelining = connection.has_extn('pipelining')
+    if not (pipelining or streamed):
+        return connection.sendmail(fromaddr, toaddrs, message)
+
+    if isinstance(message, str):
+        message = smtplib._fix_eols(message).encode('ascii')
+    if isinstance(toaddrs, str):
+        toaddrs = [toaddrs]
+    if pipelining:
+        options = ''
+        if not streamed and connection.has_extn('size'):
+            options = ' size=%d' % len(message)
+        refused = _pipeline_envelope(connection, fromaddr, toaddrs, options)
+    else:
+        refused = _send_envelope(connection, fromaddr, toaddrs)
+    if len(refused) == len(toaddrs):
+        _rset(connection)
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    if streamed:
+        code, response = smtp_data_stream(connection, message)
+    else:
+        code, response = connection.data(message)
+    if code != 250:
+        if code == 421:
+            connection.close()
+        else:
+            _rset(connection)
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _encode(message):
+    if isinstance(message, Message):
+        return encode_message(message)
+    if hasattr(message, 'iter_bytes'):
+        return message.iter_bytes()
+    return message
+
+
+def _keeps_connection(exc, connection):
+    # the server answered, so the session itself is still usable; the
+    # transaction state is cleared with RSET before the next reuse.  A
+    # connection closed on a 421 reply, e.g. to one of several RCPT
+    # commands, is not.
+    if connection.sock is None:
+        return False
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code != 421
+    return isinstance(exc, smtplib.SMTPRecipientsRefused)
+
+
+class SMTPConnectionPool(object):
+    """Keeps authenticated SMTP connections open between sends.
+
+    The pool wraps a :class:`repoze.sendmail.mailer.SMTPMailer` and
+    provides the same ``send`` method, so it can be used anywhere a
+    mailer is expected.  Instead of connecting, authenticating and
+    quitting for every message, connections are returned to the pool
+    after use and handed out again later.
+
+    Before an idle connection is reused it is checked with ``RSET``; a
+    connection which fails this check, has been idle for longer than
+    ``idle_timeout`` seconds or raised a connection-level error while in
+    use is closed and discarded.
+
+    :param mailer: the SMTP mailer providing the server configuration
+    :param size: the maximum number of idle connections kept open. More
+           connections may be in use at the same time; those are closed
+           when returned to a full pool.
+    :param idle_timeout: seconds after which an idle connection is closed
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, mailer, size=5, idle_timeout=60):
+        self.mailer = mailer
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _is_alive(self, connection):
+        try:
+            code, response = connection.rset()
+        except (smtplib.SMTPException, socket.error):
+            return False
+        return code == 250
+
+    def acquire(self):
+        """Return a connection, reusing an idle one if possible."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                last_used, connection = self._idle.pop()
+            expired = time.time() - last_used > self.idle_timeout
+            if not expired and self._is_alive(connection):
+                return connection
+            smtp_disconnect(connection)
+        return smtp_connect(self.mailer)
+
+    def release(self, connection, discard=False):
+        """Return ``connection`` to the pool.
+
+        If ``discard`` is true, or the pool is already full, the
+        connection is closed instead.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [
+                item for item in self._idle
+                if now - item[0] > self.idle_timeout
+            ]
+            for item in expired:
+                self._idle.remove(item)
+            if not discard and len(self._idle) < self.size:
+                self._idle.append((now, connection))
+                connection = None
+        for last_used, stale in expired:
+            smtp_disconnect(stale)
+        if connection is not None:
+            smtp_disconnect(connection)
+
+    @contextmanager
+    def connection(self):
+        """Context manager checking a connection out of the pool.
+
+        The connection is returned to the pool on exit, unless an error
+        indicates that the session can no longer be trusted.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+        except Exception as exc:
+            self.release(
+                connection, discard=not _keeps_connection(exc, connection))
+            raise
+        self.release(connection)
+
+    def send(self, fromaddr, toaddrs, message):
+        """Send a message over a pooled connection.
+
+        :param fromaddr: the envelope sender
+        :param toaddrs: the envelope recipients
+        :param message: an ``email.message.Message`` instance, the
+               already encoded message bytes or a
+               :class:`pyramid_mailer.message.Message`, which is streamed
+               to the server
+
+        Returns a dictionary of the refused recipients, as
+        ``smtplib.SMTP.sendmail`` does.  Commands are pipelined if the
+        server supports it, see :func:`smtp_sendmail`.
+        """
+        with self.connection() as connection:
+            return smtp_sendmail(
+                connection, fromaddr, toaddrs, _encode(message))
+
+    def send_many(self, envelopes):
+        """Send several messages over a single connection.
+
+        :param envelopes: a sequence of ``(fromaddr, toaddrs, message)``
+               tuples, as accepted by :meth:`send`
+
+        Returns a list with one entry per envelope: either the dictionary
+        of refused recipients or the SMTP or socket error which prevented
+        the message from being delivered.  A broken connection is replaced
+        for the remaining messages; if no connection can be established
+        the error is reported for every message not yet sent.
+        """
+        envelopes = list(envelopes)
+        results = []
+        connection = None
+        try:
+            for fromaddr, toaddrs, message in envelopes:
+                if connection is None:
+                    try:
+                        connection = self.acquire()
+                    except _CONNECT_ERRORS as exc:
+                        results.extend(
+                            [exc] * (len(envelopes) - len(results)))
+                        break
+                try:
+                    result = smtp_sendmail(
+                        connection, fromaddr, toaddrs, _encode(message))
+                except (smtplib.SMTPException, socket.error) as exc:
+                    if not _keeps_connection(exc, connection):
+                        self.release(connection, discard=True)
+                        connection = None
+                    result = exc
+                results.append(result)
+        except Exception:
+            if connection is not None:
+                self.release(connection, discard=True)
+            raise
+        if connection is not None:
+            self.release(connection)
+        return results
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for last_used, connection in idle:
+            smtp_disconnect(connection)
+
+
+def _can_resend(message):
+    # messages which can be encoded again; an iterator of chunks can only
+    # be sent once
+    return isinstance(message, (bytes, str, Message)) or hasattr(
+        message, 'iter_bytes')
+
+
+class _Host(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.outstanding = 0
+        self.failures = 0
+        self.down_since = None
+
+
+class MultiHostPool(SMTPConnectionPool):
+    """Spreads SMTP connections over several mail servers, failing over
+    between them.
+
+    Every host has its own :class:`SMTPConnectionPool`.  New connections
+    go to the healthy hosts in turns (``round_robin``) or to the one with
+    the fewest connections in use (``least_outstanding``).  A host which
+    refuses connections, or whose connections break, ``max_failures``
+    times in a row is marked unhealthy and only tried again after
+    ``retry_after`` seconds, or when no healthy host is left; a
+    successful send marks it healthy again.
+
+    A connection which cannot be opened is retried with the next host.
+    :meth:`send` also resends a message through the next host if the
+    connection broke before the server accepted it, so a dead host costs
+    a failed connection attempt rather than a failed send.  Messages given
+    as iterators of chunks are not resent.  :meth:`send_many` sends the
+    messages after a broken connection through the next host.
+
+    :param mailers: one :class:`repoze.sendmail.mailer.SMTPMailer` per
+           host
+    :param size: the number of idle connections kept open per host
+    :param idle_timeout: seconds after which an idle connection is closed
+    :param strategy: ``round_robin`` or ``least_outstanding``
+    :param max_failures: the number of failures in a row after which a
+           host is considered unhealthy
+    :param retry_after: seconds an unhealthy host is skipped
+
+    :versionadded: 0.16
+    """
+
+    strategies = ('round_robin', 'least_outstanding')
+
+    def __init__(self, mailers, size=5, idle_timeout=60,
+                 strategy='round_robin', max_failures=3, retry_after=30):
+        if not mailers:
+            raise ValueError('no hosts to send mail through')
+        if strategy not in self.strategies:
+            raise ValueError('invalid strategy: %s' % strategy)
+        super(MultiHostPool, self).__init__(
+            mailers[0], size=size, idle_timeout=idle_timeout)
+        self.mailers = list(mailers)
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.hosts = [
+            _Host(SMTPConnectionPool(mailer, size, idle_timeout))
+            for mailer in self.mailers]
+        self._next = 0
+        # the host of every connection in use
+        self._in_use = {}
+
+    def _candidates(self, now):
+        # the hosts to try, in order: the healthy ones by strategy, then
+        # the unhealthy ones, longest down first
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.hosts)
+            hosts = self.hosts[start:] + self.hosts[:start]
+            if self.strategy == 'least_outstanding':
+                # sorting is stable, so ties keep their turns
+                hosts.sort(key=lambda host: host.outstanding)
+            healthy = [host for host in hosts if host.down_since is None or
+                       now - host.down_since >= self.retry_after]
+            down = sorted([host for host in hosts if host not in healthy],
+                          key=lambda host: host.down_since)
+        return healthy + down
+
+    def _failed(self, host):
+        with self._lock:
+            host.failures += 1
+            if host.failures >= self.max_failures:
+                host.down_since = time.time()
+
+    def _succeeded(self, host):
+        with self._lock:
+            host.failures = 0
+            host.down_since = None
+
+    def acquire(self, tried=None):
+        """Return a connection to one of the hosts, trying the next one if
+        a host cannot be reached.  The hosts tried are added to the set
+        ``tried``, and hosts already in it are skipped; the error of the
+        last host is raised if no connection could be opened.
+        """
+        if tried is None:
+            tried = set()
+        error = None
+        for host in self._candidates(time.time()):
+            if host in tried:
+                continue
+            tried.add(host)
+            try:
+                connection = host.pool.acquire()
+            except _CONNECT_ERRORS as exc:
+                self._failed(host)
+                error = exc
+                continue
+            with self._lock:
+                host.outstanding += 1
+                self._in_use[connection] = host
+            return connection
+        if error is None:
+            raise socket.error('all mail hosts have been tried')
+        raise error
+
+    def release(self, connection, discard=False):
+        """Return ``connection`` to the pool of its host.  A discarded
+        connection counts as a failure of the host.
+        """
+        with self._lock:
+            host = self._in_use.pop(connection)
+            host.outstanding -= 1
+        if discard:
+            self._failed(host)
+        else:
+            self._succeeded(host)
+        host.pool.release(connection, discard)
+
+    def send(self, fromaddr, toaddrs, message):
+        """Send a message through one of the hosts, see
+        :meth:`SMTPConnectionPool.send`.
+        """
+        tried = set()
+        while True:
+            connection = self.acquire(tried)
+            try:
+                refused = smtp_sendmail(
+                    connection, fromaddr, toaddrs, _encode(message))
+            except Exception as exc:
+                keep = _keeps_connection(exc, connection)
+                self.release(connection, discard=not keep)
+                if (keep or len(tried) == len(self.hosts) or
+                        not _can_resend(message) or
+                        not isinstance(
+                            exc, (smtplib.SMTPException, socket.error))):
+                    raise
+                continue
+            self.release(connection)
+            return refused
+
+    def status(self):
+        """Returns the state of every host, a list of dictionaries with
+        its ``hostname``, ``port``, whether it is ``healthy``, its
+        ``failures`` in a row and its connections in use
+        (``outstanding``).
+        """
+        with self._lock:
+            return [
+                {'hostname': host.pool.mailer.hostname,
+                 'port': host.pool.mailer.port,
+                 'healthy': host.down_since is None,
+                 'failures': host.failures,
+                 'outstanding': host.outstanding}
+                for host in self.hosts]
+
+    def close(self):
+        """Close the idle connections of all hosts."""
+        for host in self.hosts:
+            host.pool.close()
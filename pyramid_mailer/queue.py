@@ -0,0 +1,1733 @@
+import argparse
+from contextlib import contextmanager
+from email.header import Header
+from email.header import decode_header
+from email.header import make_header
+import gzip
+import hashlib
+import io
+from itertools import chain
+from itertools import groupby
+from itertools import islice
+import logging
+import lzma
+import math
+from operator import itemgetter
+import os
+import random
+import re
+import shutil
+import smtplib
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from repoze.sendmail.maildir import Maildir
+
+from pyramid_mailer._compat import EHLO_Error
+from pyramid_mailer._compat import ESMTP_NotSupported
+from pyramid_mailer._compat import TLS_NotAvailable
+
+log = logging.getLogger(__name__)
+
+# claims older than this are assumed to belong to a crashed processor
+MAX_SEND_TIME = 60 * 60 * 3
+
+_CLAIMED = '.sending-'
+DEAD = 'dead'
+DEFAULT_LANE = 'default'
+SCHEDULED = 'scheduled'
+# seconds of not_before times sharing a directory of scheduled messages
+_BUCKET = 60
+# the name of a queued file: the times it was scheduled for, its maildir
+# name and the number of failed attempts to send it
+_QUEUED_NAME = re.compile(r'^(?:\d+-)*(.*?)(?:\.retry(\d+))?$')
+_LANE_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+# the states messages are counted in, see QueueCounters
+QUEUE_STATES = ('queued', 'retrying', 'sending', 'dead')
+_NOTHING = object()
+# the state and queued minute of a row of SQLiteQueue, see QueueCounters;
+# {0} is the name of the row
+_COUNT_KEY = {
+    'state': "(CASE WHEN {0}.rejected THEN 'dead' "
+             "WHEN {0}.claimed IS NOT NULL THEN 'sending' "
+             "WHEN {0}.attempts > 0 THEN 'retrying' ELSE 'queued' END)",
+    'minute': 'CAST({0}.queued / 60 AS INTEGER)',
+}
+
+_NLCRE = re.compile(b'\r?\n')
+_HEADER_END = re.compile(b'\n\r?\n')
+# bytes decompressed at a time when reading queued messages
+_CHUNK = 64 * 1024
+# the number of row ids SQLiteQueue lists at once
+_PAGE = 500
+
+COMPRESSIONS = ('zlib', 'lzma')
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+
+
+def _crlf(data):
+    # data with CRLF line endings; mostly it has them already, and
+    # bytes.replace beats a regular expression over short base64 lines
+    if data.count(b'\n') != data.count(b'\r\n'):
+        data = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    return data
+
+
+def parse_queued(data):
+    """Split a queued message into its envelope and the message itself.
+
+    Returns ``(fromaddr, toaddrs, message)``: the envelope taken from the
+    ``X-Actually-From`` and ``X-Actually-To`` headers and the message
+    bytes without those headers, with CRLF line endings.
+    """
+    data = _crlf(data)
+    end = data.find(b'\r\n\r\n')
+    if end < 0:
+        end = len(data)
+    fields = []
+    for line in data[:end + 2].splitlines(True):
+        if fields and line[:1] in (b' ', b'\t'):
+            fields[-1] += line
+        else:
+            fields.append(line)
+    fromaddr = ''
+    toaddrs = ()
+    kept = []
+    for field in fields:
+        name, _, value = field.partition(b':')
+        name = name.strip().lower()
+        if name == b'x-actually-from':
+            fromaddr = _decode(value)
+        elif name == b'x-actually-to':
+            toaddrs = tuple(
+                addr.strip() for addr in _decode(value).split(','))
+        else:
+            kept.append(field)
+    return fromaddr, toaddrs, b''.join(kept) + data[end + 2:]
+
+
+def compressing(fp, compression):
+    """Wrap the binary file object ``fp`` to compress what is written to it.
+
+    ``compression`` is ``zlib``, which writes a deflate stream in the gzip
+    format, or ``lzma``, which writes the xz format.  Closing the returned
+    file writes the end of the stream but leaves ``fp`` open.
+    """
+    if compression == 'zlib':
+        return gzip.GzipFile(
+            filename='', mode='wb', compresslevel=6, fileobj=fp, mtime=0)
+    if compression == 'lzma':
+        return lzma.LZMAFile(fp, 'wb', preset=1)
+    raise ValueError('invalid compression: %s' % compression)
+
+
+def compress_queued(data, compression):
+    """Returns the bytes ``data`` compressed like :func:`compressing`
+    does.
+    """
+    buf = io.BytesIO()
+    with compressing(buf, compression) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def _compression(fp):
+    # the compression of the queued message in fp, recognized by the
+    # magic number of its stream; headers of plain messages are printable
+    magic = fp.read(len(_XZ_MAGIC))
+    fp.seek(0)
+    if magic.startswith(_GZIP_MAGIC):
+        return 'zlib'
+    if magic == _XZ_MAGIC:
+        return 'lzma'
+    return None
+
+
+def _decompressing(fp):
+    # the queued message in fp, decompressed as it is read
+    compression = _compression(fp)
+    if compression == 'zlib':
+        return gzip.GzipFile(fileobj=fp, mode='rb')
+    if compression == 'lzma':
+        return lzma.LZMAFile(fp)
+    return fp
+
+
+def _crlf_chunks(data, fp):
+    # data and the rest of fp a chunk at a time, with CRLF line endings;
+    # a CR at the end of a chunk may be followed by LF in the next
+    while True:
+        more = fp.read(_CHUNK)
+        if data.endswith(b'\r') and more:
+            data, more = data[:-1], b'\r' + more
+        if data:
+            yield _crlf(data)
+        if not more:
+            return
+        data = more
+
+
+def read_queued(fp, stream=False):
+    """Read a queued message from the binary file object ``fp``.
+
+    Returns ``(fromaddr, toaddrs, message)`` like :func:`parse_queued`.
+    Messages stored compressed (see :func:`compressing`) are recognized by
+    their magic number and decompressed as they are read.  Only the
+    headers are read up front if ``stream`` is true: ``message`` is then
+    an iterator of bytes chunks reading the rest of ``fp``, which
+    :class:`pyramid_mailer.pool.SMTPConnectionPool` sends as it goes.
+    """
+    fp = _decompressing(fp)
+    head = b''
+    while True:
+        match = _HEADER_END.search(head)
+        if match is not None:
+            break
+        more = fp.read(_CHUNK)
+        if not more:
+            break
+        head += more
+    end = match.end() if match is not None else len(head)
+    fromaddr, toaddrs, headers = parse_queued(head[:end])
+    chunks = _crlf_chunks(head[end:], fp)
+    if stream:
+        return fromaddr, toaddrs, chain([headers], chunks)
+    return fromaddr, toaddrs, headers + b''.join(chunks)
+
+
+def _closing(chunks, fp):
+    # the chunks read from fp, closing it once they have all been read
+    with fp:
+        for chunk in chunks:
+            yield chunk
+
+
+def shard_path(queue_path, index):
+    """Returns the path of the maildir of shard ``index`` of a sharded
+    queue.
+    """
+    return os.path.join(queue_path, '%02d' % index)
+
+
+def shard_index(key, shards):
+    """Returns the shard a message with the id ``key`` is queued in."""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def _decode(value):
+    value = _NLCRE.sub(b'', value).decode('ascii').strip()
+    return str(make_header(decode_header(value)))
+
+
+class _Group(object):
+
+    def __init__(self):
+        self.items = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    """Combines the commits of concurrent callers into one.
+
+    :meth:`submit` hands an item to ``flush`` and blocks until it has been
+    flushed.  Items submitted while an earlier flush is in progress, or
+    within ``max_latency`` seconds of the first item of a group, are
+    flushed together with a single call, so e.g. many threads queueing
+    messages share one ``fsync``.  A group is flushed early once it holds
+    ``max_size`` items.
+
+    :param flush: called with a list of items
+    :param max_latency: seconds the first caller of a group waits for
+           others to join it
+    :param max_size: the largest number of items flushed together
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, flush, max_latency=0.0, max_size=1000):
+        self.flush = flush
+        self.max_latency = max_latency
+        self.max_size = max_size
+        self.flushes = 0
+        self._group = None
+        self._joined = threading.Condition()
+        self._flushing = threading.Lock()
+
+    def submit(self, item):
+        """Flush ``item`` together with those of concurrent callers.
+
+        Raises the error of the flush, if any.
+        """
+        with self._joined:
+            group = self._group
+            leader = group is None
+            if leader:
+                group = self._group = _Group()
+            group.items.append(item)
+            if len(group.items) >= self.max_size:
+                self._group = None
+                self._joined.notify_all()
+        if leader:
+            self._lead(group)
+        else:
+            group.done.wait()
+        if group.error is not None:
+            raise group.error
+
+    def _lead(self, group):
+        deadline = time.time() + self.max_latency
+        with self._joined:
+            while self._group is group:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._joined.wait(remaining)
+        with self._flushing:
+            # callers keep joining while an earlier group is flushed
+            with self._joined:
+                if self._group is group:
+                    self._group = None
+            try:
+                self.flush(group.items)
+                self.flushes += 1
+            except Exception as exc:
+                group.error = exc
+            finally:
+                group.done.set()
+
+
+def sync_directories(paths):
+    """``fsync`` each of the directories ``paths`` once, making the files
+    renamed into them durable.  ``paths`` may also name files, which are
+    synced the same way, and an item of ``paths`` may be a tuple of
+    paths, as submitted to a :class:`GroupCommit` by
+    :class:`pyramid_mailer.delivery.StreamingQueuedMailDelivery` for all
+    messages of a transaction.
+    """
+    directories = set()
+    for path in paths:
+        if isinstance(path, tuple):
+            directories.update(path)
+        else:
+            directories.add(path)
+    for path in directories:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+
+def _claimed_name(path):
+    # the maildir name of the message claimed at path
+    return os.path.basename(path)[len(_CLAIMED):]
+
+
+def open_maildir(path):
+    """Returns the :class:`repoze.sendmail.maildir.Maildir` at ``path``,
+    creating it and any missing parent directories first.
+
+    Unlike ``Maildir(path, True)`` this also works when ``path`` already
+    exists without being a maildir, as the directory holding the priority
+    lanes of a queue does before its ``default`` lane is used.
+    """
+    for subdir in ('cur', 'new', 'tmp'):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    return Maildir(path)
+
+
+def scheduled_path(path, not_before, name):
+    """The path a message ``name`` of the maildir at ``path`` is kept at
+    until the timestamp ``not_before``.
+
+    Scheduled messages are kept in a directory per minute below the
+    ``scheduled`` directory of the maildir, and their names start with
+    their time, so :meth:`MaildirQueue.promote` only has to look at the
+    directories of the minutes that have passed.
+
+    :versionadded: 0.16
+    """
+    return os.path.join(
+        path, SCHEDULED, '%d' % (not_before // _BUCKET),
+        '%d-%s' % (math.ceil(not_before), name))
+
+
+def lane_path(queue_path, lane):
+    """The path of the maildir (or directory of shards) of the priority
+    lane ``lane`` of the queue at ``queue_path``.
+
+    The ``default`` lane is ``queue_path`` itself; other lanes are kept in
+    subfolders named after them, ``.urgent`` for ``urgent``, like the
+    folders of a Maildir++.
+
+    :versionadded: 0.16
+    """
+    if lane == DEFAULT_LANE:
+        return queue_path
+    if not _LANE_NAME.match(lane):
+        raise ValueError('invalid queue lane: %r' % (lane,))
+    return os.path.join(queue_path, '.' + lane)
+
+
+class DedupIndex(object):
+    """An index of the ``Message-Id`` of recently queued messages, used
+    to drop duplicates.
+
+    Every id is recorded as an empty file named after its hash, in a
+    directory per quarter of ``ttl`` seconds below ``path``.  Looking an id
+    up takes a few ``stat`` calls whatever the size of the queue or the
+    index, the file is created exclusively so two processes cannot both
+    record the same id, and expired directories are removed as a whole
+    when a new one is started.  An id is forgotten between ``ttl`` and
+    ``1.25 * ttl`` seconds after it was recorded.
+
+    :param path: the directory of the index, created if it does not exist
+    :param ttl: the number of seconds an id is remembered
+
+    :versionadded: 0.16
+    """
+
+    slots = 4
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.width = ttl / self.slots
+        os.makedirs(path, exist_ok=True)
+
+    def _paths(self, messageid, now):
+        name = hashlib.sha1(messageid.encode('utf-8')).hexdigest()
+        current = int(now // self.width)
+        return [os.path.join(self.path, '%d' % slot, name)
+                for slot in range(current, current - self.slots - 1, -1)]
+
+    def __contains__(self, messageid):
+        paths = self._paths(messageid, time.time())
+        return any(os.path.exists(path) for path in paths)
+
+    def add(self, messageid):
+        """Record ``messageid``.  Returns ``False`` if it has been recorded
+        before, i.e. the message is a duplicate.
+        """
+        paths = self._paths(messageid, time.time())
+        if any(os.path.exists(path) for path in paths[1:]):
+            return False
+        directory = os.path.dirname(paths[0])
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            self.expire()
+        try:
+            os.close(os.open(paths[0], os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def expire(self):
+        """Remove the directories of ids older than ``ttl``."""
+        oldest = int(time.time() // self.width) - self.slots
+        for slot in os.listdir(self.path):
+            if slot.isdigit() and int(slot) < oldest:
+                shutil.rmtree(os.path.join(self.path, slot),
+                              ignore_errors=True)
+
+
+class MaildirQueue(object):
+    """The maildir queue filled by :meth:`Mailer.send_to_queue
+    <pyramid_mailer.mailer.Mailer.send_to_queue>`.
+
+    Messages are claimed for delivery by renaming them from the ``new``
+    directory to a hidden file in ``cur``.  Only one rename can succeed,
+    so any number of threads and processes may take messages from the
+    same queue without sending one twice.  Claims left behind by a crashed
+    processor are given up after ``max_send_time`` seconds.
+
+    Messages queued with a ``not_before`` time wait in the ``scheduled``
+    directory until :meth:`promote` moves them to ``new``, as do messages
+    to be retried; the number of failed attempts is kept in the file
+    name.  Messages which cannot be sent are moved to the ``dead``
+    directory.
+
+    If ``counters`` are given, every change of the state of a message is
+    counted, so :meth:`stats` need not list the queue.
+
+    :param path: the path of the maildir, created if it does not exist
+    :param max_send_time: seconds after which a claim is considered stale
+    :param counters: a :class:`QueueCounters`
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, path, max_send_time=MAX_SEND_TIME, counters=None):
+        self.maildir = open_maildir(path)
+        self.max_send_time = max_send_time
+        self.counters = counters
+
+    def __iter__(self):
+        """Iterate over the names of the queued messages, oldest first."""
+        entries = []
+        for entry in os.scandir(str(self.maildir.subdir_new)):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                entries.append((entry.stat().st_mtime, entry.name))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+        return iter([name for mtime, name in entries])
+
+    def claim(self, name):
+        """Claim the message ``name``.
+
+        Returns the path of the claimed file, or ``None`` if the message
+        has been claimed by someone else.
+        """
+        claims = self.claim_many([name])
+        return claims[0] if claims else None
+
+    def claim_many(self, names):
+        """Claim the messages ``names``, returning the paths of those
+        which could be claimed.
+        """
+        claims = [self._claim(name) for name in names]
+        claims = [path for path in claims if path is not None]
+        self._count([
+            (name, _waiting_state(name), 'sending')
+            for name in map(_claimed_name, claims)])
+        return claims
+
+    def _claim(self, name):
+        claimed = os.path.join(str(self.maildir.subdir_cur), _CLAIMED + name)
+        try:
+            os.rename(os.path.join(str(self.maildir.subdir_new), name),
+                      claimed)
+        except FileNotFoundError:
+            return None
+        # renaming keeps the time the message was queued
+        os.utime(claimed, None)
+        return claimed
+
+    def _count(self, moves):
+        if self.counters is not None and moves:
+            self.counters.move(moves)
+
+    def read(self, path, stream=False):
+        """Returns ``(fromaddr, toaddrs, message)`` for the claimed message
+        at ``path``, see :func:`read_queued`.
+        """
+        fp = open(path, 'rb')
+        if not stream:
+            with fp:
+                return read_queued(fp)
+        try:
+            fromaddr, toaddrs, chunks = read_queued(fp, stream=True)
+        except Exception:
+            fp.close()
+            raise
+        return fromaddr, toaddrs, _closing(chunks, fp)
+
+    def complete(self, path):
+        """Remove the claimed message at ``path`` after it has been sent."""
+        os.unlink(path)
+        self._count([(_claimed_name(path), 'sending', None)])
+
+    def release(self, path):
+        """Return the claimed message at ``path`` to the queue."""
+        name = _claimed_name(path)
+        os.rename(path, os.path.join(str(self.maildir.subdir_new), name))
+        self._count([(name, 'sending', _waiting_state(name))])
+
+    def attempts(self, path):
+        """The number of failed attempts to send the claimed message at
+        ``path``.
+        """
+        name = _claimed_name(path)
+        attempts = _QUEUED_NAME.match(name).group(2)
+        return int(attempts or 0)
+
+    def retry(self, path, not_before, toaddrs=None):
+        """Count a failed attempt to send the claimed message at ``path``
+        and return it to the queue at the timestamp ``not_before``; if
+        ``toaddrs`` is given, only for those recipients.
+        """
+        if toaddrs is not None:
+            self._readdress(path, toaddrs)
+        name = _claimed_name(path)
+        match = _QUEUED_NAME.match(name)
+        name = '%s.retry%d' % (match.group(1), int(match.group(2) or 0) + 1)
+        if not_before <= time.time():
+            os.rename(path, os.path.join(str(self.maildir.subdir_new), name))
+        else:
+            target = scheduled_path(str(self.maildir.path), not_before, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(path, target)
+        self._count([(name, 'sending', 'retrying')])
+
+    def _readdress(self, path, toaddrs):
+        # rewrite the claimed message at path with the envelope recipients
+        # toaddrs, compressed as it was
+        tmp = os.path.join(str(self.maildir.subdir_tmp), _claimed_name(path))
+        with open(path, 'rb') as fp:
+            compression = _compression(fp)
+            fromaddr, old, chunks = read_queued(fp, stream=True)
+            with open(tmp, 'wb') as out:
+                target = out
+                if compression is not None:
+                    target = compressing(out, compression)
+                with target:
+                    for name, value in (('X-Actually-From', fromaddr),
+                                        ('X-Actually-To', ','.join(toaddrs))):
+                        value = Header(value, 'utf-8').encode(linesep='\r\n')
+                        target.write(('%s: %s\r\n' % (name, value)).encode(
+                            'ascii'))
+                    for chunk in chunks:
+                        target.write(chunk)
+        os.replace(tmp, path)
+
+    def reject(self, path):
+        """Move the claimed message at ``path`` to the ``dead``
+        directory, out of the queue for good.
+        """
+        name = _claimed_name(path)
+        dead = os.path.join(str(self.maildir.path), DEAD)
+        os.makedirs(dead, exist_ok=True)
+        os.rename(path, os.path.join(dead, name))
+        self._count([(name, 'sending', 'dead')])
+
+    def promote(self, now=None):
+        """Move the scheduled messages which are due to ``new``.  Returns
+        their number.
+
+        Only the directories of past minutes and the current one are
+        listed (see :func:`scheduled_path`), so the cost depends on the
+        number of due messages rather than on all scheduled ones.
+        """
+        if now is None:
+            now = time.time()
+        scheduled = os.path.join(str(self.maildir.path), SCHEDULED)
+        try:
+            buckets = [int(bucket) for bucket in os.listdir(scheduled)
+                       if bucket.isdigit()]
+        except FileNotFoundError:
+            return 0
+        current = int(now // _BUCKET)
+        new = str(self.maildir.subdir_new)
+        promoted = 0
+        for bucket in sorted(buckets):
+            if bucket > current:
+                break
+            directory = os.path.join(scheduled, '%d' % bucket)
+            for name in os.listdir(directory):
+                due = name.partition('-')[0]
+                if not due.isdigit() or int(due) > now:
+                    continue
+                try:
+                    os.rename(os.path.join(directory, name),
+                              os.path.join(new, name))
+                except FileNotFoundError:
+                    # promoted by another processor
+                    continue
+                promoted += 1
+            if bucket < current:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+        return promoted
+
+    def recover(self):
+        """Return messages claimed longer than ``max_send_time`` ago to the
+        queue.  Returns their number.
+        """
+        directory = str(self.maildir.subdir_cur)
+        now = time.time()
+        recovered = 0
+        for name in os.listdir(directory):
+            if not name.startswith(_CLAIMED):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if now - max(stat.st_mtime, stat.st_ctime) > (
+                        self.max_send_time):
+                    self.release(path)
+                    recovered += 1
+            except FileNotFoundError:
+                # completed or recovered by someone else meanwhile
+                continue
+        return recovered
+
+    def stats(self):
+        """Returns the statistics of the queue, see
+        :meth:`QueueCounters.stats`.  Without ``counters`` they are
+        gathered by listing the queue.
+        """
+        if self.counters is not None:
+            return self.counters.stats()
+        return _stats(
+            (state, 1, _queued_minute(name))
+            for name, old, state in self._scan())
+
+    def recount(self):
+        """Set the ``counters`` from a listing of the queue.  Messages
+        which change state meanwhile may be miscounted, so run it while
+        no processor is at work.
+        """
+        self.counters.move(self._scan(), reset=True)
+
+    def _scan(self):
+        # (name, None, state) of every message in the maildir
+        path = str(self.maildir.path)
+        for name in os.listdir(str(self.maildir.subdir_new)):
+            if not name.startswith('.'):
+                yield name, None, _waiting_state(name)
+        for name in os.listdir(str(self.maildir.subdir_cur)):
+            if name.startswith(_CLAIMED):
+                yield name[len(_CLAIMED):], None, 'sending'
+        scheduled = os.path.join(path, SCHEDULED)
+        for bucket in _listdir(scheduled):
+            for name in _listdir(os.path.join(scheduled, bucket)):
+                yield name, None, _waiting_state(name)
+        for name in _listdir(os.path.join(path, DEAD)):
+            yield name, None, 'dead'
+
+
+class ShardedMaildirQueue(object):
+    """A queue spread over several maildirs, filled by a
+    :class:`pyramid_mailer.mailer.Mailer` with ``queue_shards`` set.
+
+    Each message is written to one of ``shards`` maildirs below ``path``,
+    chosen by a hash of its ``Message-Id`` (see :func:`shard_index`), so
+    no single directory has to hold or list the whole queue.  The shards
+    are scanned one by one and their messages handed out in turns, so
+    concurrent workers mostly claim messages in different directories.
+
+    The entries and claims of this queue are pairs of a shard, a
+    :class:`MaildirQueue`, and the name or path within it.
+
+    :param path: the directory holding the shards
+    :param shards: the number of shards
+    :param max_send_time: see :class:`MaildirQueue`
+    :param counters: a :class:`QueueCounters` shared by the shards
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, path, shards, max_send_time=MAX_SEND_TIME,
+                 counters=None):
+        self.path = path
+        self.counters = counters
+        os.makedirs(path, exist_ok=True)
+        self.shards = [
+            MaildirQueue(shard_path(path, index), max_send_time, counters)
+            for index in range(shards)
+        ]
+
+    def __iter__(self):
+        listings = [
+            [(shard, name) for name in shard] for shard in self.shards]
+        entries = []
+        for index in range(max([len(names) for names in listings] or [0])):
+            entries.extend(
+                names[index] for names in listings if index < len(names))
+        return iter(entries)
+
+    def claim(self, entry):
+        shard, name = entry
+        path = shard.claim(name)
+        if path is None:
+            return None
+        return shard, path
+
+    def claim_many(self, entries):
+        claims = []
+        for shard, name in entries:
+            path = shard._claim(name)
+            if path is not None:
+                claims.append((shard, path))
+        # one update of the shared counters for the whole batch
+        if self.counters is not None and claims:
+            self.counters.move([
+                (name, _waiting_state(name), 'sending')
+                for name in [_claimed_name(path) for shard, path in claims]])
+        return claims
+
+    def read(self, claimed, stream=False):
+        shard, path = claimed
+        return shard.read(path, stream)
+
+    def complete(self, claimed):
+        shard, path = claimed
+        shard.complete(path)
+
+    def release(self, claimed):
+        shard, path = claimed
+        shard.release(path)
+
+    def attempts(self, claimed):
+        shard, path = claimed
+        return shard.attempts(path)
+
+    def retry(self, claimed, not_before, toaddrs=None):
+        shard, path = claimed
+        shard.retry(path, not_before, toaddrs)
+
+    def reject(self, claimed):
+        shard, path = claimed
+        shard.reject(path)
+
+    def promote(self, now=None):
+        return sum(shard.promote(now) for shard in self.shards)
+
+    def recover(self):
+        return sum(shard.recover() for shard in self.shards)
+
+    def stats(self):
+        if self.counters is not None:
+            return self.counters.stats()
+        return _stats(
+            (state, 1, _queued_minute(name))
+            for shard in self.shards for name, old, state in shard._scan())
+
+    def recount(self):
+        self.counters.move(
+            [move for shard in self.shards for move in shard._scan()],
+            reset=True)
+
+
+class LaneQueue(object):
+    """A queue made of several priority lanes, filled by a
+    :class:`pyramid_mailer.mailer.Mailer` with ``queue_lanes`` set.
+
+    ``lanes`` is a list of ``(queue, weight)`` pairs, highest priority
+    first.  The lanes are visited in turns, starting with the first, and
+    up to ``weight`` messages are taken from a lane on each turn, so the
+    higher lanes are drained first while the lower ones still get their
+    share of the workers.
+
+    Iterating over the queue lists a lane again once its messages have
+    been handed out, at most every ``refresh`` seconds, and only stops
+    when no lane holds messages it has not handed out yet; a
+    :class:`QueueProcessor` thus picks up messages added to a high lane
+    while it is working through a large backlog in a low one.  Each
+    message is handed out once per iteration, so messages returned to the
+    queue after an error wait for the next run.
+
+    The entries and claims of this queue are pairs of the index of a lane
+    and the entry or claim of its queue.
+
+    :param lanes: a list of ``(queue, weight)`` pairs
+    :param refresh: the shortest time in seconds between two listings of
+           a lane
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, lanes, refresh=1.0):
+        self.lanes = list(lanes)
+        self.refresh = refresh
+
+    def __iter__(self):
+        listings = [iter(()) for lane in self.lanes]
+        listed = [None] * len(self.lanes)
+        seen = [set() for lane in self.lanes]
+        idle = False
+        while True:
+            found = False
+            for index, (queue, weight) in enumerate(self.lanes):
+                for count in range(weight):
+                    entry = next(listings[index], _NOTHING)
+                    if entry is _NOTHING:
+                        now = time.time()
+                        if (listed[index] is not None and
+                                now - listed[index] < self.refresh):
+                            break
+                        listed[index] = now
+                        listings[index] = (
+                            entry for entry in queue
+                            if entry not in seen[index])
+                        entry = next(listings[index], _NOTHING)
+                        if entry is _NOTHING:
+                            break
+                    seen[index].add(entry)
+                    found = True
+                    yield index, entry
+            if not found:
+                if idle:
+                    return
+                # make sure the lanes not listed lately are empty, too
+                listed = [None] * len(self.lanes)
+            idle = not found
+
+    def claim(self, entry):
+        index, inner = entry
+        claimed = self.lanes[index][0].claim(inner)
+        if claimed is None:
+            return None
+        return index, claimed
+
+    def claim_many(self, entries):
+        claims = []
+        for index, group in groupby(entries, itemgetter(0)):
+            queue = self.lanes[index][0]
+            claimed = queue.claim_many([inner for i, inner in group])
+            claims.extend((index, inner) for inner in claimed)
+        return claims
+
+    def read(self, claimed, stream=False):
+        index, inner = claimed
+        return self.lanes[index][0].read(inner, stream)
+
+    def complete(self, claimed):
+        index, inner = claimed
+        self.lanes[index][0].complete(inner)
+
+    def release(self, claimed):
+        index, inner = claimed
+        self.lanes[index][0].release(inner)
+
+    def attempts(self, claimed):
+        index, inner = claimed
+        return self.lanes[index][0].attempts(inner)
+
+    def retry(self, claimed, not_before, toaddrs=None):
+        index, inner = claimed
+        self.lanes[index][0].retry(inner, not_before, toaddrs)
+
+    def reject(self, claimed):
+        index, inner = claimed
+        self.lanes[index][0].reject(inner)
+
+    def promote(self, now=None):
+        return sum(queue.promote(now) for queue, weight in self.lanes)
+
+    def recover(self):
+        return sum(queue.recover() for queue, weight in self.lanes)
+
+
+class _Database(object):
+    # a SQLite database in WAL mode with a connection per thread
+
+    synchronous = 'FULL'
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # transactions are started explicitly, see _transaction
+            db = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=%s' % self.synchronous)
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        # a write transaction; taking the lock up front keeps two
+        # connections from claiming the same rows
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+def _queued_minute(name):
+    # the minute a maildir message was queued in, from the time its file
+    # name starts with
+    queued = _QUEUED_NAME.match(name).group(1).partition('.')[0]
+    return int(queued) // 60 if queued.isdigit() else 0
+
+
+def _waiting_state(name):
+    # the state of a message in the queue, by its file name
+    return 'retrying' if _QUEUED_NAME.match(name).group(2) else 'queued'
+
+
+def _stats(rows):
+    # statistics from (state, count, minute) rows
+    stats = dict.fromkeys(QUEUE_STATES, 0)
+    oldest = None
+    for state, count, minute in rows:
+        stats[state] += count
+        if state != 'dead' and count > 0 and (
+                oldest is None or minute < oldest):
+            oldest = minute
+    stats['depth'] = stats['queued'] + stats['retrying'] + stats['sending']
+    stats['oldest'] = None if oldest is None else oldest * 60
+    return stats
+
+
+class QueueCounters(_Database):
+    """Counts the messages of a maildir queue, kept up to date as they are
+    queued, claimed, sent, retried and rejected.
+
+    Messages are counted by state (see :data:`QUEUE_STATES`) and by the
+    minute they were queued in, in a SQLite database, so
+    :meth:`stats` costs the same however long the queue is.  The counts
+    are updated after the files have been moved and are not synced to
+    disk, so they drift from the queue if a process crashes in between;
+    :meth:`MaildirQueue.recount` sets them from a listing of the queue.
+
+    :param path: the path of the database file, created if it does not
+           exist
+    :param timeout: seconds to wait for a lock held by another connection
+
+    :versionadded: 0.16
+    """
+
+    # losing the last counts on a power failure is no worse than a crash
+    synchronous = 'NORMAL'
+
+    def __init__(self, path, timeout=30):
+        super(QueueCounters, self).__init__(path, timeout)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS counts ('
+                'state TEXT NOT NULL, '
+                'minute INTEGER NOT NULL, '
+                'count INTEGER NOT NULL, '
+                'PRIMARY KEY (state, minute)) WITHOUT ROWID')
+
+    def move(self, moves, reset=False):
+        """Count messages moving from one state to another, in one
+        transaction.
+
+        ``moves`` are ``(name, old, new)`` tuples of the maildir name of a
+        message, its old state, or ``None`` for a new message, and its new
+        state, or ``None`` for a message which has been sent.  With
+        ``reset``, the counts are replaced.
+        """
+        deltas = {}
+        for name, old, new in moves:
+            minute = _queued_minute(name)
+            if old is not None:
+                deltas[old, minute] = deltas.get((old, minute), 0) - 1
+            if new is not None:
+                deltas[new, minute] = deltas.get((new, minute), 0) + 1
+        if not (deltas or reset):
+            return
+        with self._transaction() as db:
+            if reset:
+                db.execute('DELETE FROM counts')
+            for (state, minute), delta in sorted(deltas.items()):
+                if not delta:
+                    continue
+                db.execute('INSERT OR IGNORE INTO counts VALUES (?, ?, 0)',
+                           (state, minute))
+                db.execute(
+                    'UPDATE counts SET count = count + ? '
+                    'WHERE state = ? AND minute = ?', (delta, state, minute))
+                db.execute(
+                    'DELETE FROM counts '
+                    'WHERE state = ? AND minute = ? AND count = 0',
+                    (state, minute))
+
+    def stats(self):
+        """Returns the statistics of the queue, a dictionary of the number
+        of messages in each state, their ``depth``, i.e. the number of
+        messages not yet sent or rejected, and the time the ``oldest`` of
+        those was queued, rounded down to the minute, or ``None``.
+        """
+        return _stats(self.db.execute(
+            'SELECT state, count, minute FROM counts'))
+
+
+class SQLiteQueue(_Database):
+    """A queue of rendered messages kept in a SQLite database.
+
+    The database is used in WAL mode, so adding messages does not block
+    the processors reading the queue.  :meth:`add_many` stores any number
+    of messages in one SQLite transaction, i.e. with a single sync of the
+    log, and messages are claimed in batches with one write transaction
+    each; a row is only claimed by one thread or process.  Every thread
+    uses its own connection.
+
+    Messages which cannot be sent are kept with ``rejected`` set; the
+    number of failed attempts to send a message is kept in ``attempts``.
+
+    The messages of all priority lanes are kept in the same table; an
+    instance only adds and lists those of its ``lane``.  Messages are only
+    listed once their ``not_before`` time has come, which is indexed.
+
+    If ``commit_latency`` is set, the messages added by concurrent
+    threads are stored together in one transaction, see
+    :class:`GroupCommit`.
+
+    If ``dedup_ttl`` is set, the ``Message-Id`` of every message added
+    with one chosen by the caller is kept for that many seconds in a table
+    keyed by it, and messages with an id in the table are dropped.
+
+    Triggers count the messages by lane, state and the minute they were
+    queued in as they change, in the same transaction, for :meth:`stats`.
+
+    :param path: the path of the database file, created if it does not
+           exist
+    :param max_send_time: seconds after which a claim is considered stale
+    :param timeout: seconds to wait for a lock held by another connection
+    :param commit_latency: the longest time in seconds :meth:`add_many`
+           waits for other threads to add their messages
+    :param lane: the priority lane, see :class:`LaneQueue`
+    :param dedup_ttl: the number of seconds a ``Message-Id`` is kept to
+           drop duplicates, or ``None``
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, path, max_send_time=MAX_SEND_TIME, timeout=30,
+                 commit_latency=None, lane=DEFAULT_LANE, dedup_ttl=None):
+        super(SQLiteQueue, self).__init__(path, timeout)
+        self.lane = lane
+        self.dedup_ttl = dedup_ttl
+        self.max_send_time = max_send_time
+        self.committer = None
+        if commit_latency is not None:
+            self.committer = GroupCommit(self._add_groups, commit_latency)
+        with self._transaction() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY, '
+                'message_id TEXT, '
+                'fromaddr TEXT NOT NULL, '
+                'toaddrs TEXT NOT NULL, '
+                "lane TEXT NOT NULL DEFAULT 'default', "
+                'data BLOB NOT NULL, '
+                'queued REAL NOT NULL, '
+                'not_before REAL NOT NULL, '
+                'claimed REAL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'rejected INTEGER NOT NULL DEFAULT 0)')
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS messages_pending '
+                'ON messages (lane, rejected, claimed, not_before)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS message_ids ('
+                'message_id TEXT PRIMARY KEY, '
+                'added REAL NOT NULL) WITHOUT ROWID')
+            db.execute(
+                'CREATE INDEX IF NOT EXISTS message_ids_added '
+                'ON message_ids (added)')
+            counted = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'counts'"
+            ).fetchone()
+            if not counted:
+                self._create_counts(db)
+
+    def _create_counts(self, db):
+        db.execute(
+            'CREATE TABLE counts ('
+            'lane TEXT NOT NULL, '
+            'state TEXT NOT NULL, '
+            'minute INTEGER NOT NULL, '
+            'count INTEGER NOT NULL, '
+            'PRIMARY KEY (lane, state, minute)) WITHOUT ROWID')
+        count = (
+            "INSERT OR IGNORE INTO counts VALUES ({0}.lane, %(state)s, "
+            "%(minute)s, 0); "
+            "UPDATE counts SET count = count + 1 "
+            "WHERE lane = {0}.lane AND state = %(state)s "
+            "AND minute = %(minute)s;" % _COUNT_KEY)
+        uncount = (
+            "UPDATE counts SET count = count - 1 "
+            "WHERE lane = {0}.lane AND state = %(state)s "
+            "AND minute = %(minute)s; "
+            "DELETE FROM counts WHERE lane = {0}.lane "
+            "AND state = %(state)s AND minute = %(minute)s "
+            "AND count = 0;" % _COUNT_KEY)
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS messages_inserted '
+            'AFTER INSERT ON messages '
+            'BEGIN %s END' % count.format('new'))
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS messages_deleted '
+            'AFTER DELETE ON messages '
+            'BEGIN %s END' % uncount.format('old'))
+        db.execute(
+            'CREATE TRIGGER IF NOT EXISTS messages_updated '
+            'AFTER UPDATE OF claimed, attempts, rejected ON messages '
+            'WHEN %s != %s BEGIN %s %s END' % (
+                _COUNT_KEY['state'].format('old'),
+                _COUNT_KEY['state'].format('new'),
+                uncount.format('old'), count.format('new')))
+        # messages queued before the table existed
+        self._recount(db, None)
+
+    def _recount(self, db, lane):
+        where = '' if lane is None else 'WHERE lane = ?'
+        args = () if lane is None else (lane,)
+        db.execute('DELETE FROM counts %s' % where, args)
+        db.execute(
+            'INSERT INTO counts SELECT lane, %s, %s, COUNT(*) '
+            'FROM messages %s GROUP BY 1, 2, 3' % (
+                _COUNT_KEY['state'].format('messages'),
+                _COUNT_KEY['minute'].format('messages'), where), args)
+
+    def add_many(self, messages):
+        """Add ``(messageid, fromaddr, toaddrs, message)`` tuples to the
+        queue in a single transaction; ``message`` is the rendered message
+        as bytes.  A tuple may have a fifth item, the timestamp before
+        which the message must not be sent, or ``None``, and a sixth, the
+        id recorded to drop duplicates, or ``None`` if ``messageid`` was
+        generated and cannot recur; it defaults to ``messageid``.
+        """
+        if self.committer is not None:
+            self.committer.submit(messages)
+        else:
+            self._add_groups([messages])
+
+    def _add_groups(self, groups):
+        now = time.time()
+        rows = []
+        dedupids = []
+        for messages in groups:
+            for entry in messages:
+                messageid, fromaddr, toaddrs, message = entry[:4]
+                not_before = entry[4] if len(entry) > 4 else None
+                if not_before is None:
+                    not_before = now
+                rows.append((messageid, fromaddr, ','.join(toaddrs),
+                             self.lane, message, now, not_before))
+                dedupids.append(entry[5] if len(entry) > 5 else messageid)
+        with self._transaction() as db:
+            if self.dedup_ttl is not None:
+                db.execute('DELETE FROM message_ids WHERE added < ?',
+                           (now - self.dedup_ttl,))
+                unique = []
+                for row, dedupid in zip(rows, dedupids):
+                    if dedupid is None:
+                        unique.append(row)
+                        continue
+                    cursor = db.execute(
+                        'INSERT OR IGNORE INTO message_ids '
+                        '(message_id, added) VALUES (?, ?)', (dedupid, now))
+                    if cursor.rowcount:
+                        unique.append(row)
+                    else:
+                        log.info('Dropped duplicate message %s.', dedupid)
+                rows = unique
+            db.executemany(
+                'INSERT INTO messages '
+                '(message_id, fromaddr, toaddrs, lane, data, queued, '
+                'not_before) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def __iter__(self):
+        """Iterate over the row ids of the queued messages which are due,
+        oldest first.
+
+        The ids are listed a page at a time, as they are consumed, so the
+        messages claimed meanwhile, e.g. by other processors, are skipped
+        and a long queue is not listed at once.
+        """
+        now = time.time()
+        # the rows after the last one listed, in the same order
+        not_before, rowid = float('-inf'), 0
+        while True:
+            rows = self.db.execute(
+                'SELECT not_before, id FROM messages WHERE lane = ? '
+                'AND rejected = 0 AND claimed IS NULL AND not_before <= ? '
+                'AND (not_before > ? OR (not_before = ? AND id > ?)) '
+                'ORDER BY not_before, id LIMIT ?',
+                (self.lane, now, not_before, not_before, rowid,
+                 _PAGE)).fetchall()
+            for not_before, rowid in rows:
+                yield rowid
+            if len(rows) < _PAGE:
+                return
+
+    def claim(self, rowid):
+        claimed = self.claim_many([rowid])
+        return claimed[0] if claimed else None
+
+    def claim_many(self, ids):
+        """Claim the messages with the row ids ``ids`` in one transaction,
+        returning the ids of those which could be claimed.
+        """
+        ids = list(ids)
+        if not ids:
+            return []
+        marks = ', '.join('?' * len(ids))
+        with self._transaction() as db:
+            claimed = [row[0] for row in db.execute(
+                'SELECT id FROM messages WHERE id IN (%s) '
+                'AND rejected = 0 AND claimed IS NULL ORDER BY id' % marks,
+                ids)]
+            if claimed:
+                db.execute(
+                    'UPDATE messages SET claimed = ? WHERE id IN (%s)' %
+                    ', '.join('?' * len(claimed)),
+                    [time.time()] + claimed)
+        return claimed
+
+    def read(self, rowid, stream=False):
+        """Returns ``(fromaddr, toaddrs, message)`` for a claimed message.
+
+        A compressed message is decompressed, if ``stream`` is true as an
+        iterator of bytes chunks.
+        """
+        fromaddr, toaddrs, data = self.db.execute(
+            'SELECT fromaddr, toaddrs, data FROM messages WHERE id = ?',
+            (rowid,)).fetchone()
+        message = bytes(data)
+        if message.startswith((_GZIP_MAGIC, _XZ_MAGIC)):
+            fp = _decompressing(io.BytesIO(message))
+            message = iter(lambda: fp.read(_CHUNK), b'')
+            if not stream:
+                message = b''.join(message)
+        return fromaddr, tuple(toaddrs.split(',')), message
+
+    def complete(self, rowid):
+        self.db.execute('DELETE FROM messages WHERE id = ?', (rowid,))
+
+    def release(self, rowid):
+        self.db.execute(
+            'UPDATE messages SET claimed = NULL WHERE id = ?', (rowid,))
+
+    def attempts(self, rowid):
+        return self.db.execute(
+            'SELECT attempts FROM messages WHERE id = ?',
+            (rowid,)).fetchone()[0]
+
+    def retry(self, rowid, not_before, toaddrs=None):
+        if toaddrs is not None:
+            toaddrs = ','.join(toaddrs)
+        self.db.execute(
+            'UPDATE messages SET claimed = NULL, attempts = attempts + 1, '
+            'not_before = ?, toaddrs = COALESCE(?, toaddrs) WHERE id = ?',
+            (not_before, toaddrs, rowid))
+
+    def reject(self, rowid):
+        self.db.execute(
+            'UPDATE messages SET claimed = NULL, rejected = 1 WHERE id = ?',
+            (rowid,))
+
+    def promote(self, now=None):
+        # due messages are selected by __iter__
+        return 0
+
+    def recover(self):
+        cursor = self.db.execute(
+            'UPDATE messages SET claimed = NULL '
+            'WHERE lane = ? AND claimed IS NOT NULL AND claimed < ?',
+            (self.lane, time.time() - self.max_send_time))
+        return cursor.rowcount
+
+    def stats(self):
+        """Returns the statistics of the lane, see
+        :meth:`QueueCounters.stats`.
+        """
+        return _stats(self.db.execute(
+            'SELECT state, count, minute FROM counts WHERE lane = ?',
+            (self.lane,)))
+
+    def recount(self):
+        """Count the messages of the lane anew.  The counts are kept
+        exact by triggers, so this is only needed if the database was
+        changed with them disabled.
+        """
+        with self._transaction() as db:
+            self._recount(db, self.lane)
+
+
+# errors opening or authenticating the SMTP session, which say nothing
+# about the message being sent
+_SESSION_ERRORS = (
+    smtplib.SMTPAuthenticationError,
+    smtplib.SMTPConnectError,
+    smtplib.SMTPHeloError,
+    smtplib.SMTPNotSupportedError,
+    EHLO_Error,
+    ESMTP_NotSupported,
+    TLS_NotAvailable,
+)
+
+
+def _is_permanent(exc):
+    # only replies to the MAIL, RCPT and DATA commands of the message
+    if isinstance(exc, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return 500 <= exc.smtp_code <= 599
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code <= 599
+                   for code, response in exc.recipients.values())
+    return False
+
+
+class QueueProcessor(object):
+    """Delivers the messages of a queue from several threads.
+
+    Every worker thread claims up to ``batch_size`` queued messages at a
+    time (see :class:`MaildirQueue`) and sends them with ``mailer``;
+    sharing a
+    :class:`pyramid_mailer.pool.SMTPConnectionPool` lets the workers reuse
+    each other's SMTP sessions.
+
+    After a temporary error, e.g. a 4xx reply or a refused connection, a
+    message is scheduled to be retried: ``retry_delay`` seconds after its
+    first attempt, twice that after the second and so on, up to
+    ``max_retry_delay``, each delay shortened by a random amount of up to
+    half of it so messages which failed together are not retried together.
+    Messages refused with a permanent (5xx) error, or which failed
+    ``max_attempts`` times, are set aside as dead letters.  A message
+    which some recipients refused with a temporary error is retried the
+    same way for those recipients only, until it has been tried
+    ``max_attempts`` times.  If the SMTP session cannot be opened, e.g.
+    because the login is refused, the message is returned to the queue
+    without counting an attempt and the workers stop until the next call
+    of :meth:`send_messages`.
+
+    :param mailer: an object with a ``send(fromaddr, toaddrs, message)``
+           method accepting the message as bytes, such as
+           :class:`pyramid_mailer.pool.SMTPConnectionPool`
+    :param queue: a :class:`MaildirQueue`, a :class:`ShardedMaildirQueue`,
+           a :class:`SQLiteQueue`, a :class:`LaneQueue` or the path of a
+           maildir
+    :param workers: the number of worker threads
+    :param batch_size: the number of messages a worker claims at once
+    :param retry_delay: the seconds to wait before the first retry
+    :param max_retry_delay: the longest time in seconds between retries
+    :param max_attempts: the number of attempts after which a message is
+           given up, or ``None`` to retry for ever
+    :param stream: pass messages to ``mailer`` as iterators of bytes
+           chunks, read and decompressed from the queue as they are sent
+           (see :func:`read_queued`); ``mailer`` must accept them, as
+           :class:`pyramid_mailer.pool.SMTPConnectionPool` does
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, mailer, queue, workers=1, batch_size=1,
+                 retry_delay=60, max_retry_delay=60 * 60, max_attempts=10,
+                 stream=False):
+        if isinstance(queue, str):
+            queue = MaildirQueue(queue)
+        self.mailer = mailer
+        self.queue = queue
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.stream = stream
+        self._stopped = threading.Event()
+        self._aborted = threading.Event()
+        self._lock = threading.Lock()
+
+    def send_messages(self):
+        """Deliver the messages currently in the queue.
+
+        Returns the number of messages sent.
+        """
+        self._aborted.clear()
+        self.queue.recover()
+        self.queue.promote()
+        entries = iter(self.queue)
+        sent = []
+        threads = [
+            threading.Thread(target=self._work, args=(entries, sent))
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(sent)
+
+    def _halted(self):
+        return self._stopped.is_set() or self._aborted.is_set()
+
+    def _work(self, entries, sent):
+        while not self._halted():
+            # entries may be listed lazily, see LaneQueue
+            with self._lock:
+                batch = list(islice(entries, self.batch_size))
+            if not batch:
+                return
+            claims = self.queue.claim_many(batch)
+            for index, claimed in enumerate(claims):
+                if self._halted():
+                    for unsent in claims[index:]:
+                        self.queue.release(unsent)
+                    return
+                if self._send_message(claimed):
+                    sent.append(claimed)
+
+    def _send_message(self, claimed):
+        fromaddr, toaddrs, message = '', (), None
+        try:
+            if self.stream:
+                fromaddr, toaddrs, message = self.queue.read(
+                    claimed, stream=True)
+            else:
+                fromaddr, toaddrs, message = self.queue.read(claimed)
+            refused = self.mailer.send(fromaddr, toaddrs, message)
+        except Exception as exc:
+            if isinstance(exc, _SESSION_ERRORS):
+                log.error(
+                    'Cannot open an SMTP session, stopping until the next '
+                    'run: %s', exc)
+                self._aborted.set()
+                self.queue.release(claimed)
+                return False
+            attempts = self.queue.attempts(claimed) + 1
+            if _is_permanent(exc):
+                log.error(
+                    'Discarding email from %s to %s due to a permanent '
+                    'error: %s', fromaddr, ', '.join(toaddrs), exc)
+                self.queue.reject(claimed)
+            elif (self.max_attempts is not None and
+                    attempts >= self.max_attempts):
+                log.error(
+                    'Discarding email from %s to %s after %d attempts: %s',
+                    fromaddr, ', '.join(toaddrs), attempts, exc)
+                self.queue.reject(claimed)
+            else:
+                delay = self._retry_delay(attempts)
+                log.error(
+                    'Error while sending mail from %s to %s, retrying in '
+                    '%d seconds.', fromaddr, ', '.join(toaddrs), delay,
+                    exc_info=True)
+                self.queue.retry(claimed, time.time() + delay)
+            return False
+        finally:
+            # a stream the mailer did not read to the end holds its file
+            if hasattr(message, 'close'):
+                message.close()
+        refused = refused or {}
+        temporary = sorted(
+            addr for addr, (code, response) in refused.items()
+            if not 500 <= code <= 599)
+        permanent = sorted(set(refused).difference(temporary))
+        if permanent:
+            log.warning('Mail from %s refused for %s.',
+                        fromaddr, ', '.join(permanent))
+        attempts = self.queue.attempts(claimed) + 1
+        if temporary and (self.max_attempts is None or
+                          attempts < self.max_attempts):
+            delay = self._retry_delay(attempts)
+            log.warning(
+                'Mail from %s temporarily refused for %s, retrying in %d '
+                'seconds.', fromaddr, ', '.join(temporary), delay)
+            self.queue.retry(claimed, time.time() + delay, temporary)
+        else:
+            if temporary:
+                log.error(
+                    'Discarding email from %s to %s after %d attempts.',
+                    fromaddr, ', '.join(temporary), attempts)
+            self.queue.complete(claimed)
+        log.info('Mail from %s to %s sent.', fromaddr, ', '.join(
+            addr for addr in toaddrs if addr not in refused))
+        return True
+
+    def _retry_delay(self, attempts):
+        # exponential backoff with jitter
+        delay = min(self.retry_delay * 2 ** (attempts - 1),
+                    self.max_retry_delay)
+        return delay - random.uniform(0, delay / 2)
+
+    def run(self, interval):
+        """Deliver queued messages every ``interval`` seconds until
+        :meth:`stop` is called.
+        """
+        while not self._stopped.is_set():
+            self.send_messages()
+            self._stopped.wait(interval)
+
+    def stop(self):
+        """Make :meth:`run` return once the messages being sent are done."""
+        self._stopped.set()
+
+
+def mailer_queues(mailer):
+    """Returns ``(lane, queue, weight)`` for each priority lane of the
+    queue of the :class:`pyramid_mailer.mailer.Mailer` ``mailer``, with
+    the queue of the lane as used by :func:`main`.
+    """
+    queues = []
+    for lane, weight in mailer.queue_lanes:
+        counters = (mailer.lane_counters or {}).get(lane)
+        if mailer.queue_backend == 'sqlite':
+            queue = mailer.sqlite_queues[lane]
+        elif mailer.queue_shards:
+            queue = ShardedMaildirQueue(
+                lane_path(mailer.queue_path, lane), mailer.queue_shards,
+                counters=counters)
+        else:
+            queue = MaildirQueue(
+                lane_path(mailer.queue_path, lane), counters=counters)
+        queues.append((lane, queue, weight))
+    return queues
+
+
+def main(argv=sys.argv):
+    """The ``pmailqp`` console script.
+
+    Delivers the messages queued by an application, using the ``mail.*``
+    settings of its Pyramid ini file.
+    """
+    from pyramid.paster import get_appsettings
+    from pyramid.paster import setup_logging
+    from pyramid_mailer.mailer import Mailer
+    from pyramid_mailer.pool import MultiHostPool
+    from pyramid_mailer.pool import SMTPConnectionPool
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Deliver the messages of a pyramid_mailer maildir '
+                    'queue, configured by the mail.* settings of a '
+                    'Pyramid ini file.')
+    parser.add_argument('config_uri',
+                        help='the ini file, e.g. production.ini')
+    parser.add_argument('--app-name', default='main',
+                        help='the application section to read the '
+                             'settings from (default: main)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of worker threads (default: 1)')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='the number of messages a worker claims at '
+                             'once (default: 1, 50 for a SQLite queue)')
+    parser.add_argument('--retry-delay', type=float, default=60,
+                        help='seconds before the first retry of a message '
+                             'after a temporary error, doubled for each '
+                             'further one (default: 60)')
+    parser.add_argument('--max-retry-delay', type=float, default=60 * 60,
+                        help='the longest delay between two retries '
+                             '(default: 3600)')
+    parser.add_argument('--max-attempts', type=int, default=10,
+                        help='move a message to the dead letters after '
+                             'this many attempts, 0 to retry for ever '
+                             '(default: 10)')
+    parser.add_argument('--interval', type=float, default=None,
+                        help='keep running, processing the queue every '
+                             'INTERVAL seconds')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri, name=args.app_name)
+    prefix = settings.get('pyramid_mailer.prefix', 'mail.')
+    mailer = Mailer.from_settings(settings, prefix)
+    if not mailer.queue_path:
+        parser.error('%squeue_path is not set in %s' % (
+            prefix, args.config_uri))
+
+    pool = mailer.smtp_mailer
+    if isinstance(pool, MultiHostPool):
+        # keep a connection open per worker to every host
+        for host in pool.hosts:
+            host.pool.size = max(host.pool.size, args.workers)
+    elif not isinstance(pool, SMTPConnectionPool):
+        pool = SMTPConnectionPool(pool, size=args.workers)
+    batch_size = args.batch_size or 1
+    if mailer.queue_backend == 'sqlite':
+        batch_size = args.batch_size or 50
+    lanes = [(queue, weight)
+             for lane, queue, weight in mailer_queues(mailer)]
+    if len(lanes) > 1:
+        queue = LaneQueue(lanes)
+    else:
+        [(queue, weight)] = lanes
+    processor = QueueProcessor(
+        pool, queue, args.workers, batch_size,
+        retry_delay=args.retry_delay, max_retry_delay=args.max_retry_delay,
+        max_attempts=args.max_attempts or None, stream=True)
+    try:
+        if args.interval is None:
+            processor.send_messages()
+        else:
+            processor.run(args.interval)
+    except KeyboardInterrupt:
+        processor.stop()
+    finally:
+        pool.close()
+    return 0
+
+
+def _age(seconds):
+    # e.g. 3d4h, 2h5m or 42s
+    seconds = int(seconds)
+    for unit, size, smaller, smaller_size in [
+            ('d', 86400, 'h', 3600), ('h', 3600, 'm', 60),
+            ('m', 60, 's', 1)]:
+        if seconds >= size:
+            return '%d%s%d%s' % (
+                seconds // size, unit, seconds % size // smaller_size,
+                smaller)
+    return '%ds' % max(seconds, 0)
+
+
+def stat_main(argv=sys.argv, out=sys.stdout):
+    """The ``pmailqstat`` console script.
+
+    Prints the number of messages in each state, and the age of the
+    oldest one, for each lane of the queue of an application, see
+    :meth:`pyramid_mailer.mailer.Mailer.queue_stats`.
+    """
+    import json
+    from pyramid.paster import get_appsettings
+    from pyramid_mailer.mailer import Mailer
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Show the statistics of a pyramid_mailer queue, '
+                    'configured by the mail.* settings of a Pyramid ini '
+                    'file.')
+    parser.add_argument('config_uri',
+                        help='the ini file, e.g. production.ini')
+    parser.add_argument('--app-name', default='main',
+                        help='the application section to read the '
+                             'settings from (default: main)')
+    parser.add_argument('--json', action='store_true',
+                        help='print the statistics as JSON')
+    parser.add_argument('--recount', action='store_true',
+                        help='set the counters from a listing of the '
+                             'queue first; stop pmailqp meanwhile')
+    args = parser.parse_args(argv[1:])
+
+    settings = get_appsettings(args.config_uri, name=args.app_name)
+    prefix = settings.get('pyramid_mailer.prefix', 'mail.')
+    mailer = Mailer.from_settings(settings, prefix)
+    if not mailer.queue_path:
+        parser.error('%squeue_path is not set in %s' % (
+            prefix, args.config_uri))
+    if args.recount:
+        if mailer.queue_backend == 'maildir' and not mailer.queue_counters:
+            parser.error('%squeue_counters is not set in %s' % (
+                prefix, args.config_uri))
+        for lane, queue, weight in mailer_queues(mailer):
+            queue.recount()
+
+    stats = mailer.queue_stats()
+    if args.json:
+        json.dump(stats, out, indent=2, sort_keys=True)
+        out.write('\n')
+        return 0
+    now = time.time()
+    columns = ('depth',) + QUEUE_STATES
+    out.write('%-12s' % 'lane' + ''.join(
+        '%10s' % column for column in columns) + '%10s\n' % 'oldest')
+    for lane, weight in mailer.queue_lanes:
+        lane_stats = stats[lane]
+        oldest = lane_stats['oldest']
+        out.write('%-12s' % lane + ''.join(
+            '%10d' % lane_stats[column] for column in columns) + '%10s\n' % (
+            '-' if oldest is None else _age(now - oldest)))
+    return 0
@@ -0,0 +1,81 @@
+class RecipientRouter(object):
+    """Maps recipient addresses to routes by their domain.
+
+    The patterns are compiled into dictionaries when the router is
+    created, so routing an address takes a dictionary lookup per label of
+    its domain however many routes there are.  A pattern is either a
+    domain (``example.com``), which matches that domain only, ``*.`` and a
+    domain (``*.example.com``), which matches its subdomains, or ``*``,
+    which matches any domain.  Domains are matched case-insensitively; an
+    exact match wins over the longest matching ``*.`` pattern, which wins
+    over ``*``.  If a pattern is given more than once, the first route
+    given for it is used.
+
+    :param routes: a sequence of ``(pattern, route)`` pairs; a route can
+           be any hashable object
+    :param default: the route of addresses matching no pattern
+
+    :versionadded: 0.16
+    """
+
+    def __init__(self, routes, default=None):
+        self.routes = list(routes)
+        self.default = default
+        self._domains = {}
+        self._suffixes = {}
+        fallback = []
+        for pattern, route in self.routes:
+            pattern = pattern.strip().lower()
+            if pattern == '*':
+                fallback.append(route)
+            elif pattern.startswith('*.') and len(pattern) > 2:
+                self._suffixes.setdefault(pattern[1:], route)
+            elif pattern and '*' not in pattern and '@' not in pattern:
+                self._domains.setdefault(pattern, route)
+            else:
+                raise ValueError('invalid route pattern: %s' % pattern)
+        if fallback:
+            self.default = fallback[0]
+
+    def route(self, address):
+        """Returns the route of ``address``, a plain address or one with a
+        display name (``Name <user@example.com>``).
+        """
+        domain = address.rpartition('@')[2].rstrip('> \t').lower()
+        return self._route(domain)
+
+    def _route(self, domain):
+        route = self._domains.get(domain)
+        if route is not None:
+            return route
+        # ".sub.example.com", then ".example.com", then ".com"
+        index = domain.find('.')
+        while index != -1:
+            route = self._suffixes.get(domain[index:])
+            if route is not None:
+                return route
+            index = domain.find('.', index + 1)
+        return self.default
+
+    def split(self, addresses):
+        """Group ``addresses`` by route.
+
+        Returns a list of ``(route, addresses)`` pairs, in the order in
+        which the routes are first used; every domain is only routed once.
+        """
+        groups = []
+        by_route = {}
+        by_domain = {}
+        for address in addresses:
+            domain = address.rpartition('@')[2].rstrip('> \t').lower()
+            try:
+                route = by_domain[domain]
+            except KeyError:
+                route = by_domain[domain] = self._route(domain)
+            try:
+                group = by_route[route]
+            except KeyError:
+                group = by_route[route] = []
+                groups.append((route, group))
+            group.append(address)
+        return groups
@@ -0,0 +1,133 @@
+import asyncio
+import unittest
+
+
+class TestAsyncMailer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _getTargetClass(self):
+        from pyramid_mailer.aio import AsyncMailer
+        return AsyncMailer
+
+    def _makeOne(self, mailer=None, **kw):
+        if mailer is None:
+            from pyramid_mailer.mailer import DummyMailer
+            mailer = DummyMailer()
+        return self._getTargetClass()(mailer, **kw)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_from_settings(self):
+        settings = {'mail.host': 'my.server.com',
+                    'mail.async_concurrency': '4'}
+        mailer = self._getTargetClass().from_settings(settings)
+        self.assertEqual(mailer.concurrency, 4)
+        self.assertEqual(mailer.executor._max_workers, 4)
+        self.assertEqual(mailer.mailer.smtp_pool.size, 4)
+        self.assertEqual(mailer.mailer.smtp_pool.mailer.hostname,
+                         'my.server.com')
+        mailer.close()
+
+    def test_from_settings_with_pool_size(self):
+        settings = {'mail.pool_size': '2'}
+        mailer = self._getTargetClass().from_settings(settings)
+        self.assertEqual(mailer.concurrency, 10)
+        self.assertEqual(mailer.mailer.smtp_pool.size, 2)
+        mailer.close()
+
+    def test_bind(self):
+        from pyramid_mailer.mailer import Mailer
+        mailer = self._makeOne(Mailer())
+        result = mailer.bind(default_sender='foo')
+        self.assertEqual(result.mailer.default_sender, 'foo')
+        self.assertIs(result.executor, mailer.executor)
+        mailer.close()
+
+    def test_send_to_queue_debug_mailer(self):
+        import os
+        import shutil
+        import tempfile
+        from pyramid_mailer.mailer import DebugMailer
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        mailer = self._makeOne(DebugMailer(tempdir))
+        self._run(mailer.send_to_queue(_makeMessage(), priority='urgent'))
+        mailer.close()
+        self.assertEqual(len(os.listdir(tempdir)), 1)
+
+    def test_send_immediately(self):
+        mailer = self._makeOne()
+        msg = _makeMessage()
+        self._run(mailer.send_immediately(msg))
+        self.assertEqual(mailer.mailer.outbox, [msg])
+
+    def test_send_immediately_error(self):
+        import socket
+        from pyramid_mailer.mailer import Mailer
+        mailer = self._makeOne(Mailer(host='localhost', port='28322'))
+        msg = _makeMessage()
+        self.assertRaises(socket.error, self._run,
+                          mailer.send_immediately(msg))
+        self.assertEqual(
+            self._run(mailer.send_immediately(msg, fail_silently=True)),
+            None)
+
+    def test_send_many(self):
+        mailer = self._makeOne()
+        msgs = [_makeMessage(), _makeMessage()]
+        result = self._run(mailer.send_many(iter(msgs)))
+        self.assertEqual(result, [{}, {}])
+        self.assertEqual(mailer.mailer.outbox, msgs)
+
+    def test_send_immediately_sendmail(self):
+        mailer = self._makeOne()
+        msg = _makeMessage()
+        self._run(mailer.send_immediately_sendmail(msg))
+        self.assertEqual(mailer.mailer.outbox, [msg])
+
+    def test_send_to_queue_commits(self):
+        import os
+        import shutil
+        import tempfile
+        from pyramid_mailer.mailer import Mailer
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        queue_path = os.path.join(tempdir, 'queue')
+        mailer = self._makeOne(Mailer(queue_path=queue_path))
+        self._run(mailer.send_to_queue(_makeMessage()))
+        self.assertEqual(len(os.listdir(os.path.join(queue_path, 'new'))), 1)
+
+    def test_concurrent_sends(self):
+        mailer = self._makeOne()
+        msgs = [_makeMessage() for i in range(20)]
+
+        async def send_all():
+            await asyncio.gather(*[mailer.send_immediately(msg)
+                                   for msg in msgs])
+
+        self._run(send_all())
+        self.assertEqual(len(mailer.mailer.outbox), 20)
+
+    def test_close(self):
+        mailer = self._makeOne()
+        mailer.close()
+        self.assertRaises(RuntimeError, mailer.executor.submit, len, '')
+
+
+def _makeMessage(subject="testing",
+                 sender="sender@example.com",
+                 recipients=["tester@example.com"],
+                 body="test",
+                 **kw):
+    from pyramid_mailer.message import Message
+    return Message(subject=subject,
+                   sender=sender,
+                   recipients=recipients,
+                   body=body,
+                   **kw)
@@ -0,0 +1,54 @@
+import threading
+import unittest
+
+
+class TestBackgroundSender(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.background import BackgroundSender
+        return BackgroundSender
+
+    def _makeOne(self, **kw):
+        sender = self._getTargetClass()(**kw)
+        self.addCleanup(sender.shutdown)
+        return sender
+
+    def test_submit(self):
+        sender = self._makeOne(workers=2)
+        future = sender.submit(sum, [1, 2])
+        self.assertEqual(future.result(), 3)
+
+    def test_submit_error(self):
+        sender = self._makeOne()
+        future = sender.submit(int, 'x')
+        self.assertRaises(ValueError, future.result)
+
+    def test_queue_bound(self):
+        sender = self._makeOne(workers=1, queue_size=1)
+        gate = threading.Event()
+        first = sender.submit(gate.wait)
+        submitted = threading.Event()
+        def submit_second():
+            sender.submit(len, '')
+            submitted.set()
+        thread = threading.Thread(target=submit_second)
+        thread.start()
+        self.assertFalse(submitted.wait(0.1))
+        gate.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        self.assertTrue(first.result())
+
+    def test_submit_after_shutdown_releases_slot(self):
+        sender = self._makeOne(queue_size=1)
+        sender.shutdown()
+        self.assertRaises(RuntimeError, sender.submit, len, '')
+        self.assertRaises(RuntimeError, sender.submit, len, '')
+
+    def test_shutdown_drains(self):
+        import time
+        sender = self._makeOne(workers=1)
+        done = []
+        sender.submit(lambda: (time.sleep(0.05), done.append(1)))
+        sender.shutdown(wait=True)
+        self.assertEqual(done, [1])
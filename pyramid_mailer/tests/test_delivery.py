@@ -0,0 +1,673 @@
+import unittest
+
+
+class Test_prepare_message(unittest.TestCase):
+
+    def _callFUT(self, message):
+        from pyramid_mailer.delivery import prepare_message
+        return prepare_message(message)
+
+    def test_adds_headers(self):
+        from email.mime.text import MIMEText
+        message = MIMEText('hello')
+        messageid = self._callFUT(message)
+        self.assertEqual(message['Message-Id'], messageid)
+        self.assertTrue(message['Date'])
+
+    def test_keeps_headers(self):
+        from email.mime.text import MIMEText
+        message = MIMEText('hello')
+        message['Message-Id'] = '<abc@example.com>'
+        message['Date'] = 'today'
+        messageid = self._callFUT(message)
+        self.assertEqual(messageid, '<abc@example.com>')
+        self.assertEqual(message['Date'], 'today')
+
+
+class TestBatchMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        self.tm = transaction.TransactionManager()
+
+    def _getTargetClass(self):
+        from pyramid_mailer.delivery import BatchMailDelivery
+        return BatchMailDelivery
+
+    def _makeOne(self, mailer=None):
+        if mailer is None:
+            mailer = DummyBatchMailer()
+        return self._getTargetClass()(mailer, transaction_manager=self.tm)
+
+    def _makeEnvelope(self, body='hello'):
+        from email.mime.text import MIMEText
+        return ('sender@example.com', ['a@example.com'], MIMEText(body))
+
+    def test_default_transaction_manager(self):
+        import transaction
+        delivery = self._getTargetClass()(DummyBatchMailer())
+        self.assertIs(delivery.transaction_manager, transaction.manager)
+
+    def test_send_many_on_commit(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        ids = delivery.send_many([self._makeEnvelope('one'),
+                                  self._makeEnvelope('two')])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(delivery.mailer.batches, [])
+        self.tm.commit()
+        self.assertEqual(len(delivery.mailer.batches), 1)
+        self.assertEqual(len(delivery.mailer.batches[0]), 2)
+
+    def test_send_many_on_abort(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send_many([self._makeEnvelope()])
+        self.tm.abort()
+        self.assertEqual(delivery.mailer.batches, [])
+
+    def test_send(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        envelope = self._makeEnvelope()
+        messageid = delivery.send(*envelope)
+        self.assertEqual(envelope[2]['Message-Id'], messageid)
+        self.tm.commit()
+        self.assertEqual(delivery.mailer.batches, [[envelope]])
+
+
+    def test_coalesces_transaction(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope('one'))
+        delivery.send_many([self._makeEnvelope('two'),
+                            self._makeEnvelope('three')])
+        self.tm.commit()
+        self.assertEqual(len(delivery.mailer.batches), 1)
+        self.assertEqual(len(delivery.mailer.batches[0]), 3)
+
+    def test_separate_transactions(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope('one'))
+        self.tm.commit()
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope('two'))
+        self.tm.commit()
+        self.assertEqual(len(delivery.mailer.batches), 2)
+
+    def test_failure_raised_after_batch(self):
+        error = ValueError()
+        delivery = self._makeOne(DummyBatchMailer(results=[{}, error]))
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope('one'))
+        delivery.send(*self._makeEnvelope('two'))
+        self.assertRaises(ValueError, self.tm.commit)
+        self.assertEqual(len(delivery.mailer.batches[0]), 2)
+
+
+class TestBackgroundMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        self.tm = transaction.TransactionManager()
+
+    def _getTargetClass(self):
+        from pyramid_mailer.delivery import BackgroundMailDelivery
+        return BackgroundMailDelivery
+
+    def _makeOne(self, mailer=None):
+        if mailer is None:
+            mailer = DummyBatchMailer()
+        return self._getTargetClass()(
+            mailer, DummyBackgroundSender(), transaction_manager=self.tm)
+
+    def _makeEnvelope(self, body='hello'):
+        from email.mime.text import MIMEText
+        return ('sender@example.com', ['a@example.com'], MIMEText(body))
+
+    def test_submits_on_commit(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope('one'))
+        delivery.send(*self._makeEnvelope('two'))
+        self.assertEqual(delivery.background_sender.submitted, [])
+        self.tm.commit()
+        self.assertEqual(len(delivery.background_sender.submitted), 1)
+        self.assertEqual(delivery.mailer.batches, [])
+        func, args = delivery.background_sender.submitted[0]
+        envelopes = args[0]
+        self.assertEqual(len(envelopes), 2)
+        self.assertIsInstance(envelopes[0][2], bytes)
+        self.assertIn(b'Message-Id', envelopes[0][2])
+        func(*args)
+        self.assertEqual(delivery.mailer.batches, [envelopes])
+
+    def test_nothing_on_abort(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope())
+        self.tm.abort()
+        self.assertEqual(delivery.background_sender.submitted, [])
+
+    def test_errors_logged(self):
+        import logging
+        error = ValueError('boom')
+        delivery = self._makeOne(DummyBatchMailer(results=[error]))
+        records = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        handler = Handler()
+        logger = logging.getLogger('pyramid_mailer.delivery')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.tm.begin()
+        delivery.send(*self._makeEnvelope())
+        self.tm.commit()
+        func, args = delivery.background_sender.submitted[0]
+        self.assertEqual(func(*args), [error])
+        self.assertEqual(len(records), 1)
+        self.assertIn('a@example.com', records[0].getMessage())
+
+
+class TestStreamingQueuedMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        self.tm = transaction.TransactionManager()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.queue_path = os.path.join(tempdir, 'queue')
+
+    def _getTargetClass(self):
+        from pyramid_mailer.delivery import StreamingQueuedMailDelivery
+        return StreamingQueuedMailDelivery
+
+    def _makeOne(self):
+        return self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm)
+
+    def _makeMessage(self, **kw):
+        import io
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        return Message(
+            subject='testing', sender='sender@example.com',
+            recipients=['a@example.com'], body='hello',
+            attachments=[Attachment('f.bin', 'application/octet-stream',
+                                    io.BytesIO(b'data'))],
+            **kw)
+
+    def _listdir(self, name):
+        import os
+        return os.listdir(os.path.join(self.queue_path, name))
+
+    def _parse(self, filename):
+        import os
+        from email import message_from_binary_file
+        path = os.path.join(self.queue_path, 'new', filename)
+        with open(path, 'rb') as fp:
+            return message_from_binary_file(fp)
+
+    def test_send_on_commit(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        messageid = delivery.send(
+            'sender@example.com', ['a@example.com', 'b@example.com'],
+            self._makeMessage())
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(len(self._listdir('tmp')), 1)
+        self.tm.commit()
+        self.assertEqual(self._listdir('tmp'), [])
+        [filename] = self._listdir('new')
+        queued = self._parse(filename)
+        self.assertEqual(queued['Message-Id'], messageid)
+        self.assertTrue(queued['Date'])
+        self.assertEqual(_decode(queued['X-Actually-From']),
+                         'sender@example.com')
+        self.assertEqual(_decode(queued['X-Actually-To']),
+                         'a@example.com,b@example.com')
+        self.assertEqual(queued.get_payload(1).get_payload(decode=True),
+                         b'data')
+
+    def test_send_on_abort(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.abort()
+        self.assertEqual(self._listdir('tmp'), [])
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_send_keeps_message_id(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        message = self._makeMessage(
+            extra_headers={'Message-Id': '<abc@example.com>'})
+        messageid = delivery.send(
+            'sender@example.com', ['a@example.com'], message)
+        self.tm.commit()
+        self.assertEqual(messageid, '<abc@example.com>')
+        [filename] = self._listdir('new')
+        self.assertEqual(self._parse(filename)['Message-Id'],
+                         '<abc@example.com>')
+
+    def test_send_write_error(self):
+        delivery = self._makeOne()
+        message = self._makeMessage()
+        def iter_bytes(headers=()):
+            yield b'Subject: half\r\n'
+            raise IOError('disk full')
+        message.iter_bytes = iter_bytes
+        self.tm.begin()
+        self.assertRaises(IOError, delivery.send,
+                          'sender@example.com', ['a@example.com'], message)
+        self.assertEqual(self._listdir('tmp'), [])
+
+    def test_send_sharded(self):
+        import os
+        from pyramid_mailer.queue import shard_index
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm, shards=4)
+        self.tm.begin()
+        messageids = [
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage())
+            for index in range(8)]
+        self.tm.commit()
+        self.assertEqual(sorted(os.listdir(self.queue_path)),
+                         sorted(set('%02d' % shard_index(messageid, 4)
+                                    for messageid in messageids)))
+        count = sum(
+            len(os.listdir(os.path.join(self.queue_path, shard, 'new')))
+            for shard in os.listdir(self.queue_path))
+        self.assertEqual(count, 8)
+
+    def test_send_sharded_email_message(self):
+        import os
+        from pyramid_mailer.queue import shard_index
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm, shards=4)
+        message = self._makeMessage().to_message()
+        self.tm.begin()
+        messageid = delivery.send(
+            'sender@example.com', ['a@example.com'], message)
+        self.tm.commit()
+        shard = '%02d' % shard_index(messageid, 4)
+        self.assertEqual(os.listdir(self.queue_path), [shard])
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.queue_path, shard, 'new'))), 1)
+
+    def test_send_email_message(self):
+        from email.mime.text import MIMEText
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      MIMEText('hello'))
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 1)
+
+    def test_send_group_commit(self):
+        import os
+        committer = DummyCommitter()
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm,
+            committer=committer)
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage().to_message())
+        self.assertEqual(committer.submitted, [])
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 2)
+        files, directories = committer.submitted
+        tmp = os.path.join(self.queue_path, 'tmp')
+        self.assertEqual(len(files), 2)
+        self.assertEqual({os.path.dirname(path) for path in files}, {tmp})
+        self.assertEqual(directories, (os.path.join(self.queue_path, 'new'),))
+
+    def test_send_group_commit_directories(self):
+        import os
+        import time
+        committer = DummyCommitter()
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm,
+            committer=committer)
+        self.tm.begin()
+        for index in range(3):
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage())
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(), not_before=time.time() + 3600)
+        self.tm.commit()
+        files, (new, scheduled) = committer.submitted
+        self.assertEqual(len(files), 4)
+        self.assertEqual(new, os.path.join(self.queue_path, 'new'))
+        self.assertTrue(scheduled.startswith(
+            os.path.join(self.queue_path, 'scheduled')))
+
+    def test_send_not_before(self):
+        import os
+        import time
+        delivery = self._makeOne()
+        not_before = time.time() + 3600
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(), not_before=not_before)
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage().to_message(), not_before=not_before)
+        self.tm.commit()
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('tmp'), [])
+        [bucket] = self._listdir('scheduled')
+        self.assertEqual(bucket, '%d' % (not_before // 60))
+        names = os.listdir(os.path.join(self.queue_path, 'scheduled', bucket))
+        self.assertEqual(len(names), 2)
+        for name in names:
+            self.assertTrue(name.startswith('%d-' % (not_before + 1)))
+
+    def test_send_not_before_past(self):
+        import time
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(), not_before=time.time() - 1)
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 1)
+
+    def test_send_not_before_bucket_removed(self):
+        import os
+        import shutil
+        import time
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(), not_before=time.time() + 3600)
+        shutil.rmtree(os.path.join(self.queue_path, 'scheduled'))
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('scheduled')), 1)
+
+    def test_send_name_clash(self):
+        from pyramid_mailer import delivery as module
+
+        class DummyRandom(object):
+            values = [1, 1, 2]
+
+            def randrange(self, stop):
+                return self.values.pop(0)
+
+        class DummyTime(object):
+            def time(self):
+                return 1000.0
+
+        delivery = self._makeOne()
+        patched = module.random, module.time
+        module.random, module.time = DummyRandom(), DummyTime()
+        try:
+            self.tm.begin()
+            for index in range(2):
+                delivery.send('sender@example.com', ['a@example.com'],
+                              self._makeMessage())
+        finally:
+            module.random, module.time = patched
+        self.tm.commit()
+        names = self._listdir('new')
+        self.assertEqual(len(names), 2)
+        self.assertEqual(sorted(name.rpartition('.')[2] for name in names),
+                         ['1', '2'])
+
+    def _makeDedup(self):
+        import os
+        from pyramid_mailer.queue import DedupIndex
+        return DedupIndex(os.path.join(self.queue_path, 'ids'), 3600)
+
+    def test_send_dedup(self):
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm,
+            dedup=self._makeDedup())
+        headers = {'Message-Id': '<abc@example.com>'}
+        for attempt in range(2):
+            self.tm.begin()
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage(extra_headers=headers))
+            message = self._makeMessage(extra_headers=headers).to_message()
+            delivery.send('sender@example.com', ['a@example.com'], message)
+            self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 1)
+        self.assertEqual(self._listdir('tmp'), [])
+
+    def test_send_dedup_after_abort(self):
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm,
+            dedup=self._makeDedup())
+        headers = {'Message-Id': '<abc@example.com>'}
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(extra_headers=headers))
+        self.tm.abort()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(extra_headers=headers))
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 1)
+
+    def test_send_dedup_generated_ids(self):
+        dedup = self._makeDedup()
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm, dedup=dedup)
+        self.tm.begin()
+        ids = [
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage()),
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage().to_message()),
+        ]
+        self.tm.commit()
+        self.assertEqual(len(self._listdir('new')), 2)
+        for messageid in ids:
+            self.assertFalse(messageid in dedup)
+
+    def test_send_compressed(self):
+        import gzip
+        import os
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm, compression='zlib')
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage().to_message())
+        self.tm.commit()
+        for filename in self._listdir('new'):
+            path = os.path.join(self.queue_path, 'new', filename)
+            with gzip.open(path) as fp:
+                data = fp.read()
+            self.assertTrue(data.startswith(b'X-Actually-From: ') or
+                            b'\nX-Actually-From: ' in data)
+        self.assertEqual(len(self._listdir('new')), 2)
+
+    def test_send_counters(self):
+        import os
+        from pyramid_mailer.queue import QueueCounters
+        counters = QueueCounters(os.path.join(self.queue_path, 'counts.db'))
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm, counters=counters)
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.abort()
+        self.assertEqual(counters.stats()['queued'], 0)
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.commit()
+        self.assertEqual(counters.stats()['queued'], 1)
+
+    def test_send_group_commit_abort(self):
+        committer = DummyCommitter()
+        delivery = self._getTargetClass()(
+            self.queue_path, transaction_manager=self.tm,
+            committer=committer)
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.abort()
+        self.assertEqual(self._listdir('tmp'), [])
+        self.assertEqual(committer.submitted, [])
+
+
+class DummyCommitter(object):
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, item):
+        self.submitted.append(item)
+
+
+def _decode(value):
+    from email.header import decode_header
+    [(value, charset)] = decode_header(value)
+    return value.decode(charset)
+
+
+class DummyBackgroundSender(object):
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, func, *args):
+        self.submitted.append((func, args))
+
+
+class DummyBatchMailer(object):
+
+    def __init__(self, results=None):
+        self.batches = []
+        self.results = results
+
+    def send_many(self, envelopes):
+        self.batches.append(list(envelopes))
+        if self.results is not None:
+            return self.results
+        return [{} for envelope in envelopes]
+
+
+class TestSQLiteQueuedMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from pyramid_mailer.queue import SQLiteQueue
+        self.tm = transaction.TransactionManager()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.queue = SQLiteQueue(os.path.join(tempdir, 'queue.db'))
+
+    def _getTargetClass(self):
+        from pyramid_mailer.delivery import SQLiteQueuedMailDelivery
+        return SQLiteQueuedMailDelivery
+
+    def _makeOne(self):
+        return self._getTargetClass()(self.queue, transaction_manager=self.tm)
+
+    def _makeMessage(self, **kw):
+        from pyramid_mailer.message import Message
+        return Message(
+            subject='testing', sender='sender@example.com',
+            recipients=['a@example.com'], body='hello', **kw)
+
+    def test_send_not_before(self):
+        import time
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage(), not_before=time.time() + 3600)
+        self.tm.commit()
+        self.assertEqual(list(self.queue), [])
+        count = self.queue.db.execute(
+            'SELECT COUNT(*) FROM messages').fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_send_on_commit(self):
+        from email import message_from_bytes
+        delivery = self._makeOne()
+        self.tm.begin()
+        messageids = [
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage()),
+            delivery.send('sender@example.com', ['b@example.com'],
+                          self._makeMessage().to_message()),
+            ]
+        self.assertEqual(list(self.queue), [])
+        self.tm.commit()
+        claimed = self.queue.claim_many(list(self.queue))
+        self.assertEqual(len(claimed), 2)
+        for rowid, messageid, toaddr in zip(
+                claimed, messageids, ['a@example.com', 'b@example.com']):
+            fromaddr, toaddrs, data = self.queue.read(rowid)
+            self.assertEqual(fromaddr, 'sender@example.com')
+            self.assertEqual(toaddrs, (toaddr,))
+            queued = message_from_bytes(data)
+            # encode_message folds long headers of email messages
+            self.assertEqual(queued['Message-Id'].strip(), messageid)
+            self.assertTrue(queued['Date'])
+            self.assertEqual(queued['X-Actually-To'], None)
+        stored = self.queue.db.execute(
+            'SELECT message_id FROM messages ORDER BY id').fetchall()
+        self.assertEqual([row[0] for row in stored], messageids)
+
+    def test_send_on_abort(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.abort()
+        self.assertEqual(list(self.queue), [])
+
+    def test_send_dedup_generated_ids(self):
+        self.queue.dedup_ttl = 3600
+        delivery = self._makeOne()
+        self.tm.begin()
+        for attempt in range(2):
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage())
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage().to_message())
+            delivery.send('sender@example.com', ['a@example.com'],
+                          self._makeMessage(idempotency_key='reset:42'))
+        self.tm.commit()
+        self.assertEqual(len(list(self.queue)), 5)
+        ids = self.queue.db.execute('SELECT message_id FROM message_ids')
+        self.assertEqual([row[0] for row in ids],
+                         [self._makeMessage(
+                             idempotency_key='reset:42').message_id])
+
+    def test_send_compressed(self):
+        import lzma
+        delivery = self._getTargetClass()(
+            self.queue, transaction_manager=self.tm, compression='lzma')
+        self.tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'],
+                      self._makeMessage())
+        self.tm.commit()
+        [data] = [bytes(row[0]) for row in self.queue.db.execute(
+            'SELECT data FROM messages')]
+        [rowid] = self.queue.claim_many(list(self.queue))
+        self.assertEqual(self.queue.read(rowid)[2], lzma.decompress(data))
+
+    def test_send_keeps_message_id(self):
+        delivery = self._makeOne()
+        self.tm.begin()
+        messageid = delivery.send(
+            'sender@example.com', ['a@example.com'],
+            self._makeMessage(extra_headers={'Message-Id': '<1@example>'}))
+        self.tm.commit()
+        self.assertEqual(messageid, '<1@example>')
@@ -60,6 +60,25 @@ class Test_includeme(unittest.TestCase):
         self._do_includeme(config)
         self.assertEqual(registry.registered[IMailer].default_sender, 'sender')
 
+    def test_registers_shutdown(self):
+        import pyramid_mailer
+        from pyramid_mailer.interfaces import IMailer
+        registered = []
+        class DummyAtexit(object):
+            def register(self, func):
+                registered.append(func)
+        orig = pyramid_mailer.atexit
+        pyramid_mailer.atexit = DummyAtexit()
+        try:
+            registry = DummyRegistry()
+            config = DummyConfig(registry, {'mail.async_workers': '2'})
+            self._do_includeme(config)
+        finally:
+            pyramid_mailer.atexit = orig
+        mailer = registry.registered[IMailer]
+        self.assertEqual(registered, [mailer.shutdown])
+        mailer.shutdown()
+
 class TestFunctional(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
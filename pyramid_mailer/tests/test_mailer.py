@@ -81,6 +81,21 @@ class DebugMailerTests(_Base):
         with open(os.path.join(self._tempdir, files[0]), 'r') as msg:
             self.assertTrue('recipient@example.com' in msg.read())
 
+    def test_send_many(self):
+        mailer = self._makeOne()
+        mailer.send_many([_makeMessage(), _makeMessage()])
+        files = self._listFiles()
+        self.assertEqual(len(files), 2)
+
+    def test_send_to_queue(self):
+        import datetime
+        mailer = self._makeOne()
+        mailer.send_to_queue(_makeMessage())
+        mailer.send_to_queue(_makeMessage(), priority='urgent',
+                             not_before=datetime.datetime.now())
+        files = self._listFiles()
+        self.assertEqual(len(files), 2)
+
     def test_default_sender(self):
         mailer = self._makeOne()
         msg = _makeMessage(sender=None)
@@ -134,6 +149,19 @@ class DummyMailerTests(unittest.TestCase):
         mailer.send_to_queue(msg)
         self.assertEqual(mailer.queue, [msg])
 
+    def test_send_many(self):
+        mailer = self._makeOne()
+        msgs = [_makeMessage(), _makeMessage()]
+        mailer.send_many(msgs)
+        self.assertEqual(mailer.outbox, msgs)
+
+    def test_send_many_immediately(self):
+        mailer = self._makeOne()
+        msgs = [_makeMessage(), _makeMessage()]
+        result = mailer.send_many_immediately(iter(msgs))
+        self.assertEqual(mailer.outbox, msgs)
+        self.assertEqual(result, [{}, {}])
+
     def test_send_sendmail(self):
         mailer = self._makeOne()
         msg = _makeMessage()
@@ -301,6 +329,79 @@ class MailerTests(_Base):
         self.assertEqual(mailer.direct_delivery.mailer.username, None)
         self.assertEqual(mailer.direct_delivery.mailer.password, None)
 
+    def test_from_settings_with_pool(self):
+        from pyramid_mailer.pool import SMTPConnectionPool
+        settings = {'mymail.host': 'my.server.com',
+                    'mymail.pool_size': '3',
+                    'mymail.pool_idle_timeout': '30'}
+        mailer = self._getTargetClass().from_settings(settings,
+                                                      prefix='mymail.')
+        pool = mailer.smtp_mailer
+        self.assertTrue(isinstance(pool, SMTPConnectionPool))
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.idle_timeout, 30)
+        self.assertEqual(pool.mailer.hostname, 'my.server.com')
+        self.assertIs(mailer.direct_delivery.mailer, pool)
+
+    def test_from_settings_with_hosts(self):
+        from pyramid_mailer.pool import MultiHostPool
+        settings = {'mymail.hosts': 'one.example.com two.example.com:2525\n'
+                                    '[::1]:26',
+                    'mymail.port': '587',
+                    'mymail.username': 'user',
+                    'mymail.password': 'secret',
+                    'mymail.pool_size': '3',
+                    'mymail.hosts_strategy': 'least_outstanding',
+                    'mymail.hosts_max_failures': '5',
+                    'mymail.hosts_retry_after': '7.5'}
+        mailer = self._getTargetClass().from_settings(settings,
+                                                      prefix='mymail.')
+        pool = mailer.smtp_mailer
+        self.assertTrue(isinstance(pool, MultiHostPool))
+        self.assertEqual(
+            [(m.hostname, m.port) for m in pool.mailers],
+            [('one.example.com', 587), ('two.example.com', 2525),
+             ('::1', 26)])
+        self.assertEqual(pool.mailers[1].username, 'user')
+        self.assertEqual(pool.hosts[0].pool.size, 3)
+        self.assertEqual(pool.strategy, 'least_outstanding')
+        self.assertEqual(pool.max_failures, 5)
+        self.assertEqual(pool.retry_after, 7.5)
+        self.assertIs(mailer.smtp_pool, pool)
+
+    def test_hosts_ssl(self):
+        from pyramid_mailer.mailer import SMTP_SSLMailer
+        mailer = self._makeOne(hosts=['a.example.com', 'b.example.com'],
+                               ssl=True, port=465)
+        self.assertEqual(mailer.smtp_mailer.hosts[0].pool.size, 0)
+        for smtp_mailer in mailer.smtp_mailer.mailers:
+            self.assertTrue(isinstance(smtp_mailer, SMTP_SSLMailer))
+            self.assertEqual(smtp_mailer.port, 465)
+
+    def test_send_immediately_hosts(self):
+        import socket
+        mailer = self._makeOne(hosts=['localhost:28322', 'localhost:28323'])
+        msg = _makeMessage()
+        self.assertRaises(socket.error,
+                          mailer.send_immediately,
+                          msg)
+        self.assertEqual(
+            [host['failures'] for host in mailer.smtp_mailer.status()],
+            [1, 1])
+
+    def test_bind_shares_pool(self):
+        mailer = self._makeOne(pool_size=2)
+        result = mailer.bind(default_sender='foo')
+        self.assertIs(result.smtp_mailer, mailer.smtp_mailer)
+
+    def test_send_immediately_pooled(self):
+        import socket
+        mailer = self._makeOne(host='localhost', port='28322', pool_size=2)
+        msg = _makeMessage()
+        self.assertRaises(socket.error,
+                          mailer.send_immediately,
+                          msg)
+
     def test_send_immediately(self):
         import socket
         mailer = self._makeOne(host='localhost', port='28322')
@@ -309,6 +410,54 @@ class MailerTests(_Base):
                           mailer.send_immediately,
                           msg)
 
+    def test_send_immediately_uses_session_handling(self):
+        from pyramid_mailer.pool import SMTPConnectionPool
+        mailer = self._makeOne()
+        sent = []
+        def send(pool, *args):
+            sent.append((pool, args))
+            return {}
+        orig = SMTPConnectionPool.send
+        SMTPConnectionPool.send = send
+        try:
+            result = mailer.send_immediately(_makeMessage())
+        finally:
+            SMTPConnectionPool.send = orig
+        self.assertEqual(result, {})
+        pool = sent[0][0]
+        self.assertIs(pool.mailer, mailer.smtp_mailer)
+        self.assertEqual(pool.size, 0)
+
+    def test_send_immediately_streams_message(self):
+        from pyramid_mailer.pool import SMTPConnectionPool
+        mailer = self._makeOne(default_sender='foo@example.com')
+        sent = []
+        def send(pool, *args):
+            sent.append(args)
+            return {}
+        orig = SMTPConnectionPool.send
+        SMTPConnectionPool.send = send
+        msg = _makeMessage(sender=None)
+        try:
+            mailer.send_immediately(msg)
+        finally:
+            SMTPConnectionPool.send = orig
+        self.assertEqual(sent, [('foo@example.com', msg.send_to, msg)])
+
+    def test_send_immediately_invalid_message(self):
+        from pyramid_mailer.exceptions import InvalidMessage
+        mailer = self._makeOne()
+        msg = _makeMessage(recipients=[])
+        self.assertRaises(InvalidMessage, mailer.send_immediately, msg)
+
+    def test_send_immediately_custom_mailer_gets_email_message(self):
+        from email.message import Message
+        mailer = self._makeOne()
+        smtp_mailer = DummyMailer()
+        mailer.smtp_mailer = smtp_mailer
+        mailer.send_immediately(_makeMessage())
+        self.assertTrue(isinstance(smtp_mailer.out[0][2], Message))
+
     def test_send_immediately_and_fail_silently(self):
         mailer = self._makeOne(host='localhost', port='28322')
         msg = _makeMessage()
@@ -336,6 +485,502 @@ class MailerTests(_Base):
         mailer.send(msg)
         self.assertEqual(len(smtp_mailer.out), 0)
 
+    def test_send_many(self):
+        import transaction
+        tm = transaction.TransactionManager()
+        mailer = self._makeOne(transaction_manager=tm)
+        pool = DummyMailer()
+        mailer.batch_delivery.mailer = pool
+        tm.begin()
+        ids = mailer.send_many([_makeMessage(), _makeMessage()])
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(pool.batches, [])
+        tm.commit()
+        self.assertEqual(len(pool.batches), 1)
+        self.assertEqual(len(pool.batches[0]), 2)
+
+    def test_send_many_immediately(self):
+        mailer = self._makeOne()
+        pool = DummyMailer()
+        mailer.smtp_pool = pool
+        result = mailer.send_many_immediately(
+            [_makeMessage(), _makeMessage()])
+        self.assertEqual(result, [{}, {}])
+        self.assertEqual(len(pool.batches[0]), 2)
+
+    def test_smtp_pool_without_pool_size(self):
+        from pyramid_mailer.pool import SMTPConnectionPool
+        mailer = self._makeOne()
+        self.assertTrue(isinstance(mailer.smtp_pool, SMTPConnectionPool))
+        self.assertEqual(mailer.smtp_pool.size, 0)
+        self.assertIs(mailer.smtp_pool.mailer, mailer.smtp_mailer)
+
+    def test_send_batch(self):
+        import transaction
+        tm = transaction.TransactionManager()
+        mailer = self._makeOne(transaction_manager=tm,
+                               transactional_delivery='batch')
+        pool = DummyMailer()
+        mailer.batch_delivery.mailer = pool
+        tm.begin()
+        mailer.send(_makeMessage())
+        mailer.send(_makeMessage())
+        tm.commit()
+        self.assertEqual(len(pool.batches), 1)
+        self.assertEqual(len(pool.batches[0]), 2)
+
+    def test_send_background(self):
+        import transaction
+        tm = transaction.TransactionManager()
+        mailer = self._makeOne(transaction_manager=tm, async_workers=1,
+                               transactional_delivery='background')
+        pool = DummyMailer()
+        mailer.background_delivery.mailer = pool
+        tm.begin()
+        mailer.send(_makeMessage())
+        mailer.send(_makeMessage())
+        tm.commit()
+        mailer.shutdown()
+        self.assertEqual(len(pool.batches), 1)
+        self.assertEqual(len(pool.batches[0]), 2)
+
+    def test_send_background_requires_async_workers(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          transactional_delivery='background')
+
+    def test_send_queue(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               transactional_delivery='queue')
+        tm.begin()
+        mailer.send(_makeMessage())
+        tm.commit()
+        self.assertEqual(len(os.listdir(os.path.join(test_queue, 'new'))), 1)
+
+    def test_send_to_queue_streams_attachment(self):
+        import io
+        import os
+        import transaction
+        from email import message_from_binary_file
+        from pyramid_mailer.message import Attachment
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue)
+        data = os.urandom(100000)
+        msg = _makeMessage(attachments=[
+            Attachment('foo.bin', 'application/octet-stream',
+                       io.BytesIO(data))])
+        tm.begin()
+        mailer.send_to_queue(msg)
+        tm.commit()
+        [filename] = os.listdir(os.path.join(test_queue, 'new'))
+        with open(os.path.join(test_queue, 'new', filename), 'rb') as fp:
+            queued = message_from_binary_file(fp)
+        self.assertEqual(queued.get_payload(1).get_payload(decode=True), data)
+
+    def test_send_to_queue_sharded(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               queue_shards=4)
+        self.assertEqual(mailer.queue_delivery.shards, 4)
+        self.assertEqual(mailer.bind(default_sender='x').queue_shards, 4)
+        tm.begin()
+        mailer.send_to_queue(_makeMessage())
+        tm.commit()
+        [shard] = os.listdir(test_queue)
+        self.assertEqual(
+            len(os.listdir(os.path.join(test_queue, shard, 'new'))), 1)
+
+    def test_from_settings_queue_shards(self):
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': '/tmp', 'mail.queue_shards': '16'})
+        self.assertEqual(mailer.queue_shards, 16)
+        self.assertEqual(mailer.queue_delivery.shards, 16)
+
+    def test_send_to_queue_sqlite(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=path,
+                               queue_backend='sqlite')
+        bound = mailer.bind(default_sender='x')
+        self.assertTrue(bound.sqlite_queue is mailer.sqlite_queue)
+        tm.begin()
+        mailer.send_to_queue(_makeMessage())
+        bound.send_to_queue(_makeMessage())
+        tm.commit()
+        self.assertEqual(len(list(mailer.sqlite_queue)), 2)
+
+    def test_queue_backend_invalid(self):
+        self.assertRaises(ValueError, self._makeOne, queue_path='/tmp',
+                          queue_backend='redis')
+
+    def test_queue_backend_sqlite_no_shards(self):
+        self.assertRaises(ValueError, self._makeOne, queue_path='/tmp',
+                          queue_backend='sqlite', queue_shards=4)
+
+    def test_from_settings_queue_backend(self):
+        import os
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': path, 'mail.queue_backend': 'sqlite'})
+        self.assertEqual(mailer.queue_backend, 'sqlite')
+        self.assertEqual(mailer.sqlite_queue.path, path)
+
+    def test_send_to_queue_group_commit(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               queue_commit_latency=0.001)
+        committer = mailer.queue_committer
+        self.assertEqual(committer.max_latency, 0.001)
+        bound = mailer.bind(default_sender='x')
+        self.assertTrue(bound.queue_delivery.committer is committer)
+        tm.begin()
+        mailer.send_to_queue(_makeMessage())
+        tm.commit()
+        self.assertEqual(len(os.listdir(os.path.join(test_queue, 'new'))), 1)
+        # the file, then the directory it was moved to
+        self.assertEqual(committer.flushes, 2)
+
+    def test_send_to_queue_group_commit_once_per_transaction(self):
+        import os
+        import time
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               queue_commit_latency=0.2)
+        tm.begin()
+        for index in range(5):
+            mailer.send_to_queue(_makeMessage())
+        start = time.time()
+        tm.commit()
+        self.assertLess(time.time() - start, 0.9)
+        self.assertEqual(len(os.listdir(os.path.join(test_queue, 'new'))), 5)
+        self.assertEqual(mailer.queue_committer.flushes, 2)
+
+    def test_send_to_queue_sqlite_group_commit(self):
+        import os
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._makeOne(queue_path=path, queue_backend='sqlite',
+                               queue_commit_latency=0.001)
+        self.assertEqual(mailer.sqlite_queue.committer.max_latency, 0.001)
+        self.assertEqual(mailer.queue_committer, None)
+
+    def test_from_settings_queue_commit_latency(self):
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': '/tmp',
+             'mail.queue_commit_latency': '0.005'})
+        self.assertEqual(mailer.queue_commit_latency, 0.005)
+        self.assertEqual(mailer.queue_delivery.committer.max_latency, 0.005)
+
+    def test_send_to_queue_priority(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               queue_lanes=[('urgent', 10), ('bulk', 1)])
+        self.assertEqual(mailer.queue_lanes,
+                         [('urgent', 10), ('bulk', 1), ('default', 1)])
+        bound = mailer.bind(default_sender='x')
+        self.assertEqual(bound.queue_lanes, mailer.queue_lanes)
+        tm.begin()
+        mailer.send_to_queue(_makeMessage(), priority='urgent')
+        mailer.send_to_queue(_makeMessage(), priority='urgent')
+        bound.send_to_queue(_makeMessage(), priority='bulk')
+        mailer.send_to_queue(_makeMessage())
+        tm.commit()
+        self.assertEqual(
+            len(os.listdir(os.path.join(test_queue, '.urgent', 'new'))), 2)
+        self.assertEqual(
+            len(os.listdir(os.path.join(test_queue, '.bulk', 'new'))), 1)
+        self.assertEqual(len(os.listdir(os.path.join(test_queue, 'new'))), 1)
+
+    def test_send_to_queue_not_before(self):
+        import os
+        from datetime import datetime
+        from datetime import timedelta
+        from datetime import timezone
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue)
+        not_before = datetime.now(timezone.utc) + timedelta(hours=1)
+        tm.begin()
+        mailer.send_to_queue(_makeMessage(), not_before=not_before)
+        tm.commit()
+        self.assertEqual(os.listdir(os.path.join(test_queue, 'new')), [])
+        self.assertEqual(os.listdir(os.path.join(test_queue, 'scheduled')),
+                         ['%d' % (not_before.timestamp() // 60)])
+
+    def test_send_to_queue_dedup(self):
+        import os
+        import transaction
+        from pyramid_mailer.message import Message
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=test_queue,
+                               queue_dedup_ttl=3600)
+        bound = mailer.bind(default_sender='x')
+        self.assertEqual(bound.queue_dedup_ttl, 3600)
+        self.assertIs(bound.queue_dedup, mailer.queue_dedup)
+        self.assertIs(bound.queue_delivery.dedup, mailer.queue_dedup)
+        for attempt in range(2):
+            tm.begin()
+            bound.send_to_queue(Message(
+                subject='Reset', sender='shop@example.com',
+                recipients=['a@example.com'], body='body',
+                idempotency_key='reset:42'))
+            tm.commit()
+        self.assertEqual(len(os.listdir(os.path.join(test_queue, 'new'))), 1)
+
+    def test_send_to_queue_sqlite_dedup(self):
+        import os
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': path, 'mail.queue_backend': 'sqlite',
+             'mail.queue_dedup_ttl': '86400'})
+        self.assertEqual(mailer.queue_dedup_ttl, 86400)
+        self.assertEqual(mailer.sqlite_queue.dedup_ttl, 86400)
+
+    def test_send_to_queue_compressed(self):
+        import os
+        import transaction
+        from pyramid_mailer.queue import MaildirQueue
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': test_queue,
+             'mail.queue_compression': 'lzma'})
+        bound = mailer.bind(transaction_manager=tm)
+        self.assertEqual(bound.queue_compression, 'lzma')
+        self.assertEqual(bound.queue_delivery.compression, 'lzma')
+        tm.begin()
+        bound.send_to_queue(_makeMessage())
+        tm.commit()
+        queue = MaildirQueue(test_queue)
+        [name] = list(queue)
+        fromaddr, toaddrs, message = queue.read(queue.claim(name))
+        self.assertEqual(toaddrs, ('tester@example.com',))
+        self.assertTrue(b'Subject: ' in message)
+
+    def test_send_to_queue_sqlite_compressed(self):
+        import os
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._makeOne(queue_path=path, queue_backend='sqlite',
+                               queue_compression='zlib')
+        self.assertEqual(mailer.queue_delivery.compression, 'zlib')
+
+    def test_invalid_queue_compression(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          queue_path=self._makeTempdir(),
+                          queue_compression='bzip2')
+
+    def test_queue_stats(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': test_queue, 'mail.queue_counters': 'true',
+             'mail.queue_lanes': 'urgent:5'})
+        bound = mailer.bind(transaction_manager=tm)
+        self.assertTrue(bound.queue_counters)
+        self.assertTrue(bound.lane_counters is mailer.lane_counters)
+        tm.begin()
+        bound.send_to_queue(_makeMessage(), priority='urgent')
+        bound.send_to_queue(_makeMessage())
+        bound.send_to_queue(_makeMessage())
+        tm.commit()
+        self.assertTrue(os.path.exists(os.path.join(test_queue, 'counts.db')))
+        stats = mailer.queue_stats()
+        self.assertEqual(stats['urgent']['queued'], 1)
+        self.assertEqual(stats['default']['queued'], 2)
+
+    def test_queue_stats_sqlite(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=path,
+                               queue_backend='sqlite')
+        tm.begin()
+        mailer.send_to_queue(_makeMessage())
+        tm.commit()
+        self.assertEqual(mailer.queue_stats()['default']['depth'], 1)
+
+    def test_queue_stats_no_queue_path(self):
+        self.assertRaises(RuntimeError, self._makeOne().queue_stats)
+
+    def test_send_to_queue_unknown_priority(self):
+        mailer = self._makeOne(queue_path=self._makeTempdir())
+        self.assertRaises(ValueError, mailer.send_to_queue, _makeMessage(),
+                          priority='urgent')
+
+    def test_send_to_queue_sqlite_priority(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        path = os.path.join(self._makeTempdir(), 'queue.db')
+        mailer = self._makeOne(transaction_manager=tm, queue_path=path,
+                               queue_backend='sqlite',
+                               queue_lanes=[('urgent', 10), ('default', 2)])
+        self.assertTrue(mailer.sqlite_queue is mailer.sqlite_queues['default'])
+        tm.begin()
+        mailer.send_to_queue(_makeMessage(), priority='urgent')
+        tm.commit()
+        self.assertEqual(len(list(mailer.sqlite_queues['urgent'])), 1)
+        self.assertEqual(list(mailer.sqlite_queue), [])
+
+    def test_queue_lanes_invalid(self):
+        self.assertRaises(ValueError, self._makeOne, queue_path='/tmp',
+                          queue_lanes=[('../x', 1)])
+        self.assertRaises(ValueError, self._makeOne, queue_path='/tmp',
+                          queue_lanes=[('urgent', 0)])
+
+    def test_from_settings_queue_lanes(self):
+        mailer = self._getTargetClass().from_settings(
+            {'mail.queue_path': '/tmp',
+             'mail.queue_lanes': 'urgent:10 default:5\nbulk'})
+        self.assertEqual(mailer.queue_lanes,
+                         [('urgent', 10), ('default', 5), ('bulk', 1)])
+
+    def test_send_queue_requires_queue_path(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          transactional_delivery='queue')
+
+    def test_invalid_transactional_delivery(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          transactional_delivery='bogus')
+
+    def test_from_settings_with_transactional_delivery(self):
+        settings = {'mail.transactional_delivery': 'batch'}
+        mailer = self._getTargetClass().from_settings(settings)
+        self.assertEqual(mailer.transactional_delivery, 'batch')
+        self.assertEqual(mailer.bind().transactional_delivery, 'batch')
+
+    def test_send_immediately_background(self):
+        from concurrent.futures import Future
+        mailer = self._makeOne(async_workers=2, async_queue_size=5)
+        self.assertEqual(mailer.background_sender.workers, 2)
+        self.assertEqual(mailer.background_sender.queue_size, 5)
+        smtp_mailer = DummyMailer()
+        mailer.smtp_mailer = smtp_mailer
+        future = mailer.send_immediately(_makeMessage())
+        self.assertTrue(isinstance(future, Future))
+        future.result()
+        mailer.shutdown()
+        self.assertEqual(len(smtp_mailer.out), 1)
+
+    def test_send_immediately_background_fail_silently(self):
+        import socket
+        mailer = self._makeOne(async_workers=1)
+        mailer.smtp_mailer = DummyMailer(socket.error())
+        future = mailer.send_immediately(_makeMessage(), True)
+        self.assertEqual(future.result(), None)
+        future = mailer.send_immediately(_makeMessage())
+        self.assertRaises(socket.error, future.result)
+        mailer.shutdown()
+
+    def test_send_many_immediately_background(self):
+        mailer = self._makeOne(async_workers=1)
+        pool = DummyMailer()
+        mailer.smtp_pool = pool
+        future = mailer.send_many_immediately([_makeMessage()])
+        self.assertEqual(future.result(), [{}])
+        mailer.shutdown()
+
+    def test_send_immediately_background_renders_first(self):
+        import threading
+        mailer = self._makeOne(async_workers=1)
+        self.addCleanup(mailer.shutdown)
+        smtp_mailer = DummyMailer()
+        mailer.smtp_mailer = smtp_mailer
+        busy = threading.Event()
+        mailer.background_sender.submit(busy.wait)
+        msg = _makeMessage(subject='first', body='first body')
+        future = mailer.send_immediately(msg)
+        msg.subject = 'second'
+        msg.body = 'second body'
+        busy.set()
+        future.result()
+        [(frm, to, sent)] = smtp_mailer.out
+        self.assertEqual(sent['Subject'], 'first')
+        self.assertIn('first body', sent.get_payload(decode=True).decode())
+
+    def test_send_immediately_background_pooled_renders_first(self):
+        import threading
+        from pyramid_mailer.pool import SMTPConnectionPool
+        class DummyPool(SMTPConnectionPool):
+            def __init__(self):
+                self.out = []
+            def send(self, frm, to, msg):
+                self.out.append((frm, to, msg))
+                return {}
+        mailer = self._makeOne(async_workers=1)
+        self.addCleanup(mailer.shutdown)
+        mailer.smtp_mailer = pool = DummyPool()
+        busy = threading.Event()
+        mailer.background_sender.submit(busy.wait)
+        msg = _makeMessage(subject='first')
+        future = mailer.send_immediately(msg)
+        msg.subject = 'second'
+        busy.set()
+        self.assertEqual(future.result(), {})
+        [(frm, to, sent)] = pool.out
+        self.assertIsInstance(sent, bytes)
+        self.assertIn(b'Subject: first', sent)
+
+    def test_send_many_immediately_background_renders_first(self):
+        import threading
+        mailer = self._makeOne(async_workers=1)
+        self.addCleanup(mailer.shutdown)
+        pool = DummyMailer()
+        mailer.smtp_pool = pool
+        busy = threading.Event()
+        mailer.background_sender.submit(busy.wait)
+        msg = _makeMessage(subject='first')
+        future = mailer.send_many_immediately([msg])
+        msg.subject = 'second'
+        busy.set()
+        future.result()
+        [[(frm, to, sent)]] = pool.batches
+        self.assertIn(b'Subject: first', sent)
+
+    def test_bind_shares_background_sender(self):
+        mailer = self._makeOne(async_workers=1)
+        result = mailer.bind(default_sender='foo')
+        self.assertIs(result.background_sender, mailer.background_sender)
+        mailer.shutdown()
+
+    def test_from_settings_with_async_workers(self):
+        settings = {'mail.async_workers': '3',
+                    'mail.async_queue_size': '10'}
+        mailer = self._getTargetClass().from_settings(settings)
+        self.assertEqual(mailer.background_sender.workers, 3)
+        self.assertEqual(mailer.background_sender.queue_size, 10)
+        mailer.shutdown()
+
+    def test_shutdown(self):
+        mailer = self._makeOne(pool_size=1)
+        pool = mailer.smtp_pool
+        conn = DummyConnection()
+        pool._idle.append((0, conn))
+        mailer.shutdown()
+        self.assertEqual(pool._idle, [])
+        self.assertTrue(conn.quitted)
+
     def test_send_to_queue_unconfigured(self):
         msg = _makeMessage()
         mailer = self._makeOne()
@@ -396,6 +1041,252 @@ class MailerTests(_Base):
         self.assertRaises(ValueError, mailer.send_immediately_sendmail, msg)
 
 
+    def _makeRouted(self, **kw):
+        self.relay = _makeDummyPool()
+        self.smtp = _makeDummyPool()
+        self.sendmail = DummyMailer()
+        mailer = self._makeOne(
+            smtp_mailer=self.smtp, sendmail_mailer=self.sendmail,
+            routes=[('example.com', 'smtp:relay.example.com'),
+                    ('*.example.com', 'smtp:relay.example.com'),
+                    ('example.org', 'sendmail'),
+                    ('example.net', 'default')],
+            route_mailers={'smtp:relay.example.com': self.relay}, **kw)
+        self.addCleanup(mailer.shutdown)
+        return mailer
+
+    def test_from_settings_with_routes(self):
+        from pyramid_mailer.pool import MultiHostPool
+        from pyramid_mailer.routing import RecipientRouter
+        settings = {'mail.routes': """
+                        example.com *.example.com = smtp:relay.local
+                        gmail.com = smtp:a.example.com,b.example.com:2525
+                        example.org = sendmail
+                    """,
+                    'mail.port': '587',
+                    'mail.username': 'user',
+                    'mail.password': 'secret'}
+        mailer = self._getTargetClass().from_settings(settings)
+        self.addCleanup(mailer.shutdown)
+        self.assertEqual(mailer.routes, [
+            ('example.com', 'smtp:relay.local'),
+            ('*.example.com', 'smtp:relay.local'),
+            ('gmail.com', 'smtp:a.example.com,b.example.com:2525'),
+            ('example.org', 'sendmail')])
+        self.assertTrue(isinstance(mailer.router, RecipientRouter))
+        pool = mailer.route_mailers['smtp:a.example.com,b.example.com:2525']
+        self.assertTrue(isinstance(pool, MultiHostPool))
+        self.assertEqual(
+            [(m.hostname, m.port, m.username) for m in pool.mailers],
+            [('a.example.com', 587, 'user'), ('b.example.com', 2525, 'user')])
+        self.assertEqual(len(mailer.route_mailers), 2)
+
+    def test_from_settings_with_invalid_route(self):
+        self.assertRaises(ValueError,
+                          self._getTargetClass().from_settings,
+                          {'mail.routes': 'example.com smtp:relay'})
+
+    def test_invalid_route_transport(self):
+        for transport in ('relay', 'smtp:', 'smtp:a,'):
+            self.assertRaises(ValueError, self._makeOne,
+                              routes=[('example.com', transport)])
+
+    def test_route_to_queue_without_queue_path(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          routes=[('example.com', 'queue')])
+
+    def test_route_to_unknown_lane(self):
+        import os
+        self.assertRaises(
+            ValueError, self._makeOne,
+            queue_path=os.path.join(self._makeTempdir(), 'queue'),
+            routes=[('example.com', 'queue:bulk')])
+
+    def test_send_immediately_routed(self):
+        mailer = self._makeRouted()
+        msg = _makeMessage(recipients=[
+            'a@example.com', 'b@mx.example.com', 'c@example.org',
+            'd@example.net', 'e@example.info'])
+        self.assertEqual(mailer.send_immediately(msg), {})
+        [(frm, to, data)] = self.relay.out
+        self.assertEqual(sorted(to), ['a@example.com', 'b@mx.example.com'])
+        self.assertIsInstance(data, bytes)
+        [(frm, to, sendmail_msg)] = self.sendmail.out
+        self.assertEqual(to, ['c@example.org'])
+        [(frm, to, smtp_data)] = self.smtp.out
+        self.assertEqual(sorted(to), ['d@example.net', 'e@example.info'])
+        self.assertIs(smtp_data, data)
+        messageid = sendmail_msg['Message-Id']
+        self.assertIn(b'Message-Id: ' + messageid.encode('ascii'), data)
+        self.assertEqual(msg.message_id, None)
+
+    def test_send_immediately_routed_new_id_per_send(self):
+        from email import message_from_bytes
+        mailer = self._makeRouted()
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        mailer.send_immediately(msg)
+        msg.recipients = ['c@example.com', 'd@example.info']
+        mailer.send_immediately(msg)
+        ids = [message_from_bytes(data)['Message-Id']
+               for frm, to, data in self.relay.out + self.smtp.out]
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(ids[0], ids[2])
+        self.assertEqual(ids[1], ids[3])
+        self.assertNotEqual(ids[0], ids[1])
+        self.assertEqual(msg.message_id, None)
+        self.assertEqual(msg.extra_headers, {})
+
+    def test_send_immediately_routed_keeps_message_id(self):
+        mailer = self._makeRouted()
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'],
+                           extra_headers={'Message-Id': '<id@example.com>'})
+        mailer.send_immediately(msg)
+        [(frm, to, data)] = self.relay.out
+        self.assertIn(b'Message-Id: <id@example.com>', data)
+
+    def test_send_immediately_routed_custom_mailer(self):
+        from email.message import Message
+        mailer = self._makeRouted()
+        mailer.smtp_mailer = smtp_mailer = DummyMailer()
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        mailer.send_immediately(msg)
+        [(frm, to, sent)] = smtp_mailer.out
+        self.assertIsInstance(sent, Message)
+        [(frm, to, data)] = self.relay.out
+        self.assertEqual(sent['Message-Id'],
+                         data.split(b'Message-Id: ')[1].split(b'\r\n')[0]
+                         .decode('ascii'))
+
+    def test_send_immediately_routed_custom_route_mailer(self):
+        from email.message import Message
+        mailer = self._makeRouted()
+        relay = DummyMailer()
+        mailer.route_mailers['smtp:relay.example.com'] = relay
+        mailer.send_immediately(_makeMessage(recipients=['a@example.com']))
+        [(frm, to, sent)] = relay.out
+        self.assertIsInstance(sent, Message)
+
+    def test_send_immediately_routed_default_only(self):
+        mailer = self._makeRouted()
+        msg = _makeMessage(recipients=['a@example.info'])
+        mailer.send_immediately(msg)
+        self.assertEqual([to for frm, to, m in self.smtp.out],
+                         [{'a@example.info'}])
+        self.assertEqual(msg.message_id, None)
+
+    def test_send_immediately_routed_single_group_streams(self):
+        mailer = self._makeRouted()
+        msg = _makeMessage(recipients=['a@example.com'])
+        mailer.send_immediately(msg)
+        self.assertEqual(self.relay.out,
+                         [('sender@example.com', ['a@example.com'], msg)])
+
+    def test_send_immediately_routed_refused(self):
+        mailer = self._makeRouted()
+        self.relay.send = lambda frm, to, msg: {to[0]: (550, 'unknown')}
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        self.assertEqual(mailer.send_immediately(msg),
+                         {'a@example.com': (550, 'unknown')})
+
+    def test_send_immediately_routed_error(self):
+        import socket
+        mailer = self._makeRouted()
+        self.relay.raises = socket.error('refused')
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        self.assertRaises(socket.error, mailer.send_immediately, msg)
+        self.assertEqual(len(self.smtp.out), 1)
+        self.assertEqual(
+            mailer.send_immediately(msg, fail_silently=True), {})
+
+    def test_send_immediately_routed_all_fail(self):
+        mailer = self._makeRouted()
+        self.relay.raises = ValueError('relay')
+        self.smtp.raises = ValueError('smtp')
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        self.assertRaises(ValueError, mailer.send_immediately, msg)
+
+    def test_send_immediately_routed_background(self):
+        mailer = self._makeRouted(async_workers=1)
+        msg = _makeMessage(recipients=['a@example.com', 'b@example.info'])
+        future = mailer.send_immediately(msg)
+        self.assertEqual(future.result(), {})
+        self.assertEqual(len(self.relay.out), 1)
+        self.assertEqual(len(self.smtp.out), 1)
+
+    def test_send_routed(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(
+            transaction_manager=tm, queue_path=test_queue,
+            smtp_mailer=DummyMailer(), sendmail_mailer=DummyMailer(),
+            routes=[('example.com', 'smtp:relay.example.com'),
+                    ('example.org', 'queue'),
+                    ('example.net', 'sendmail')],
+            route_mailers={'smtp:relay.example.com': DummyMailer()})
+        self.addCleanup(mailer.shutdown)
+        relay = mailer.route_mailers['smtp:relay.example.com']
+        msg = _makeMessage(recipients=[
+            'a@example.com', 'b@example.org', 'c@example.net',
+            'd@example.info'])
+        tm.begin()
+        messageid = mailer.send(msg)
+        self.assertEqual(relay.out, [])
+        tm.commit()
+        self.assertEqual(msg.message_id, None)
+        self.assertEqual(relay.out[0][2]['Message-Id'], messageid)
+        self.assertEqual(mailer.smtp_mailer.out[0][2]['Message-Id'],
+                         messageid)
+        self.assertEqual([to for frm, to, m in relay.out],
+                         [['a@example.com']])
+        self.assertEqual([to for frm, to, m in mailer.sendmail_mailer.out],
+                         [['c@example.net']])
+        self.assertEqual([to for frm, to, m in mailer.smtp_mailer.out],
+                         [['d@example.info']])
+        [filename] = os.listdir(os.path.join(test_queue, 'new'))
+        with open(os.path.join(test_queue, 'new', filename), 'rb') as fp:
+            queued = fp.read()
+        self.assertIn(b'b=40example=2Eorg', queued)
+        self.assertIn(messageid.encode('ascii'), queued)
+
+    def test_send_immediately_routed_to_queue(self):
+        import os
+        import transaction
+        tm = transaction.TransactionManager()
+        test_queue = os.path.join(self._makeTempdir(), 'test_queue')
+        mailer = self._makeOne(
+            transaction_manager=tm, queue_path=test_queue,
+            smtp_mailer=DummyMailer(), queue_lanes=[('bulk', 1)],
+            routes=[('example.org', 'queue:bulk')])
+        self.addCleanup(mailer.shutdown)
+        msg = _makeMessage(recipients=['a@example.org', 'b@example.info'])
+        tm.begin()
+        mailer.send_immediately(msg)
+        self.assertEqual([to for frm, to, m in mailer.smtp_mailer.out],
+                         [['b@example.info']])
+        self.assertEqual(
+            len(os.listdir(os.path.join(test_queue, '.bulk', 'new'))), 1)
+        tm.abort()
+        self.assertEqual(
+            len(os.listdir(os.path.join(test_queue, '.bulk', 'new'))), 1)
+
+    def test_bind_shares_routes(self):
+        mailer = self._makeRouted()
+        result = mailer.bind(default_sender='foo')
+        self.assertEqual(result.routes, mailer.routes)
+        self.assertIs(result.route_mailers, mailer.route_mailers)
+        self.assertIs(result.route_sender, mailer.route_sender)
+        self.assertIs(result.router, mailer.router)
+
+    def test_shutdown_closes_routes(self):
+        mailer = self._makeRouted()
+        closed = []
+        self.relay.close = lambda: closed.append(True)
+        mailer.shutdown()
+        self.assertEqual(closed, [True])
+        self.assertRaises(RuntimeError, mailer.route_sender.submit, len, ())
+
 class DummyConnectionFactory(object):
 
     def __init__(self, hostname, port, keyfile=None, certfile=None):
@@ -408,10 +1299,19 @@ class DummyConnectionFactory(object):
         self.debuglevel = level
 
 
+class DummyConnection(object):
+
+    quitted = False
+
+    def quit(self):
+        self.quitted = True
+
+
 class DummyMailer(object):
 
     def __init__(self, raises=None):
         self.out = []
+        self.batches = []
         self.raises = raises
 
     def send(self, frm, to, msg):
@@ -419,6 +1319,20 @@ class DummyMailer(object):
             raise self.raises
         self.out.append((frm, to, msg))
 
+    def send_many(self, envelopes):
+        self.batches.append(list(envelopes))
+        return [{} for envelope in envelopes]
+
+    def close(self):
+        pass
+
+
+def _makeDummyPool():
+    from pyramid_mailer.pool import SMTPConnectionPool
+    class DummyPool(DummyMailer, SMTPConnectionPool):
+        pass
+    return DummyPool()
+
 
 def _makeMessage(subject="testing",
                 sender="sender@example.com",
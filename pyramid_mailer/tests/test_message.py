@@ -23,6 +23,71 @@ class TestAttachment(unittest.TestCase):
         a = self._makeOne(data=StringIO("foo"))
         self.assertEqual(a.data, "foo")
 
+    def _makeFile(self, data, name='report.pdf'):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def test_data_from_path(self):
+        import mmap
+        a = self._makeOne(path=self._makeFile(b'foo'))
+        self.assertTrue(isinstance(a.data, mmap.mmap))
+        self.assertEqual(a.data[:], b'foo')
+
+    def test_data_from_pathlike(self):
+        import pathlib
+        a = self._makeOne(data=pathlib.Path(self._makeFile(b'foo')))
+        self.assertEqual(a.data[:], b'foo')
+        self.assertEqual(a.filename, None)
+
+    def test_data_from_path_shares_mapping(self):
+        path = self._makeFile(b'foo')
+        first = self._makeOne(path=path)
+        second = self._makeOne(path=path)
+        self.assertTrue(first.data is second.data)
+
+    def test_map_file(self):
+        from pyramid_mailer.message import map_file
+        path = self._makeFile(b'foo')
+        mapping = map_file(path)
+        self.assertEqual(mapping[:], b'foo')
+        self.assertTrue(map_file(path) is mapping)
+        self.assertEqual(map_file(self._makeFile(b'', 'empty.txt')), b'')
+
+    def test_data_from_mmap(self):
+        import mmap
+        with open(self._makeFile(b'foo'), 'rb') as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(mapping.close)
+        a = self._makeOne(data=mapping)
+        self.assertTrue(a.data is mapping)
+
+    def test_to_mailbase_path_guesses_content_type(self):
+        a = self._makeOne(path=self._makeFile(b'foo'))
+        base = a.to_mailbase()
+        self.assertEqual(a.filename, 'report.pdf')
+        self.assertEqual(
+            base.get_content_type(),
+            ('application/pdf', {'name':'report.pdf'})
+            )
+
+    def test_to_mailbase_path_text(self):
+        a = self._makeOne(path=self._makeFile(b'bar', 'notes.txt'))
+        base = a.to_mailbase()
+        self.assertEqual(
+            base.get_content_type(),
+            ('text/plain', {'name':'notes.txt', 'charset':'us-ascii'})
+            )
+
+    def test_to_mailbase_path_empty_file(self):
+        a = self._makeOne(path=self._makeFile(b''))
+        self.assertRaises(RuntimeError, a.to_mailbase)
+
     def test_to_mailbase_no_data(self):
         a = self._makeOne()
         self.assertRaises(RuntimeError, a.to_mailbase)
@@ -825,6 +890,463 @@ class TestMessage(unittest.TestCase):
         response = msg.to_message()
         self.assertTrue("THISSHOULDBEINMESSAGEBODY" in str(response))
 
+    def _makeCachedMessage(self, **kw):
+        from pyramid_mailer.message import Message
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            body="body",
+            **kw)
+        built = []
+        orig = msg._build_message
+
+        def _build_message():
+            built.append(True)
+            return orig()
+        msg._build_message = _build_message
+        return msg, built
+
+    def test_to_message_is_cached(self):
+        msg, built = self._makeCachedMessage()
+        first = msg.to_message()
+        second = msg.to_message()
+        self.assertEqual(len(built), 1)
+        self.assertEqual(str(first), str(second))
+        self.assertFalse(first is second)
+
+    def test_to_message_returns_copy(self):
+        msg, built = self._makeCachedMessage()
+        first = msg.to_message()
+        first['X-Mutated'] = 'yes'
+        self.assertEqual(msg.to_message()['X-Mutated'], None)
+
+    def test_to_message_rerendered_after_assignment(self):
+        msg, built = self._makeCachedMessage()
+        msg.to_message()
+        msg.subject = 'changed'
+        self.assertEqual(msg.to_message()['Subject'], 'changed')
+        self.assertEqual(len(built), 2)
+
+    def test_to_message_not_rerendered_for_same_value(self):
+        msg, built = self._makeCachedMessage()
+        msg.to_message()
+        msg.sender = msg.sender
+        msg.to_message()
+        self.assertEqual(len(built), 1)
+
+    def test_to_message_rerendered_after_add_recipient(self):
+        msg, built = self._makeCachedMessage()
+        msg.to_message()
+        msg.add_recipient('other@example.com')
+        self.assertTrue('other@example.com' in msg.to_message()['To'])
+        self.assertEqual(len(built), 2)
+
+    def test_to_message_rerendered_after_inplace_edits(self):
+        msg, built = self._makeCachedMessage()
+        msg.to_message()
+        msg.cc.append('cc@example.com')
+        self.assertEqual(msg.to_message()['Cc'], 'cc@example.com')
+        msg.extra_headers['X-Foo'] = 'bar'
+        self.assertEqual(msg.to_message()['X-Foo'], 'bar')
+        self.assertEqual(len(built), 3)
+
+    def test_to_message_rerendered_after_attachment_change(self):
+        from pyramid_mailer.message import Attachment
+        attachment = Attachment('foo.txt', 'text/plain', 'first')
+        msg, built = self._makeCachedMessage(attachments=[attachment])
+        msg.to_message()
+        attachment.filename = 'bar.txt'
+        self.assertTrue('bar.txt' in msg.as_string())
+        self.assertEqual(len(built), 2)
+
+    def test_as_string_is_cached(self):
+        msg, built = self._makeCachedMessage()
+        first = msg.as_string()
+        self.assertTrue(msg.as_string() is first)
+        self.assertEqual(first, str(msg.to_message()))
+        msg.body = 'other'
+        self.assertFalse(msg.as_string() is first)
+        self.assertEqual(len(built), 2)
+
+    def _makeStreamedMessage(self, data, content_type='application/pdf',
+                             **kw):
+        import io
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        attachment = Attachment('foo.pdf', content_type, io.BytesIO(data),
+                                **kw)
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            body="body",
+            attachments=[attachment],
+            )
+        return msg, attachment
+
+    def _normalize(self, data):
+        import re
+        return re.sub(b'=+[0-9a-f]+==', b'BOUNDARY', data)
+
+    def _assertEquivalent(self, first, second):
+        # compares the structure, headers and decoded payloads of two
+        # encoded messages
+        from email import message_from_bytes
+        from email.header import decode_header
+        def describe(data):
+            parts = []
+            for part in message_from_bytes(data).walk():
+                headers = sorted(
+                    (name, decode_header(value))
+                    for name, value in part.items()
+                    if name not in ('Content-Type', 'MIME-Version'))
+                params = [(name, value) for name, value
+                          in part.get_params([])
+                          if name not in ('boundary', 'charset')]
+                payload = charset = None
+                if not part.is_multipart():
+                    payload = part.get_payload(decode=True)
+                if part.get_content_maintype() == 'text':
+                    charset = part.get_content_charset()
+                parts.append((part.get_content_type(), params, charset,
+                              headers, payload))
+            return parts
+        self.assertEqual(describe(first), describe(second))
+
+    def test_iter_bytes_matches_to_message(self):
+        from repoze.sendmail.encoding import encode_message
+        data = os.urandom(100000)
+        msg, attachment = self._makeStreamedMessage(data)
+        streamed = b''.join(msg.iter_bytes([('Message-Id', '<1@example>')]))
+        attachment._data = data
+        expected = msg.to_message()
+        expected['Message-Id'] = '<1@example>'
+        self._assertEquivalent(streamed, encode_message(expected))
+
+    def test_iter_bytes_streams_in_chunks(self):
+        from pyramid_mailer.message import STREAM_CHUNK_SIZE
+        from pyramid_mailer.message import encoded_part_cache
+        data = b'x' * (STREAM_CHUNK_SIZE * 3 + 10)
+        # too big for the encoded part cache
+        self.addCleanup(setattr, encoded_part_cache, 'max_size',
+                        encoded_part_cache.max_size)
+        encoded_part_cache.max_size = STREAM_CHUNK_SIZE
+        msg, attachment = self._makeStreamedMessage(data)
+        chunks = list(msg.iter_bytes())
+        self.assertTrue(len(chunks) > 4)
+        self.assertTrue(max(len(chunk) for chunk in chunks)
+                        < STREAM_CHUNK_SIZE * 2)
+        self.assertTrue(hasattr(attachment._data, 'read'))
+
+    def test_iter_bytes_rereads_file(self):
+        msg, attachment = self._makeStreamedMessage(b'data')
+        first = self._normalize(b''.join(msg.iter_bytes()))
+        second = self._normalize(b''.join(msg.iter_bytes()))
+        self.assertEqual(first, second)
+        self.assertEqual(attachment.data, b'data')
+
+    def test_iter_bytes_starts_at_file_position(self):
+        import io
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        fp = io.BytesIO(b'skipdata')
+        fp.read(4)
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            body=Attachment(data=fp, content_type='image/png'),
+            )
+        out = b''.join(msg.iter_bytes())
+        self.assertTrue(out.endswith(b'\r\n\r\nZGF0YQ==\r\n'))
+
+    def test_iter_bytes_text_file(self):
+        import io
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        text = b'\xc3\xa9t\xc3\xa9'.decode('utf-8')
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            body=Attachment(data=io.StringIO(text),
+                            content_type='text/plain; charset=latin-1'),
+            )
+        out = b''.join(msg.iter_bytes())
+        self.assertTrue(out.endswith(b'\r\n\r\n6XTp\r\n'))
+
+    def test_iter_bytes_text_without_charset_not_streamed(self):
+        msg, attachment = self._makeStreamedMessage(
+            b'hello', content_type='text/plain')
+        out = b''.join(msg.iter_bytes())
+        self.assertTrue(b'charset="us-ascii"' in out)
+        self.assertEqual(attachment._data, b'hello')
+
+    def test_iter_bytes_quoted_printable_not_streamed(self):
+        msg, attachment = self._makeStreamedMessage(
+            b'hello', transfer_encoding='quoted-printable')
+        b''.join(msg.iter_bytes())
+        self.assertEqual(attachment._data, b'hello')
+
+    def test_iter_bytes_empty_file(self):
+        msg, attachment = self._makeStreamedMessage(b'')
+        self.assertRaises(RuntimeError, list, msg.iter_bytes())
+
+    def test_iter_bytes_streams_mapped_file(self):
+        import shutil
+        import tempfile
+        from repoze.sendmail.encoding import encode_message
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'report.pdf')
+        data = os.urandom(200000)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            body="body",
+            attachments=[Attachment(path=path)],
+            )
+        streamed = b''.join(msg.iter_bytes())
+        self.assertTrue(msg._has_streams())
+        self._assertEquivalent(streamed, encode_message(msg.to_message()))
+        self.assertEqual(
+            msg.to_message().get_payload()[1].get_payload(decode=True), data)
+
+    def test_write_to(self):
+        import io
+        msg, attachment = self._makeStreamedMessage(b'data')
+        fp = io.BytesIO()
+        msg.write_to(fp)
+        self.assertEqual(self._normalize(fp.getvalue()),
+                         self._normalize(b''.join(msg.iter_bytes())))
+
+    def _makeRichMessage(self, **kw):
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        text = b'LaPe\xf1a'.decode('iso-8859-1')
+        return Message(
+            recipients=['test@example.com', text + ' <other@example.com>'],
+            cc=['cc@example.com'],
+            subject=text * 20,
+            sender=text + ' <sender@example.com>',
+            body='body ' + text + '\nsecond line',
+            html='<p>' + text + '</p>',
+            extra_headers={'X-Foo': 'bar'},
+            attachments=[
+                Attachment('foo.pdf', 'application/pdf', os.urandom(5000)),
+                Attachment('foo.txt', 'text/plain', 'text\n.dot'),
+                ],
+            **kw)
+
+    def test_to_bytes_matches_to_message(self):
+        from repoze.sendmail.encoding import encode_message
+        msg = self._makeRichMessage()
+        expected = msg.to_message()
+        expected['Message-Id'] = '<1@example>'
+        self._assertEquivalent(
+            msg.to_bytes(headers=[('Message-Id', '<1@example>')]),
+            encode_message(expected))
+
+    def test_to_bytes_single_part(self):
+        from repoze.sendmail.encoding import encode_message
+        from pyramid_mailer.message import Message
+        msg = Message(
+            recipients=['test@example.com'],
+            subject="testing",
+            sender="sender@example.com",
+            html="<p>html</p>",
+            )
+        self._assertEquivalent(msg.to_bytes(),
+                               encode_message(msg.to_message()))
+        self.assertTrue(msg.to_bytes().startswith(
+            b'Content-Type: text/html; charset="us-ascii"\r\n'
+            b'MIME-Version: 1.0\r\n'
+            b'Content-Transfer-Encoding: quoted-printable\r\n'))
+
+    def test_to_bytes_crlf_line_endings(self):
+        msg = self._makeRichMessage()
+        data = msg.to_bytes()
+        self.assertEqual(data.count(b'\n'), data.count(b'\r\n'))
+        self.assertEqual(data.count(b'\r'), data.count(b'\r\n'))
+
+    def test_to_bytes_mime_version_once(self):
+        msg = self._makeRichMessage()
+        self.assertEqual(msg.to_bytes().count(b'MIME-Version'), 1)
+
+    def test_to_bytes_non_ascii_filename(self):
+        from email import message_from_bytes
+        from pyramid_mailer.message import Attachment
+        msg = self._makeRichMessage()
+        msg.attach(Attachment(b'f\xc3\xa9.pdf'.decode('utf-8'),
+                              'application/pdf', b'data'))
+        parsed = message_from_bytes(msg.to_bytes())
+        attachment = parsed.get_payload()[-1]
+        self.assertEqual(attachment.get_filename(),
+                         b'f\xc3\xa9.pdf'.decode('utf-8'))
+        self.assertEqual(attachment.get_payload(decode=True), b'data')
+
+    def test_to_bytes_is_cached(self):
+        msg = self._makeRichMessage()
+        built = []
+        orig = msg._build_mailbase
+
+        def _build_mailbase(streams=None):
+            built.append(True)
+            return orig(streams)
+        msg._build_mailbase = _build_mailbase
+        first = msg.to_bytes()
+        self.assertEqual(msg.to_bytes(), first)
+        self.assertEqual(len(built), 1)
+        msg.add_recipient('third@example.com')
+        self.assertTrue(b'third@example.com' in msg.to_bytes())
+        self.assertEqual(len(built), 2)
+
+    def test_to_bytes_to_file(self):
+        import io
+        msg = self._makeRichMessage()
+        fp = io.BytesIO()
+        self.assertEqual(msg.to_bytes(fp), None)
+        self.assertEqual(fp.getvalue(), msg.to_bytes())
+
+    def test_to_bytes_headers(self):
+        from email.header import Header
+        msg = self._makeRichMessage()
+        data = msg.to_bytes(headers=[
+            ('Message-Id', '<%s@example.com>' % ('x' * 80)),
+            ('X-Actually-To', Header('test@example.com', 'utf-8')),
+            ])
+        head = data.split(b'\r\n\r\n')[0]
+        self.assertTrue(head.endswith(
+            b'\r\nMessage-Id: <' + b'x' * 80 + b'@example.com>\r\n'
+            b'X-Actually-To: =?utf-8?q?test=40example=2Ecom?='))
+
+    def test_to_bytes_invalid(self):
+        from pyramid_mailer.message import Message
+        from pyramid_mailer.exceptions import InvalidMessage
+        msg = Message(sender='sender@example.com', body='body')
+        self.assertRaises(InvalidMessage, msg.to_bytes)
+
+    def test_personalize(self):
+        msg = self._makeRichMessage()
+        personal = msg.personalize('reader@example.com', subject='Hello')
+        self.assertEqual(personal.recipients, ['reader@example.com'])
+        self.assertEqual(personal.subject, 'Hello')
+        self.assertEqual(personal.sender, msg.sender)
+        self.assertEqual(personal.cc, msg.cc)
+        self.assertEqual(personal.extra_headers, msg.extra_headers)
+        self.assertTrue(personal.html is msg.html)
+        self.assertTrue(personal.attachments[0] is msg.attachments[0])
+        personal.attach(object())
+        personal.extra_headers['X-Bar'] = 'baz'
+        self.assertEqual(len(msg.attachments), 2)
+        self.assertEqual(msg.extra_headers, {'X-Foo': 'bar'})
+
+    def test_message_id_from_idempotency_key(self):
+        from pyramid_mailer.message import Message
+        def make(**kw):
+            return Message(sender='Shop <shop@example.com>',
+                           recipients=['a@example.com'], body='body', **kw)
+        msg = make(idempotency_key='reset:42')
+        self.assertEqual(msg.message_id, make(
+            idempotency_key='reset:42').message_id)
+        self.assertNotEqual(msg.message_id, make(
+            idempotency_key='reset:43').message_id)
+        self.assertTrue(msg.message_id.endswith('@example.com>'))
+        self.assertEqual(msg.to_message()['Message-Id'], msg.message_id)
+        self.assertTrue(
+            b'Message-Id: ' + msg.message_id.encode('ascii') in msg.to_bytes())
+        self.assertEqual(make().message_id, None)
+        self.assertEqual(make().to_message()['Message-Id'], None)
+
+    def test_message_id_from_extra_headers(self):
+        from pyramid_mailer.message import Message
+        msg = Message(sender='shop@example.com', recipients=['a@example.com'],
+                      body='body', idempotency_key='reset:42',
+                      extra_headers={'message-id': '<given@example.com>'})
+        self.assertEqual(msg.message_id, '<given@example.com>')
+        self.assertEqual(msg.to_message()['Message-Id'],
+                         '<given@example.com>')
+
+    def test_personalize_idempotency_key(self):
+        msg = self._makeRichMessage()
+        msg.idempotency_key = 'newsletter:7'
+        first = msg.personalize('a@example.com')
+        second = msg.personalize('b@example.com')
+        self.assertNotEqual(first.message_id, second.message_id)
+        self.assertEqual(first.message_id,
+                         msg.personalize('a@example.com').message_id)
+
+    def test_personalize_unknown_override(self):
+        msg = self._makeRichMessage()
+        self.assertRaises(TypeError, msg.personalize, 'reader@example.com',
+                          recipients=['other@example.com'])
+
+    def test_personalize_matches_message(self):
+        from pyramid_mailer.message import Message
+        msg = self._makeRichMessage()
+        for body in ('Dear reader', msg.body):
+            personal = msg.personalize('reader@example.com', body=body)
+            expected = Message(
+                recipients=['reader@example.com'],
+                cc=msg.cc,
+                subject=msg.subject,
+                sender=msg.sender,
+                body=body,
+                html=msg.html,
+                extra_headers=msg.extra_headers,
+                attachments=msg.attachments,
+                )
+            self._assertEquivalent(personal.to_bytes(), expected.to_bytes())
+            self._assertEquivalent(personal.as_string().encode('utf-8'),
+                                   expected.as_string().encode('utf-8'))
+
+    def test_personalize_encodes_shared_parts_once(self):
+        from pyramid_mailer import message
+        msg = self._makeRichMessage()
+        encoded = []
+        orig = message.encoded_part_cache.encode_bytes
+
+        def encode_bytes(ctenc, body):
+            encoded.append(body)
+            return orig(ctenc, body)
+        message.encoded_part_cache.encode_bytes = encode_bytes
+        try:
+            for name in ('one', 'two', 'three'):
+                personal = msg.personalize(
+                    '%s@example.com' % name, body='Dear-%s' % name)
+                self.assertTrue(
+                    b'Dear-' + name.encode('ascii') in personal.to_bytes())
+        finally:
+            del message.encoded_part_cache.encode_bytes
+        # the html part and two attachments once, the body every time
+        self.assertEqual(len(encoded), 6)
+
+    def test_personalize_template_part_changed(self):
+        msg = self._makeRichMessage()
+        attachment = msg.attachments[1]
+        first = msg.personalize('reader@example.com').to_bytes()
+        self.assertTrue(b'foo.txt' in first)
+        attachment.filename = 'bar.txt'
+        second = msg.personalize('reader@example.com').to_bytes()
+        self.assertFalse(b'foo.txt' in second)
+        self.assertTrue(b'bar.txt' in second)
+
+    def test_personalize_template_part_replaced(self):
+        msg = self._makeRichMessage()
+        personal = msg.personalize('reader@example.com')
+        personal.to_bytes()
+        msg.html = '<p>changed</p>'
+        self.assertTrue(b'changed' not in personal.to_bytes())
+        self.assertTrue(
+            b'changed' in msg.personalize('reader@example.com').to_bytes())
+        self.assertEqual(len(msg._shared), 4)
+
 class Test_normalize_header(unittest.TestCase):
     def _callFUT(self, header):
         from pyramid_mailer.message import normalize_header
@@ -905,6 +1427,12 @@ class TestMailBase(unittest.TestCase):
         base.set_body('foo')
         self.assertEqual(base.body, 'foo')
 
+    def test_set_body_forgets_encoded(self):
+        base = self._makeOne()
+        base.encoded[(None, bytes)] = b'foo'
+        base.set_body('bar')
+        self.assertEqual(base.encoded, {})
+
     def test_get_body(self):
         base = self._makeOne()
         base.body = 'foo'
@@ -1055,6 +1583,295 @@ class Test_to_message(unittest.TestCase):
         result = self._callFUT(mail)
         self.assertTrue('hello' in result.as_string())
 
+class TestEncodedPartCache(unittest.TestCase):
+    def _getTargetClass(self):
+        from pyramid_mailer.message import EncodedPartCache
+        return EncodedPartCache
+
+    def _makeOne(self, **kw):
+        return self._getTargetClass()(**kw)
+
+    def test_encode_miss_then_hit(self):
+        cache = self._makeOne(min_size=0)
+        data = b'x' * 100
+        first = cache.encode('base64', None, data)
+        self.assertEqual(first, _bencode(data).decode('ascii'))
+        second = cache.encode('base64', None, data)
+        self.assertTrue(second is first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, len(first))
+
+    def test_encode_key_includes_encoding(self):
+        cache = self._makeOne(min_size=0)
+        data = b'x' * 100
+        cache.encode('base64', None, data)
+        result = cache.encode('quoted-printable', None, data)
+        self.assertEqual(result, _qencode(data).decode('ascii'))
+        self.assertEqual(cache.misses, 2)
+
+    def test_encode_small_payload_not_cached(self):
+        cache = self._makeOne(min_size=10)
+        self.assertEqual(cache.encode(None, 'ascii', b'abc'), 'abc')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_encode_evicts_least_recently_used(self):
+        cache = self._makeOne(min_size=0, max_size=25)
+        cache.encode(None, 'ascii', b'a' * 10)
+        cache.encode(None, 'ascii', b'b' * 10)
+        cache.encode(None, 'ascii', b'a' * 10)
+        cache.encode(None, 'ascii', b'c' * 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 20)
+        cache.encode(None, 'ascii', b'a' * 10)
+        self.assertEqual(cache.hits, 2)
+        cache.encode(None, 'ascii', b'b' * 10)
+        self.assertEqual(cache.misses, 4)
+
+    def test_encode_bytes(self):
+        cache = self._makeOne(min_size=0)
+        data = b'x' * 100
+        first = cache.encode_bytes('base64', data)
+        self.assertEqual(first,
+                         _bencode(data).replace(b'\n', b'\r\n'))
+        self.assertTrue(cache.encode_bytes('BASE64', data) is first)
+        cache.encode('base64', None, data)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_clear(self):
+        cache = self._makeOne(min_size=0)
+        cache.encode('base64', None, b'abc')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.size, cache.hits, cache.misses), (0, 0, 0))
+
+    def test_shared_by_messages(self):
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        from pyramid_mailer.message import encoded_part_cache
+        encoded_part_cache.clear()
+        self.addCleanup(encoded_part_cache.clear)
+        data = os.urandom(10000)
+        for recipient in ['a@example.com', 'b@example.com']:
+            msg = Message(
+                recipients=[recipient],
+                subject="testing",
+                sender="sender@example.com",
+                body="body",
+                attachments=[Attachment('foo.pdf', 'application/pdf', data)],
+                )
+            msg.to_message()
+        self.assertEqual(encoded_part_cache.misses, 1)
+        self.assertEqual(encoded_part_cache.hits, 1)
+
+    def test_encode_stream(self):
+        cache = self._makeOne(min_size=10, max_size=100)
+        first = cache.encode_stream(('a',), 50, lambda: b'encoded')
+        self.assertEqual(first, b'encoded')
+        self.assertTrue(cache.encode_stream(('a',), 50, None) is first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.encode_stream(('b',), 5, None), None)
+        self.assertEqual(cache.encode_stream(('b',), 500, None), None)
+
+    def _sendStreamed(self, make_data, count=5, clear=True):
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        from pyramid_mailer.message import encoded_part_cache
+        if clear:
+            encoded_part_cache.clear()
+            self.addCleanup(encoded_part_cache.clear)
+        outputs = []
+        for index in range(count):
+            attachment = make_data()
+            if not isinstance(attachment, Attachment):
+                attachment = Attachment(
+                    'foo.pdf', 'application/pdf', attachment)
+            msg = Message(
+                recipients=['%d@example.com' % index],
+                subject="testing",
+                sender="sender@example.com",
+                body="body",
+                attachments=[attachment],
+                )
+            outputs.append(msg.to_bytes())
+        return outputs
+
+    def _writeFile(self, data):
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def test_streamed_path_shared_by_messages(self):
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import encoded_part_cache
+        data = os.urandom(10000)
+        path = self._writeFile(data)
+        outputs = self._sendStreamed(
+            lambda: Attachment('foo.pdf', 'application/pdf', path=path))
+        self.assertEqual((encoded_part_cache.hits, encoded_part_cache.misses),
+                         (4, 1))
+        encoded = _bencode(data).replace(b'\n', b'\r\n')
+        for output in outputs:
+            self.assertTrue(encoded in output)
+
+    def test_streamed_file_shared_by_messages(self):
+        from pyramid_mailer.message import encoded_part_cache
+        path = self._writeFile(os.urandom(10000))
+        files = []
+
+        def open_file():
+            fp = open(path, 'rb')
+            files.append(fp)
+            return fp
+
+        self._sendStreamed(open_file)
+        for fp in files:
+            fp.close()
+        self.assertEqual((encoded_part_cache.hits, encoded_part_cache.misses),
+                         (4, 1))
+
+    def test_streamed_file_changed(self):
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import encoded_part_cache
+        path = self._writeFile(os.urandom(10000))
+        self._sendStreamed(
+            lambda: Attachment('foo.pdf', 'application/pdf', path=path), 1)
+        os.utime(path, ns=(0, 0))
+        self._sendStreamed(
+            lambda: Attachment('foo.pdf', 'application/pdf', path=path), 1,
+            clear=False)
+        self.assertEqual(encoded_part_cache.misses, 2)
+        self.assertEqual(encoded_part_cache.hits, 0)
+
+    def test_streamed_buffer_shared_by_messages(self):
+        import io
+        from pyramid_mailer.message import encoded_part_cache
+        data = os.urandom(10000)
+        self._sendStreamed(lambda: io.BytesIO(data))
+        self.assertEqual((encoded_part_cache.hits, encoded_part_cache.misses),
+                         (4, 1))
+
+    def test_streamed_mmap_shared_by_messages(self):
+        import mmap
+        from pyramid_mailer.message import encoded_part_cache
+        with open(self._writeFile(os.urandom(10000)), 'rb') as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(mapping.close)
+        self._sendStreamed(lambda: mapping)
+        self.assertEqual((encoded_part_cache.hits, encoded_part_cache.misses),
+                         (4, 1))
+
+class Test_serialize(unittest.TestCase):
+    def _callFUT(self, base):
+        from pyramid_mailer.message import serialize
+        head, chunks = serialize(base)
+        return head, b''.join(chunks)
+
+    def _makeBase(self, items=()):
+        from pyramid_mailer.message import MailBase
+        return MailBase(items)
+
+    def test_no_ctype(self):
+        base = self._makeBase()
+        base.set_body('hello')
+        head, body = self._callFUT(base)
+        self.assertEqual(head,
+                         b'Content-Type: text/plain; charset="us-ascii"\r\n'
+                         b'MIME-Version: 1.0\r\n')
+        self.assertEqual(body, b'hello')
+
+    def test_ctype_doesnt_match_parts(self):
+        base = self._makeBase()
+        base.set_content_type('text/html')
+        base.parts.append(self._makeBase())
+        self.assertRaises(RuntimeError, self._callFUT, base)
+
+    def test_8bit_line_endings(self):
+        base = self._makeBase([('Subject', 'hi')])
+        base.set_content_type('text/plain', {'charset': 'utf-8'})
+        base.set_transfer_encoding('8bit')
+        base.set_body(b'one\ntwo\rthree\r\nfour')
+        head, body = self._callFUT(base)
+        self.assertEqual(body, b'one\r\ntwo\r\nthree\r\nfour')
+        self.assertTrue(b'Subject: hi\r\n' in head)
+
+    def test_multipart(self):
+        part = self._makeBase()
+        part.set_body(b'hello')
+        base = self._makeBase()
+        base.set_content_type('multipart/mixed', {'boundary': 'XYZ'})
+        base.attach_part(part)
+        head, body = self._callFUT(base)
+        self.assertEqual(
+            head, b'Content-Type: multipart/mixed; boundary="XYZ"\r\n'
+                  b'MIME-Version: 1.0\r\n')
+        self.assertEqual(
+            body, b'--XYZ\r\nContent-Type: text/plain\r\n\r\nhello\r\n'
+                  b'--XYZ--\r\n')
+
+    def test_no_ctype_with_parts(self):
+        part = self._makeBase()
+        part.set_body(b'hello')
+        base = self._makeBase()
+        base.attach_part(part)
+        head, body = self._callFUT(base)
+        self.assertTrue(head.startswith(b'Content-Type: multipart/mixed; '))
+        self.assertTrue(b'\r\n\r\nhello\r\n' in body)
+
+    def test_non_text_str_body(self):
+        base = self._makeBase()
+        base.set_content_type('application/json')
+        base.set_body(b'"\xc3\xa9"'.decode('utf-8'))
+        head, body = self._callFUT(base)
+        self.assertEqual(
+            head, b'Content-Type: application/json; charset="utf-8"\r\n'
+                  b'MIME-Version: 1.0\r\n')
+        self.assertEqual(body, b'"\xc3\xa9"')
+
+class Test_format_header(unittest.TestCase):
+    def _callFUT(self, name, value):
+        from pyramid_mailer.message import format_header
+        return format_header(name, value)
+
+    def test_ascii(self):
+        self.assertEqual(self._callFUT('Subject', 'hello'),
+                         'Subject: hello\r\n')
+
+    def test_non_ascii(self):
+        self.assertEqual(self._callFUT('Subject', b'\xe9'.decode('latin-1')),
+                         'Subject: =?iso-8859-1?q?=E9?=\r\n')
+
+    def test_address(self):
+        self.assertEqual(
+            self._callFUT('To', b'\xe9 <a@example.com>, b@example.com'
+                          .decode('latin-1')),
+            'To: =?iso-8859-1?q?=E9?= <a@example.com>, b@example.com\r\n')
+
+    def test_folded(self):
+        result = self._callFUT('Subject', 'word ' * 30)
+        self.assertTrue('\r\n ' in result)
+        self.assertTrue(max(len(line) for line in result.split('\r\n'))
+                        <= 78)
+
+class Test_format_params(unittest.TestCase):
+    def _callFUT(self, value, params):
+        from pyramid_mailer.message import format_params
+        return format_params(value, params)
+
+    def test_it(self):
+        self.assertEqual(
+            self._callFUT('attachment', {'filename': 'a "b".txt'}),
+            'attachment; filename="a \\"b\\".txt"')
+
+    def test_non_ascii(self):
+        self.assertEqual(
+            self._callFUT('attachment', {'filename': b'\xe9'.decode('latin-1')}),
+            "attachment; filename*=iso-8859-1''%E9")
+
 class Test_transfer_encode(unittest.TestCase):
     def _callFUT(self, encoding, payload):
         from pyramid_mailer.message import transfer_encode
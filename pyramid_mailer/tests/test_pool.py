@@ -0,0 +1,809 @@
+import smtplib
+import socket
+import unittest
+
+
+class Test_smtp_connect(unittest.TestCase):
+
+    def _callFUT(self, mailer):
+        from pyramid_mailer.pool import smtp_connect
+        return smtp_connect(mailer)
+
+    def test_plain(self):
+        mailer = DummySMTPMailer()
+        conn = self._callFUT(mailer)
+        self.assertEqual(conn.log, ['ehlo'])
+
+    def test_helo_fallback(self):
+        mailer = DummySMTPMailer(ehlo=(500, 'no'))
+        conn = self._callFUT(mailer)
+        self.assertEqual(conn.log, ['ehlo', 'helo'])
+
+    def test_helo_fails(self):
+        from pyramid_mailer._compat import EHLO_Error
+        mailer = DummySMTPMailer(ehlo=(500, 'no'), helo=(500, 'no'))
+        self.assertRaises(EHLO_Error, self._callFUT, mailer)
+        self.assertTrue(mailer.connections[0].closed)
+
+    def test_starttls(self):
+        mailer = DummySMTPMailer(extensions=('starttls',))
+        conn = self._callFUT(mailer)
+        self.assertEqual(conn.log, ['ehlo', 'starttls', 'ehlo'])
+
+    def test_starttls_wo_ssl(self):
+        from pyramid_mailer import pool
+        mailer = DummySMTPMailer(extensions=('starttls',))
+        have_ssl, pool.HAVE_SSL = pool.HAVE_SSL, None
+        try:
+            conn = self._callFUT(mailer)
+        finally:
+            pool.HAVE_SSL = have_ssl
+        self.assertEqual(conn.log, ['ehlo'])
+
+    def test_no_tls(self):
+        mailer = DummySMTPMailer(extensions=('starttls',), no_tls=True)
+        conn = self._callFUT(mailer)
+        self.assertEqual(conn.log, ['ehlo'])
+
+    def test_force_tls_unavailable(self):
+        from pyramid_mailer._compat import TLS_NotAvailable
+        mailer = DummySMTPMailer(force_tls=True)
+        self.assertRaises(TLS_NotAvailable, self._callFUT, mailer)
+        self.assertTrue(mailer.connections[0].closed)
+
+    def test_login(self):
+        mailer = DummySMTPMailer(username='user', password='secret')
+        conn = self._callFUT(mailer)
+        self.assertEqual(conn.log, ['ehlo', ('login', 'user', 'secret')])
+
+    def test_login_wo_esmtp(self):
+        from pyramid_mailer._compat import ESMTP_NotSupported
+        mailer = DummySMTPMailer(username='user', password='secret',
+                                 esmtp=False)
+        self.assertRaises(ESMTP_NotSupported, self._callFUT, mailer)
+        self.assertTrue(mailer.connections[0].closed)
+
+
+class Test_smtp_disconnect(unittest.TestCase):
+
+    def _callFUT(self, connection):
+        from pyramid_mailer.pool import smtp_disconnect
+        return smtp_disconnect(connection)
+
+    def test_quit(self):
+        conn = DummyConnection()
+        self._callFUT(conn)
+        self.assertEqual(conn.log, ['quit'])
+
+    def test_quit_fails(self):
+        conn = DummyConnection(quit=smtplib.SMTPServerDisconnected())
+        self._callFUT(conn)
+        self.assertTrue(conn.closed)
+
+
+class Test_smtp_sendmail(unittest.TestCase):
+
+    def _callFUT(self, connection, fromaddr, toaddrs, message):
+        from pyramid_mailer.pool import smtp_sendmail
+        return smtp_sendmail(connection, fromaddr, toaddrs, message)
+
+    def test_without_pipelining(self):
+        conn = DummyConnection()
+        result = self._callFUT(conn, 'a@example.com', ['b@example.com'],
+                               b'data')
+        self.assertEqual(result, {})
+        self.assertEqual(conn.sent, [('a@example.com', ['b@example.com'],
+                                      b'data')])
+
+    def test_single_write(self):
+        conn = DummyPipeliningConnection([(250, b'ok')] * 3)
+        result = self._callFUT(conn, 'a@example.com',
+                               ['b@example.com', 'c@example.com'], b'data')
+        self.assertEqual(result, {})
+        self.assertEqual(conn.writes, [
+            'mail FROM:<a@example.com>\r\n'
+            'rcpt TO:<b@example.com>\r\n'
+            'rcpt TO:<c@example.com>\r\n'])
+        self.assertEqual(conn.data_sent, [b'data'])
+
+    def test_size_and_str_message(self):
+        conn = DummyPipeliningConnection([(250, b'ok')] * 2,
+                                         extensions=('size',))
+        self._callFUT(conn, 'a@example.com', 'b@example.com', 'line\n')
+        self.assertEqual(conn.writes, [
+            'mail FROM:<a@example.com> size=6\r\n'
+            'rcpt TO:<b@example.com>\r\n'])
+        self.assertEqual(conn.data_sent, [b'line\r\n'])
+
+    def test_partial_refusal(self):
+        conn = DummyPipeliningConnection(
+            [(250, b'ok'), (550, b'unknown'), (251, b'forwarded')])
+        result = self._callFUT(conn, 'a@example.com',
+                               ['b@example.com', 'c@example.com'], b'data')
+        self.assertEqual(result, {'b@example.com': (550, b'unknown')})
+        self.assertEqual(conn.data_sent, [b'data'])
+
+    def test_all_refused(self):
+        conn = DummyPipeliningConnection(
+            [(250, b'ok'), (550, b'unknown'), (550, b'unknown')])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._callFUT,
+                          conn, 'a@example.com',
+                          ['b@example.com', 'c@example.com'], b'data')
+        self.assertEqual(conn.data_sent, [])
+        self.assertIn('rset', conn.log)
+
+    def test_recipient_421(self):
+        conn = DummyPipeliningConnection(
+            [(250, b'ok'), (421, b'closing'), (250, b'ok')])
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._callFUT,
+                          conn, 'a@example.com',
+                          ['b@example.com', 'c@example.com'], b'data')
+        self.assertTrue(conn.closed)
+
+    def test_sender_refused_reads_all_replies(self):
+        conn = DummyPipeliningConnection(
+            [(550, b'no'), (503, b'need MAIL'), (503, b'need MAIL')])
+        self.assertRaises(smtplib.SMTPSenderRefused, self._callFUT,
+                          conn, 'a@example.com',
+                          ['b@example.com', 'c@example.com'], b'data')
+        self.assertEqual(conn.replies, [])
+        self.assertIn('rset', conn.log)
+
+    def test_sender_421(self):
+        conn = DummyPipeliningConnection([(421, b'closing')])
+        self.assertRaises(smtplib.SMTPSenderRefused, self._callFUT,
+                          conn, 'a@example.com', ['b@example.com'], b'data')
+        self.assertTrue(conn.closed)
+
+    def test_data_error(self):
+        conn = DummyPipeliningConnection([(250, b'ok'), (250, b'ok')],
+                                         data=(554, b'rejected'))
+        self.assertRaises(smtplib.SMTPDataError, self._callFUT,
+                          conn, 'a@example.com', ['b@example.com'], b'data')
+        self.assertIn('rset', conn.log)
+
+    def test_data_421(self):
+        conn = DummyPipeliningConnection([(250, b'ok'), (250, b'ok')],
+                                         data=(421, b'closing'))
+        self.assertRaises(smtplib.SMTPDataError, self._callFUT,
+                          conn, 'a@example.com', ['b@example.com'], b'data')
+        self.assertTrue(conn.closed)
+
+    def test_rset_disconnected(self):
+        conn = DummyPipeliningConnection([(250, b'ok'), (550, b'unknown')])
+        conn.rset_result = smtplib.SMTPServerDisconnected()
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._callFUT,
+                          conn, 'a@example.com', ['b@example.com'], b'data')
+
+
+class Test_smtp_data_stream(unittest.TestCase):
+
+    def _callFUT(self, connection, chunks):
+        from pyramid_mailer.pool import smtp_data_stream
+        return smtp_data_stream(connection, chunks)
+
+    def test_dot_stuffing_across_chunks(self):
+        conn = DummyPipeliningConnection([(354, b'go'), (250, b'queued')])
+        result = self._callFUT(
+            conn, [b'.a\r\n', b'.b\r\n.c', b'', b'.d\r\ne'])
+        self.assertEqual(result, (250, b'queued'))
+        self.assertEqual(conn.writes, [
+            'data', b'..a\r\n', b'..b\r\n..c', b'.d\r\ne', b'\r\n.\r\n'])
+
+    def test_ends_with_line_ending(self):
+        conn = DummyPipeliningConnection([(354, b'go'), (250, b'queued')])
+        self._callFUT(conn, iter([b'a\r\n']))
+        self.assertEqual(conn.writes, ['data', b'a\r\n', b'.\r\n'])
+
+    def test_refused(self):
+        conn = DummyPipeliningConnection([(554, b'no')])
+        self.assertRaises(smtplib.SMTPDataError, self._callFUT, conn, [b'a'])
+        self.assertEqual(conn.writes, ['data'])
+
+
+class Test_smtp_sendmail_streamed(unittest.TestCase):
+
+    def _callFUT(self, connection, fromaddr, toaddrs, message):
+        from pyramid_mailer.pool import smtp_sendmail
+        return smtp_sendmail(connection, fromaddr, toaddrs, message)
+
+    def test_pipelined(self):
+        conn = DummyPipeliningConnection(
+            [(250, b'ok')] * 2 + [(354, b'go'), (250, b'queued')],
+            extensions=('size',))
+        result = self._callFUT(conn, 'a@example.com', ['b@example.com'],
+                               iter([b'line\r\n']))
+        self.assertEqual(result, {})
+        self.assertEqual(conn.writes, [
+            'mail FROM:<a@example.com>\r\n'
+            'rcpt TO:<b@example.com>\r\n',
+            'data', b'line\r\n', b'.\r\n'])
+        self.assertEqual(conn.data_sent, [])
+
+    def test_without_pipelining(self):
+        conn = DummyPipeliningConnection(
+            [(250, b'ok'), (250, b'ok'), (550, b'unknown'),
+             (354, b'go'), (250, b'queued')])
+        conn.extensions = ()
+        result = self._callFUT(conn, 'a@example.com',
+                               ['b@example.com', 'c@example.com'],
+                               [b'line\r\n'])
+        self.assertEqual(result, {'c@example.com': (550, b'unknown')})
+        self.assertEqual(conn.writes, [
+            'mail a@example.com', 'rcpt b@example.com', 'rcpt c@example.com',
+            'data', b'line\r\n', b'.\r\n'])
+        self.assertEqual(conn.sent, [])
+
+    def test_without_pipelining_sender_refused(self):
+        conn = DummyPipeliningConnection([(550, b'no')])
+        conn.extensions = ()
+        self.assertRaises(smtplib.SMTPSenderRefused, self._callFUT, conn,
+                          'a@example.com', ['b@example.com'], [b'line'])
+        self.assertIn('rset', conn.log)
+
+    def test_without_pipelining_all_refused(self):
+        conn = DummyPipeliningConnection([(250, b'ok'), (550, b'no')])
+        conn.extensions = ()
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._callFUT, conn,
+                          'a@example.com', ['b@example.com'], [b'line'])
+
+    def test_without_pipelining_sender_421(self):
+        conn = DummyPipeliningConnection([(421, b'bye')])
+        conn.extensions = ()
+        self.assertRaises(smtplib.SMTPSenderRefused, self._callFUT, conn,
+                          'a@example.com', ['b@example.com'], [b'line'])
+        self.assertTrue(conn.closed)
+        self.assertNotIn('rset', conn.log)
+
+    def test_without_pipelining_recipient_421(self):
+        conn = DummyPipeliningConnection([(250, b'ok'), (421, b'bye')])
+        conn.extensions = ()
+        self.assertRaises(smtplib.SMTPRecipientsRefused, self._callFUT, conn,
+                          'a@example.com', ['b@example.com'], [b'line'])
+        self.assertTrue(conn.closed)
+
+
+class TestSMTPConnectionPool(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.pool import SMTPConnectionPool
+        return SMTPConnectionPool
+
+    def _makeOne(self, mailer=None, **kw):
+        if mailer is None:
+            mailer = DummySMTPMailer()
+        return self._getTargetClass()(mailer, **kw)
+
+    def test_send_reuses_connection(self):
+        pool = self._makeOne()
+        pool.send('sender@example.com', ['a@example.com'], b'data')
+        pool.send('sender@example.com', ['b@example.com'], b'data')
+        self.assertEqual(len(pool.mailer.connections), 1)
+        conn = pool.mailer.connections[0]
+        self.assertEqual(conn.sent, [
+            ('sender@example.com', ['a@example.com'], b'data'),
+            ('sender@example.com', ['b@example.com'], b'data'),
+        ])
+        self.assertIn('rset', conn.log)
+
+    def test_send_email_message(self):
+        from email.mime.text import MIMEText
+        pool = self._makeOne()
+        pool.send('sender@example.com', ['a@example.com'], MIMEText('hi'))
+        data = pool.mailer.connections[0].sent[0][2]
+        self.assertIsInstance(data, bytes)
+        self.assertIn(b'hi', data)
+
+    def test_send_streams_message(self):
+        import base64
+        import io
+        from pyramid_mailer.message import Attachment
+        from pyramid_mailer.message import Message
+        data = b'x' * 100000
+        message = Message(
+            subject='testing', sender='sender@example.com',
+            recipients=['a@example.com'], body='body',
+            attachments=[Attachment('f.bin', 'application/octet-stream',
+                                    io.BytesIO(data))])
+        conn = DummyPipeliningConnection(
+            [(250, b'ok')] * 2 + [(354, b'go'), (250, b'queued')])
+        pool = self._makeOne()
+        pool.mailer.smtp_factory = lambda: conn
+        pool.send('sender@example.com', ['a@example.com'], message)
+        self.assertEqual(conn.data_sent, [])
+        self.assertEqual(conn.writes[1], 'data')
+        written = b''.join(conn.writes[2:])
+        self.assertIn(base64.encodebytes(data).replace(b'\n', b'\r\n'),
+                      written)
+
+    def test_send_returns_refused(self):
+        mailer = DummySMTPMailer(
+            refused={'a@example.com': (550, 'unknown')})
+        pool = self._makeOne(mailer)
+        result = pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(result, {'a@example.com': (550, 'unknown')})
+
+    def test_acquire_discards_dead_connection(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.rset_result = smtplib.SMTPServerDisconnected()
+        new = pool.acquire()
+        self.assertIsNot(new, conn)
+        self.assertIn('quit', conn.log)
+
+    def test_acquire_discards_rset_refusal(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+        conn.rset_result = (421, 'closing')
+        new = pool.acquire()
+        self.assertIsNot(new, conn)
+
+    def test_acquire_discards_expired(self):
+        pool = self._makeOne(idle_timeout=0)
+        conn = pool.acquire()
+        pool._idle.append((0, conn))
+        new = pool.acquire()
+        self.assertIsNot(new, conn)
+        self.assertNotIn('rset', conn.log)
+        self.assertIn('quit', conn.log)
+
+    def test_release_prunes_expired(self):
+        pool = self._makeOne(idle_timeout=10)
+        stale = pool.acquire()
+        conn = pool.acquire()
+        pool._idle.append((0, stale))
+        pool.release(conn)
+        self.assertEqual([c for t, c in pool._idle], [conn])
+        self.assertIn('quit', stale.log)
+
+    def test_release_full_pool(self):
+        pool = self._makeOne(size=1)
+        first = pool.acquire()
+        second = pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertEqual([c for t, c in pool._idle], [first])
+        self.assertIn('quit', second.log)
+
+    def test_release_discard(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn, discard=True)
+        self.assertEqual(pool._idle, [])
+        self.assertIn('quit', conn.log)
+
+    def test_connection_error_discards(self):
+        mailer = DummySMTPMailer(sendmail=socket.error())
+        pool = self._makeOne(mailer)
+        self.assertRaises(socket.error, pool.send,
+                          'sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(pool._idle, [])
+
+    def test_disconnect_response_discards(self):
+        mailer = DummySMTPMailer(
+            sendmail=smtplib.SMTPDataError(421, 'closing'))
+        pool = self._makeOne(mailer)
+        self.assertRaises(smtplib.SMTPDataError, pool.send,
+                          'sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(pool._idle, [])
+
+    def test_refusal_keeps_connection(self):
+        mailer = DummySMTPMailer(
+            sendmail=smtplib.SMTPRecipientsRefused({}))
+        pool = self._makeOne(mailer)
+        self.assertRaises(smtplib.SMTPRecipientsRefused, pool.send,
+                          'sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(len(pool._idle), 1)
+
+    def test_send_many_one_session(self):
+        pool = self._makeOne(size=0)
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertEqual(results, [{}, {}])
+        self.assertEqual(len(pool.mailer.connections), 1)
+        conn = pool.mailer.connections[0]
+        self.assertEqual([m for f, t, m in conn.sent], [b'one', b'two'])
+        self.assertIn('quit', conn.log)
+
+    def test_send_many_email_message(self):
+        from email.mime.text import MIMEText
+        pool = self._makeOne()
+        pool.send_many([('sender@example.com', ['a@example.com'],
+                         MIMEText('hi'))])
+        data = pool.mailer.connections[0].sent[0][2]
+        self.assertIsInstance(data, bytes)
+
+    def test_send_many_records_refusal(self):
+        pool = self._makeOne()
+        pool.mailer.kw['sendmail'] = smtplib.SMTPRecipientsRefused({})
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results[0], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(len(pool.mailer.connections), 1)
+        self.assertEqual(len(pool._idle), 1)
+
+    def test_send_many_recipient_421_reconnects(self):
+        pool = self._makeOne()
+        _closeOnSend(pool.mailer, smtplib.SMTPRecipientsRefused(
+            {'a@example.com': (421, 'closing')}))
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertIsInstance(results[0], smtplib.SMTPRecipientsRefused)
+        self.assertEqual(results[1], {})
+        self.assertEqual(len(pool.mailer.connections), 2)
+        self.assertEqual(pool.mailer.connections[1].sent, [
+            ('sender@example.com', ['b@example.com'], b'two')])
+
+    def test_send_many_reconnects(self):
+        pool = self._makeOne()
+        pool.mailer.kw['sendmail'] = smtplib.SMTPServerDisconnected()
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertIsInstance(results[0], smtplib.SMTPServerDisconnected)
+        self.assertIsInstance(results[1], smtplib.SMTPServerDisconnected)
+        self.assertEqual(len(pool.mailer.connections), 2)
+        self.assertEqual(pool._idle, [])
+
+    def test_send_many_connect_fails(self):
+        mailer = DummySMTPMailer()
+        error = socket.error('refused')
+        def smtp_factory():
+            raise error
+        mailer.smtp_factory = smtp_factory
+        pool = self._makeOne(mailer)
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertEqual(results, [error, error])
+
+    def test_send_many_unexpected_error(self):
+        pool = self._makeOne()
+        pool.mailer.kw['sendmail'] = ValueError()
+        self.assertRaises(ValueError, pool.send_many, [
+            ('sender@example.com', ['a@example.com'], b'one'),
+        ])
+        self.assertEqual(pool._idle, [])
+
+    def test_close(self):
+        pool = self._makeOne()
+        conn = pool.acquire()
+        pool.release(conn)
+        pool.close()
+        self.assertEqual(pool._idle, [])
+        self.assertIn('quit', conn.log)
+
+
+class TestMultiHostPool(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.pool import MultiHostPool
+        return MultiHostPool
+
+    def _makeOne(self, mailers=None, **kw):
+        if mailers is None:
+            mailers = [DummySMTPMailer(hostname='a'),
+                       DummySMTPMailer(hostname='b')]
+        return self._getTargetClass()(mailers, **kw)
+
+    def _refuse(self, mailer):
+        def smtp_factory():
+            raise socket.error('refused')
+        mailer.smtp_factory = smtp_factory
+
+    def test_no_hosts(self):
+        self.assertRaises(ValueError, self._makeOne, [])
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, self._makeOne, strategy='random')
+
+    def test_acquire_skips_tried_hosts(self):
+        pool = self._makeOne()
+        tried = set([pool.hosts[0]])
+        pool.acquire(tried)
+        self.assertEqual(
+            [len(mailer.connections) for mailer in pool.mailers], [0, 1])
+        self.assertEqual(tried, set(pool.hosts))
+        self.assertRaises(socket.error, pool.acquire, tried)
+
+    def test_round_robin(self):
+        pool = self._makeOne(size=0)
+        for index in range(4):
+            pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(
+            [len(mailer.connections) for mailer in pool.mailers], [2, 2])
+
+    def test_least_outstanding(self):
+        pool = self._makeOne(strategy='least_outstanding')
+        first = pool.acquire()
+        second = pool.acquire()
+        third = pool.acquire()
+        self.assertEqual(
+            [len(mailer.connections) for mailer in pool.mailers], [2, 1])
+        pool.release(first)
+        pool.release(third)
+        pool.acquire()
+        self.assertEqual(
+            [host['outstanding'] for host in pool.status()], [1, 1])
+        pool.release(second)
+
+    def test_connect_fails_over(self):
+        pool = self._makeOne(max_failures=1)
+        self._refuse(pool.mailers[0])
+        for index in range(3):
+            pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(len(pool.mailers[1].connections), 1)
+        self.assertEqual(len(pool.mailers[1].connections[0].sent), 3)
+        self.assertEqual(
+            [host['healthy'] for host in pool.status()], [False, True])
+
+    def test_handshake_error_fails_over(self):
+        from pyramid_mailer._compat import EHLO_Error
+        from pyramid_mailer._compat import ESMTP_NotSupported
+        from pyramid_mailer._compat import TLS_NotAvailable
+        for error in (EHLO_Error(554, 'go away'), ESMTP_NotSupported(),
+                      TLS_NotAvailable()):
+            pool = self._makeOne(max_failures=1)
+            def smtp_factory(error=error):
+                raise error
+            pool.mailers[0].smtp_factory = smtp_factory
+            pool.send('sender@example.com', ['a@example.com'], b'data')
+            self.assertEqual(len(pool.mailers[1].connections[0].sent), 1)
+            self.assertEqual(
+                [host['healthy'] for host in pool.status()], [False, True])
+
+    def test_send_many_handshake_error(self):
+        from pyramid_mailer._compat import TLS_NotAvailable
+        pool = self._makeOne()
+        for mailer in pool.mailers:
+            mailer.force_tls = True
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results[0], TLS_NotAvailable)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(
+            [host['failures'] for host in pool.status()], [1, 1])
+
+    def test_unhealthy_host_skipped(self):
+        pool = self._makeOne(size=0, max_failures=1, retry_after=60)
+        attempts = []
+        def smtp_factory():
+            attempts.append(1)
+            raise socket.error('refused')
+        pool.mailers[0].smtp_factory = smtp_factory
+        for index in range(4):
+            pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(len(attempts), 1)
+        self.assertEqual(len(pool.mailers[1].connections), 4)
+
+    def test_unhealthy_host_retried(self):
+        pool = self._makeOne(size=0, max_failures=1, retry_after=0)
+        pool.hosts[0].failures = 1
+        pool.hosts[0].down_since = 0
+        pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(len(pool.mailers[0].connections), 1)
+        self.assertEqual(
+            pool.status()[0],
+            {'hostname': 'a', 'port': 25, 'healthy': True, 'failures': 0,
+             'outstanding': 0})
+
+    def test_all_hosts_fail(self):
+        pool = self._makeOne()
+        for mailer in pool.mailers:
+            self._refuse(mailer)
+        self.assertRaises(socket.error, pool.send,
+                          'sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(
+            [host['failures'] for host in pool.status()], [1, 1])
+
+    def test_unhealthy_hosts_tried_last(self):
+        pool = self._makeOne(max_failures=1, retry_after=60)
+        for host in pool.hosts:
+            host.failures = 1
+            host.down_since = 1
+        pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(len(pool.mailers[0].connections), 1)
+
+    def test_send_fails_over(self):
+        pool = self._makeOne()
+        pool.mailers[0].kw['sendmail'] = smtplib.SMTPServerDisconnected()
+        pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(pool.mailers[1].connections[0].sent, [
+            ('sender@example.com', ['a@example.com'], b'data')])
+        self.assertEqual(pool.status()[0]['failures'], 1)
+        self.assertEqual(pool.hosts[0].pool._idle, [])
+
+    def test_send_recipient_421_fails_over(self):
+        pool = self._makeOne()
+        _closeOnSend(pool.mailers[0], smtplib.SMTPRecipientsRefused(
+            {'a@example.com': (421, 'closing')}))
+        self.assertEqual(
+            pool.send('sender@example.com', ['a@example.com'], b'data'), {})
+        self.assertEqual(pool.mailers[1].connections[0].sent, [
+            ('sender@example.com', ['a@example.com'], b'data')])
+        self.assertEqual(pool.status()[0]['failures'], 1)
+        self.assertEqual(pool.hosts[0].pool._idle, [])
+
+    def test_send_not_resent_after_refusal(self):
+        pool = self._makeOne()
+        pool.mailers[0].refused = {'a@example.com': (550, 'unknown')}
+        result = pool.send('sender@example.com', ['a@example.com'], b'data')
+        self.assertEqual(result, {'a@example.com': (550, 'unknown')})
+        self.assertEqual(pool.mailers[1].connections, [])
+
+    def test_send_iterator_not_resent(self):
+        pool = self._makeOne()
+        conn = DummyPipeliningConnection([])
+        def send(s):
+            raise smtplib.SMTPServerDisconnected()
+        conn.send = send
+        pool.mailers[0].smtp_factory = lambda: conn
+        self.assertRaises(smtplib.SMTPServerDisconnected, pool.send,
+                          'sender@example.com', ['a@example.com'],
+                          iter([b'data']))
+        self.assertEqual(pool.mailers[1].connections, [])
+
+    def test_send_many_fails_over(self):
+        pool = self._makeOne()
+        pool.mailers[0].kw['sendmail'] = smtplib.SMTPServerDisconnected()
+        results = pool.send_many([
+            ('sender@example.com', ['a@example.com'], b'one'),
+            ('sender@example.com', ['b@example.com'], b'two'),
+        ])
+        self.assertIsInstance(results[0], smtplib.SMTPServerDisconnected)
+        self.assertEqual(results[1], {})
+        self.assertEqual(pool.mailers[1].connections[0].sent, [
+            ('sender@example.com', ['b@example.com'], b'two')])
+
+    def test_close(self):
+        pool = self._makeOne()
+        connections = [pool.acquire(), pool.acquire()]
+        for conn in connections:
+            pool.release(conn)
+        pool.close()
+        for conn in connections:
+            self.assertIn('quit', conn.log)
+
+
+def _closeOnSend(mailer, error):
+    # the first connection of ``mailer`` is closed by the server while
+    # sending, as smtplib does on a 421 reply
+    smtp_factory = mailer.smtp_factory
+    def factory():
+        conn = smtp_factory()
+        if len(mailer.connections) == 1:
+            def sendmail(fromaddr, toaddrs, message):
+                conn.close()
+                raise error
+            conn.sendmail = sendmail
+        return conn
+    mailer.smtp_factory = factory
+
+
+class DummyConnection(object):
+
+    does_esmtp = True
+    closed = False
+
+    def __init__(self, ehlo=(250, 'ok'), helo=(250, 'ok'), extensions=(),
+                 esmtp=True, sendmail=None, quit=None):
+        self.ehlo_result = ehlo
+        self.helo_result = helo
+        self.extensions = extensions
+        self.does_esmtp = esmtp
+        self.sendmail_result = sendmail
+        self.quit_result = quit
+        self.rset_result = (250, 'ok')
+        self.sock = object()
+        self.log = []
+        self.sent = []
+
+    def ehlo(self):
+        self.log.append('ehlo')
+        return self.ehlo_result
+
+    def helo(self):
+        self.log.append('helo')
+        return self.helo_result
+
+    def has_extn(self, name):
+        return name in self.extensions
+
+    def starttls(self):
+        self.log.append('starttls')
+
+    def login(self, username, password):
+        self.log.append(('login', username, password))
+
+    def rset(self):
+        self.log.append('rset')
+        if isinstance(self.rset_result, Exception):
+            raise self.rset_result
+        return self.rset_result
+
+    def sendmail(self, fromaddr, toaddrs, message):
+        if isinstance(self.sendmail_result, Exception):
+            raise self.sendmail_result
+        self.sent.append((fromaddr, toaddrs, message))
+        return self.sendmail_result or {}
+
+    def quit(self):
+        self.log.append('quit')
+        if self.quit_result is not None:
+            raise self.quit_result
+
+    def close(self):
+        self.closed = True
+        self.sock = None
+
+
+class DummyPipeliningConnection(DummyConnection):
+
+    def __init__(self, replies, extensions=(), data=(250, b'queued')):
+        DummyConnection.__init__(
+            self, extensions=('pipelining',) + tuple(extensions))
+        self.replies = list(replies)
+        self.data_result = data
+        self.writes = []
+        self.data_sent = []
+
+    def send(self, s):
+        self.writes.append(s)
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def data(self, message):
+        self.data_sent.append(message)
+        return self.data_result
+
+    def putcmd(self, cmd):
+        self.writes.append(cmd)
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def mail(self, fromaddr):
+        self.writes.append('mail ' + fromaddr)
+        return self.getreply()
+
+    def rcpt(self, addr):
+        self.writes.append('rcpt ' + addr)
+        return self.getreply()
+
+
+class DummySMTPMailer(object):
+
+    def __init__(self, username=None, password=None, no_tls=False,
+                 force_tls=False, refused=None, hostname='localhost',
+                 port=25, **kw):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.no_tls = no_tls
+        self.force_tls = force_tls
+        self.refused = refused
+        self.kw = kw
+        self.connections = []
+
+    def smtp_factory(self):
+        conn = DummyConnection(**self.kw)
+        if self.refused:
+            conn.sendmail_result = self.refused
+        self.connections.append(conn)
+        return conn
@@ -0,0 +1,1577 @@
+import os
+import smtplib
+import threading
+import time
+import unittest
+
+
+def dummy_app(global_config, **settings):  # pragma: no cover
+    return None
+
+
+class DummyMailer(object):
+
+    def __init__(self, error=None):
+        self.sent = []
+        self.error = error
+        self.lock = threading.Lock()
+
+    def send(self, fromaddr, toaddrs, message):
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            self.sent.append((fromaddr, toaddrs, message))
+        return {}
+
+
+def _rmtree(path):
+    import gc
+    import shutil
+    # close the SQLite connections of the test first; the last one removes
+    # the -wal and -shm files, which must not happen while they are removed
+    gc.collect()
+    shutil.rmtree(path)
+
+
+class _QueueTestBase(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(_rmtree, tempdir)
+        self.tempdir = tempdir
+        self.queue_path = os.path.join(tempdir, 'queue')
+
+    def _enqueue(self, count=1, recipients=('a@example.com',),
+                 not_before=None, compression=None, counters=None):
+        import transaction
+        from pyramid_mailer.delivery import StreamingQueuedMailDelivery
+        from pyramid_mailer.message import Message
+        tm = transaction.TransactionManager()
+        delivery = StreamingQueuedMailDelivery(
+            self.queue_path, transaction_manager=tm,
+            compression=compression, counters=counters)
+        tm.begin()
+        for index in range(count):
+            message = Message(
+                subject='testing %d' % index, sender='sender@example.com',
+                recipients=list(recipients), body='hello')
+            delivery.send('sender@example.com', list(recipients), message,
+                          not_before=not_before)
+        tm.commit()
+
+    def _listdir(self, name):
+        return sorted(os.listdir(os.path.join(self.queue_path, name)))
+
+    def _writeConfig(self, **settings):
+        path = os.path.join(self.tempdir, 'app.ini')
+        lines = ['[app:main]',
+                 'use = call:pyramid_mailer.tests.test_queue:dummy_app']
+        lines.extend('%s = %s' % item for item in sorted(settings.items()))
+        with open(path, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        return path
+
+
+class Test_parse_queued(unittest.TestCase):
+
+    def _callFUT(self, data):
+        from pyramid_mailer.queue import parse_queued
+        return parse_queued(data)
+
+    def test_it(self):
+        fromaddr, toaddrs, message = self._callFUT(
+            b'X-Actually-From: =?utf-8?q?sender=40example=2Ecom?=\r\n'
+            b'Subject: testing\r\n'
+            b'X-Actually-To: =?utf-8?q?a=40example=2Ecom=2Cb=40example=2E?=\r\n'
+            b' =?utf-8?q?com?=\r\n'
+            b'\r\n'
+            b'body\r\n')
+        self.assertEqual(fromaddr, 'sender@example.com')
+        self.assertEqual(toaddrs, ('a@example.com', 'b@example.com'))
+        self.assertEqual(message, b'Subject: testing\r\n\r\nbody\r\n')
+
+    def test_plain_values_and_line_endings(self):
+        fromaddr, toaddrs, message = self._callFUT(
+            b'X-Actually-From: sender@example.com\n'
+            b'X-Actually-To: a@example.com, b@example.com\n'
+            b'Subject: testing\n'
+            b'\n'
+            b'body\n')
+        self.assertEqual(fromaddr, 'sender@example.com')
+        self.assertEqual(toaddrs, ('a@example.com', 'b@example.com'))
+        self.assertEqual(message, b'Subject: testing\r\n\r\nbody\r\n')
+
+    def test_no_envelope(self):
+        fromaddr, toaddrs, message = self._callFUT(
+            b'Subject: testing\r\n\r\nbody\r\n')
+        self.assertEqual(fromaddr, '')
+        self.assertEqual(toaddrs, ())
+        self.assertEqual(message, b'Subject: testing\r\n\r\nbody\r\n')
+
+
+class Test_read_queued(unittest.TestCase):
+
+    queued = (b'X-Actually-From: sender@example.com\n'
+              b'X-Actually-To: a@example.com\n'
+              b'Subject: testing\n'
+              b'\n'
+              b'body\r\n.line\n' * 3)
+
+    def _callFUT(self, data, stream=False):
+        import io
+        from pyramid_mailer.queue import read_queued
+        return read_queued(io.BytesIO(data), stream)
+
+    def _compress(self, data, compression):
+        from pyramid_mailer.queue import compress_queued
+        return compress_queued(data, compression)
+
+    def test_plain(self):
+        from pyramid_mailer.queue import parse_queued
+        self.assertEqual(self._callFUT(self.queued),
+                         parse_queued(self.queued))
+
+    def test_compressed(self):
+        from pyramid_mailer.queue import parse_queued
+        for compression in ('zlib', 'lzma'):
+            data = self._compress(self.queued, compression)
+            self.assertNotEqual(data, self.queued)
+            self.assertEqual(self._callFUT(data), parse_queued(self.queued))
+
+    def test_stream(self):
+        from pyramid_mailer import queue
+        from pyramid_mailer.queue import parse_queued
+        self.addCleanup(setattr, queue, '_CHUNK', queue._CHUNK)
+        # chunks ending between CR and LF, and within the headers
+        queue._CHUNK = 7
+        data = self._compress(self.queued, 'zlib')
+        fromaddr, toaddrs, chunks = self._callFUT(data, stream=True)
+        self.assertEqual((fromaddr, toaddrs), ('sender@example.com',
+                                               ('a@example.com',)))
+        chunks = list(chunks)
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(b''.join(chunks), parse_queued(self.queued)[2])
+
+    def test_stream_crlf_split(self):
+        from pyramid_mailer import queue
+        from pyramid_mailer.queue import parse_queued
+        self.addCleanup(setattr, queue, '_CHUNK', queue._CHUNK)
+        # every CR ends a chunk
+        queue._CHUNK = 1
+        fromaddr, toaddrs, chunks = self._callFUT(self.queued, stream=True)
+        self.assertEqual(b''.join(chunks), parse_queued(self.queued)[2])
+
+    def test_no_body(self):
+        fromaddr, toaddrs, message = self._callFUT(
+            b'X-Actually-From: sender@example.com\nSubject: testing\n')
+        self.assertEqual(fromaddr, 'sender@example.com')
+        self.assertEqual(message, b'Subject: testing\r\n')
+
+    def test_invalid_compression(self):
+        self.assertRaises(ValueError, self._compress, b'', 'bzip2')
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import GroupCommit
+        return GroupCommit
+
+    def _makeOne(self, flush, **kw):
+        return self._getTargetClass()(flush, **kw)
+
+    def test_submit_alone(self):
+        flushed = []
+        committer = self._makeOne(flushed.append)
+        committer.submit(1)
+        committer.submit(2)
+        self.assertEqual(flushed, [[1], [2]])
+        self.assertEqual(committer.flushes, 2)
+
+    def test_concurrent_submits_share_flush(self):
+        flushed = []
+        committer = self._makeOne(flushed.append, max_latency=10, max_size=8)
+        threads = [threading.Thread(target=committer.submit, args=(index,))
+                   for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the group was flushed early, once it was full
+        self.assertEqual(len(flushed), 1)
+        self.assertEqual(sorted(flushed[0]), list(range(8)))
+
+    def test_submits_join_while_flushing(self):
+        flushed = []
+        flushing = threading.Event()
+        resume = threading.Event()
+
+        def flush(items):
+            flushing.set()
+            resume.wait(5)
+            flushed.append(items)
+
+        committer = self._makeOne(flush)
+        first = threading.Thread(target=committer.submit, args=(0,))
+        first.start()
+        flushing.wait(5)
+        flushing.clear()
+        others = [threading.Thread(target=committer.submit, args=(index,))
+                  for index in (1, 2, 3)]
+        for thread in others:
+            thread.start()
+        while committer._group is None or len(committer._group.items) < 3:
+            time.sleep(0.001)  # pragma: no cover
+        resume.set()
+        for thread in [first] + others:
+            thread.join()
+        self.assertEqual(flushed[0], [0])
+        self.assertEqual(sorted(flushed[1]), [1, 2, 3])
+        self.assertEqual(committer.flushes, 2)
+
+    def test_flush_error_raised_to_group(self):
+        def flush(items):
+            raise OSError('disk full')
+        committer = self._makeOne(flush)
+        self.assertRaises(OSError, committer.submit, 1)
+        self.assertEqual(committer.flushes, 0)
+
+
+class Test_sync_directories(_QueueTestBase):
+
+    def _callFUT(self, paths):
+        from pyramid_mailer.queue import sync_directories
+        return sync_directories(paths)
+
+    def test_it(self):
+        self._callFUT([self.tempdir, self.tempdir])
+
+    def test_tuples(self):
+        self._callFUT([(self.tempdir, self.tempdir), self.tempdir])
+
+    def test_missing(self):
+        self.assertRaises(
+            OSError, self._callFUT, [os.path.join(self.tempdir, 'missing')])
+
+
+class TestDedupIndex(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import DedupIndex
+        return DedupIndex
+
+    def _makeOne(self, ttl=3600):
+        return self._getTargetClass()(os.path.join(self.tempdir, 'ids'), ttl)
+
+    def test_add(self):
+        index = self._makeOne()
+        self.assertFalse('<a@example.com>' in index)
+        self.assertTrue(index.add('<a@example.com>'))
+        self.assertTrue('<a@example.com>' in index)
+        self.assertFalse(index.add('<a@example.com>'))
+        self.assertTrue(index.add('<b@example.com>'))
+
+    def test_remembers_previous_slots(self):
+        index = self._makeOne()
+        index.add('<a@example.com>')
+        [slot] = os.listdir(index.path)
+        os.rename(os.path.join(index.path, slot),
+                  os.path.join(index.path, '%d' % (int(slot) - 4)))
+        self.assertTrue('<a@example.com>' in index)
+        self.assertFalse(index.add('<a@example.com>'))
+
+    def test_expire(self):
+        index = self._makeOne()
+        index.add('<a@example.com>')
+        [slot] = os.listdir(index.path)
+        os.rename(os.path.join(index.path, slot),
+                  os.path.join(index.path, '%d' % (int(slot) - 5)))
+        self.assertFalse('<a@example.com>' in index)
+        index.expire()
+        self.assertEqual(os.listdir(index.path), [])
+
+    def test_new_slot_expires_old_ones(self):
+        index = self._makeOne()
+        os.makedirs(os.path.join(index.path, '1'))
+        self.assertTrue(index.add('<a@example.com>'))
+        self.assertEqual(len(os.listdir(index.path)), 1)
+
+
+class TestQueueCounters(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import QueueCounters
+        return QueueCounters
+
+    def _makeOne(self):
+        return self._getTargetClass()(
+            os.path.join(self.queue_path, 'counts.db'))
+
+    def test_empty(self):
+        self.assertEqual(self._makeOne().stats(), {
+            'queued': 0, 'retrying': 0, 'sending': 0, 'dead': 0,
+            'depth': 0, 'oldest': None})
+
+    def test_move_nothing(self):
+        counters = self._makeOne()
+        counters.move([])
+        self.assertEqual(counters.stats()['queued'], 0)
+
+    def test_move(self):
+        counters = self._makeOne()
+        counters.move([('600.1.host.1', None, 'queued'),
+                       ('659.1.host.2', None, 'queued'),
+                       ('1200.1.host.3', None, 'queued')])
+        counters.move([('600.1.host.1', 'queued', 'sending'),
+                       ('659.1.host.2', 'queued', 'sending'),
+                       ('660-600.1.host.1.retry1', 'sending', 'retrying'),
+                       ('659.1.host.2', 'sending', 'dead')])
+        stats = counters.stats()
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['retrying'], 1)
+        self.assertEqual(stats['sending'], 0)
+        self.assertEqual(stats['dead'], 1)
+        self.assertEqual(stats['depth'], 2)
+        self.assertEqual(stats['oldest'], 600)
+        counters.move([('600.1.host.1', 'retrying', None)])
+        self.assertEqual(counters.stats()['oldest'], 1200)
+        # rows which dropped to zero are removed
+        self.assertEqual(counters.db.execute(
+            'SELECT COUNT(*) FROM counts').fetchone()[0], 2)
+
+    def test_move_reset(self):
+        counters = self._makeOne()
+        counters.move([('600.1.host.1', None, 'queued')])
+        counters.move([('1200.1.host.3', None, 'sending')], reset=True)
+        stats = counters.stats()
+        self.assertEqual((stats['queued'], stats['sending']), (0, 1))
+        counters.move([], reset=True)
+        self.assertEqual(counters.stats()['depth'], 0)
+
+
+class TestMaildirQueue(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import MaildirQueue
+        return MaildirQueue
+
+    def _makeOne(self, **kw):
+        return self._getTargetClass()(self.queue_path, **kw)
+
+    def test_creates_maildir(self):
+        self._makeOne()
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_iter_oldest_first(self):
+        queue = self._makeOne()
+        self._enqueue(3)
+        names = self._listdir('new')
+        for index, name in enumerate(names):
+            os.utime(os.path.join(self.queue_path, 'new', name),
+                     (1000 - index, 1000 - index))
+        self.assertEqual(list(queue), list(reversed(names)))
+
+    def test_iter_skips_hidden_and_vanished(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = self._listdir('new')
+        new = os.path.join(self.queue_path, 'new')
+        open(os.path.join(new, '.hidden'), 'w').close()
+        # removed between listing and stat
+        os.symlink(os.path.join(self.tempdir, 'missing'),
+                   os.path.join(new, 'vanished'))
+        self.assertEqual(list(queue), [name])
+
+    def test_claim_once(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        path = queue.claim(name)
+        self.assertEqual(os.path.basename(path), '.sending-' + name)
+        self.assertEqual(queue.claim(name), None)
+        self.assertEqual(list(queue), [])
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_complete(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        queue.complete(queue.claim(name))
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_read_stream_corrupt(self):
+        queue = self._makeOne()
+        path = os.path.join(self.queue_path, 'new', 'corrupt')
+        with open(path, 'wb') as fp:
+            fp.write(b'\x1f\x8b' + b'\0' * 20)
+        claimed = queue.claim('corrupt')
+        self.assertRaises((OSError, EOFError), queue.read, claimed,
+                          stream=True)
+
+    def test_read_compressed_stream(self):
+        queue = self._makeOne()
+        self._enqueue(compression='lzma')
+        [name] = list(queue)
+        path = queue.claim(name)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(6), b'\xfd7zXZ\x00')
+        fromaddr, toaddrs, chunks = queue.read(path, stream=True)
+        self.assertEqual(toaddrs, ('a@example.com',))
+        message = b''.join(chunks)
+        self.assertTrue(b'\r\nSubject: testing 0\r\n' in message)
+        self.assertEqual(queue.read(path), (fromaddr, toaddrs, message))
+
+    def test_counters(self):
+        from pyramid_mailer.queue import QueueCounters
+        counters = QueueCounters(os.path.join(self.queue_path, 'counts.db'))
+        queue = self._makeOne(counters=counters)
+        self._enqueue(4, counters=counters)
+        self._enqueue(not_before=time.time() + 3600, counters=counters)
+        self.assertEqual(counters.stats()['queued'], 5)
+        first, second, third, fourth = queue.claim_many(list(queue))
+        self.assertEqual(counters.stats()['sending'], 4)
+        queue.complete(first)
+        queue.retry(second, time.time() + 3600)
+        queue.reject(third)
+        queue.release(fourth)
+        stats = queue.stats()
+        self.assertEqual(
+            [stats[state] for state in
+             ('queued', 'retrying', 'sending', 'dead', 'depth')],
+            [2, 1, 0, 1, 3])
+        self.assertTrue(time.time() - 60 < stats['oldest'] <= time.time())
+        # listing the queue agrees with the counters
+        self.assertEqual(self._makeOne().stats(), stats)
+        counters.move([], reset=True)
+        queue.recount()
+        self.assertEqual(queue.stats(), stats)
+
+    def test_release(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        queue.release(queue.claim(name))
+        self.assertEqual(list(queue), [name])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_reject(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        queue.reject(queue.claim(name))
+        self.assertEqual(list(queue), [])
+        self.assertEqual(self._listdir('cur'), [])
+        self.assertEqual(self._listdir('dead'), [name])
+
+    def test_retry(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        claimed = queue.claim(name)
+        self.assertEqual(queue.attempts(claimed), 0)
+        not_before = time.time() + 600
+        queue.retry(claimed, not_before)
+        self.assertEqual(list(queue), [])
+        self.assertEqual(self._listdir('cur'), [])
+        self.assertEqual(queue.promote(now=not_before + 60), 1)
+        [retried] = list(queue)
+        self.assertEqual(retried, '%d-%s.retry1' % (not_before + 1, name))
+        claimed = queue.claim(retried)
+        self.assertEqual(queue.attempts(claimed), 1)
+        queue.retry(claimed, time.time() - 1)
+        self.assertEqual(list(queue), [name + '.retry2'])
+
+    def _assertRetriedFor(self, compression=None):
+        queue = self._makeOne()
+        self._enqueue(recipients=('a@example.com', 'b@example.com'),
+                      compression=compression)
+        [name] = list(queue)
+        claimed = queue.claim(name)
+        fromaddr, toaddrs, message = queue.read(claimed)
+        queue.retry(claimed, time.time() - 1, ['b@example.com'])
+        [retried] = list(queue)
+        self.assertEqual(queue.read(queue.claim(retried)),
+                         (fromaddr, ('b@example.com',), message))
+        self.assertEqual(self._listdir('tmp'), [])
+
+    def test_retry_toaddrs(self):
+        self._assertRetriedFor()
+
+    def test_retry_toaddrs_compressed(self):
+        self._assertRetriedFor(compression='zlib')
+        [name] = self._listdir('cur')
+        with open(os.path.join(self.queue_path, 'cur', name), 'rb') as fp:
+            self.assertEqual(fp.read(2), b'\x1f\x8b')
+
+    def test_recover_stale_claims(self):
+        queue = self._makeOne(max_send_time=-1)
+        self._enqueue()
+        [name] = list(queue)
+        queue.claim(name)
+        self.assertEqual(queue.recover(), 1)
+        self.assertEqual(list(queue), [name])
+
+    def test_recover_skips_others_and_vanished(self):
+        from pyramid_mailer.queue import _CLAIMED
+        queue = self._makeOne(max_send_time=-1)
+        cur = os.path.join(self.queue_path, 'cur')
+        open(os.path.join(cur, 'seen'), 'w').close()
+        # completed between listing and stat
+        os.symlink(os.path.join(self.tempdir, 'missing'),
+                   os.path.join(cur, _CLAIMED + 'vanished'))
+        self.assertEqual(queue.recover(), 0)
+        self.assertEqual(list(queue), [])
+
+    def test_recover_keeps_recent_claims(self):
+        queue = self._makeOne()
+        self._enqueue()
+        [name] = list(queue)
+        queue.claim(name)
+        self.assertEqual(queue.recover(), 0)
+        self.assertEqual(list(queue), [])
+
+    def test_promote(self):
+        queue = self._makeOne()
+        not_before = time.time() + 3600
+        self._enqueue(2, not_before=not_before)
+        self.assertEqual(list(queue), [])
+        self.assertEqual(queue.promote(), 0)
+        self.assertEqual(queue.promote(now=not_before - 1), 0)
+        self.assertEqual(queue.promote(now=not_before + 1), 2)
+        self.assertEqual(len(list(queue)), 2)
+        self.assertEqual(queue.promote(now=not_before + 60), 0)
+        # the directory of the past minute is gone
+        self.assertEqual(self._listdir('scheduled'), [])
+
+    def test_promote_keeps_later_messages(self):
+        queue = self._makeOne()
+        now = time.time()
+        self._enqueue(not_before=now + 60)
+        self._enqueue(not_before=now + 7200)
+        self.assertEqual(queue.promote(now=now + 120), 1)
+        self.assertEqual(len(list(queue)), 1)
+        self.assertEqual(len(self._listdir('scheduled')), 1)
+
+    def test_promote_nothing_scheduled(self):
+        queue = self._makeOne()
+        self._enqueue(not_before=time.time() - 1)
+        self.assertEqual(queue.promote(), 0)
+        self.assertEqual(len(list(queue)), 1)
+
+    def test_promote_keeps_unknown_files(self):
+        queue = self._makeOne()
+        not_before = time.time() + 3600
+        self._enqueue(not_before=not_before)
+        [bucket] = self._listdir('scheduled')
+        open(os.path.join(self.queue_path, 'scheduled', bucket, 'junk'),
+             'w').close()
+        self.assertEqual(queue.promote(now=not_before + 120), 1)
+        self.assertEqual(self._listdir('scheduled'), [bucket])
+
+    def test_promote_race(self):
+        queue = self._makeOne()
+        not_before = time.time() + 3600
+        self._enqueue(2, not_before=not_before)
+        rename = os.rename
+        promoted = []
+
+        def racing_rename(source, target):
+            if not promoted:
+                # another processor promotes the message first
+                rename(source, target)
+                promoted.append(target)
+            rename(source, target)
+
+        os.rename = racing_rename
+        try:
+            self.assertEqual(queue.promote(now=not_before + 1), 1)
+        finally:
+            os.rename = rename
+        self.assertEqual(len(list(queue)), 2)
+
+
+class Test_scheduled_path(unittest.TestCase):
+
+    def _callFUT(self, path, not_before, name):
+        from pyramid_mailer.queue import scheduled_path
+        return scheduled_path(path, not_before, name)
+
+    def test_it(self):
+        self.assertEqual(
+            self._callFUT('/var/mail', 6000.5, 'abc'),
+            os.path.join('/var/mail', 'scheduled', '100', '6001-abc'))
+
+
+class Test_shard_index(unittest.TestCase):
+
+    def _callFUT(self, key, shards):
+        from pyramid_mailer.queue import shard_index
+        return shard_index(key, shards)
+
+    def test_it(self):
+        indexes = set(self._callFUT('<%d@example.com>' % index, 4)
+                      for index in range(100))
+        self.assertEqual(indexes, set(range(4)))
+        self.assertEqual(self._callFUT('<1@example.com>', 4),
+                         self._callFUT('<1@example.com>', 4))
+
+
+class TestShardedMaildirQueue(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import ShardedMaildirQueue
+        return ShardedMaildirQueue
+
+    def _makeOne(self, shards=4, **kw):
+        return self._getTargetClass()(self.queue_path, shards, **kw)
+
+    def _enqueueSharded(self, count, shards=4, not_before=None,
+                        counters=None):
+        import transaction
+        from pyramid_mailer.delivery import StreamingQueuedMailDelivery
+        from pyramid_mailer.message import Message
+        tm = transaction.TransactionManager()
+        delivery = StreamingQueuedMailDelivery(
+            self.queue_path, transaction_manager=tm, shards=shards,
+            counters=counters)
+        tm.begin()
+        for index in range(count):
+            message = Message(
+                subject='testing %d' % index, sender='sender@example.com',
+                recipients=['a@example.com'], body='hello')
+            delivery.send('sender@example.com', ['a@example.com'], message,
+                          not_before=not_before)
+        tm.commit()
+
+    def test_creates_shards(self):
+        self._makeOne()
+        self.assertEqual(sorted(os.listdir(self.queue_path)),
+                         ['00', '01', '02', '03'])
+
+    def test_iter_interleaves_shards(self):
+        queue = self._makeOne()
+        self._enqueueSharded(40)
+        entries = list(queue)
+        self.assertEqual(len(entries), 40)
+        first = [shard for shard, name in entries[:4]]
+        self.assertEqual(len(set(first)), 4)
+
+    def test_claim_read_complete(self):
+        queue = self._makeOne()
+        self._enqueueSharded(1)
+        [entry] = list(queue)
+        claimed = queue.claim(entry)
+        self.assertEqual(queue.claim(entry), None)
+        fromaddr, toaddrs, message = queue.read(claimed)
+        self.assertEqual(toaddrs, ('a@example.com',))
+        self.assertTrue(b'Subject: testing 0' in message)
+        queue.complete(claimed)
+        self.assertEqual(list(queue), [])
+
+    def test_counters(self):
+        from pyramid_mailer.queue import QueueCounters
+        counters = QueueCounters(os.path.join(self.tempdir, 'counts.db'))
+        queue = self._makeOne(counters=counters)
+        self._enqueueSharded(8, counters=counters)
+        claims = queue.claim_many(list(queue)[:5])
+        queue.complete(claims[0])
+        queue.reject(claims[1])
+        stats = queue.stats()
+        self.assertEqual(
+            [stats[state] for state in
+             ('queued', 'retrying', 'sending', 'dead', 'depth')],
+            [3, 0, 3, 1, 6])
+        self.assertEqual(self._makeOne().stats(), stats)
+        counters.move([], reset=True)
+        queue.recount()
+        self.assertEqual(queue.stats(), stats)
+
+    def test_release_and_reject(self):
+        queue = self._makeOne()
+        self._enqueueSharded(2)
+        first, second = list(queue)
+        queue.release(queue.claim(first))
+        queue.reject(queue.claim(second))
+        self.assertEqual(list(queue), [first])
+        claimed = queue.claim(first)
+        self.assertEqual(queue.attempts(claimed), 0)
+        queue.retry(claimed, 0)
+        self.assertEqual(list(queue), [(first[0], first[1] + '.retry1')])
+
+    def test_recover(self):
+        queue = self._makeOne(max_send_time=-1)
+        self._enqueueSharded(3)
+        for entry in list(queue):
+            queue.claim(entry)
+        self.assertEqual(queue.recover(), 3)
+        self.assertEqual(len(list(queue)), 3)
+
+    def test_promote(self):
+        queue = self._makeOne()
+        not_before = time.time() + 3600
+        self._enqueueSharded(8, not_before=not_before)
+        self.assertEqual(list(queue), [])
+        self.assertEqual(queue.promote(now=not_before + 1), 8)
+        self.assertEqual(len(list(queue)), 8)
+
+    def test_processor(self):
+        from pyramid_mailer.queue import QueueProcessor
+        mailer = DummyMailer()
+        self._enqueueSharded(20)
+        processor = QueueProcessor(mailer, self._makeOne(), workers=3)
+        self.assertEqual(processor.send_messages(), 20)
+        self.assertEqual(len(mailer.sent), 20)
+        self.assertEqual(list(self._makeOne()), [])
+
+
+class Test_lane_path(unittest.TestCase):
+
+    def _callFUT(self, queue_path, lane):
+        from pyramid_mailer.queue import lane_path
+        return lane_path(queue_path, lane)
+
+    def test_default(self):
+        self.assertEqual(self._callFUT('/var/mail', 'default'), '/var/mail')
+
+    def test_lane(self):
+        self.assertEqual(self._callFUT('/var/mail', 'urgent'),
+                         os.path.join('/var/mail', '.urgent'))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, '/var/mail', '../x')
+        self.assertRaises(ValueError, self._callFUT, '/var/mail', '')
+
+
+class DummyLane(object):
+
+    def __init__(self, *names):
+        self.pending = list(names)
+        self.claimed = []
+        self.completed = []
+        self.released = []
+        self.rejected = []
+        self.retried = []
+        self.recovered = 0
+
+    def __iter__(self):
+        return iter(list(self.pending))
+
+    def claim(self, name):
+        claims = self.claim_many([name])
+        return claims[0] if claims else None
+
+    def claim_many(self, names):
+        claims = [name for name in names if name in self.pending]
+        for name in claims:
+            self.pending.remove(name)
+        self.claimed.extend(claims)
+        return claims
+
+    def read(self, name, stream=False):
+        return 'sender@example.com', ('a@example.com',), name.encode('ascii')
+
+    def complete(self, name):
+        self.completed.append(name)
+
+    def release(self, name):
+        self.released.append(name)
+        self.pending.append(name)
+
+    def attempts(self, name):
+        return 3
+
+    def retry(self, name, not_before, toaddrs=None):
+        self.retried.append((name, not_before, toaddrs))
+
+    def reject(self, name):
+        self.rejected.append(name)
+
+    def promote(self, now=None):
+        return 0
+
+    def recover(self):
+        self.recovered += 1
+        return 1
+
+
+class TestLaneQueue(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import LaneQueue
+        return LaneQueue
+
+    def _makeOne(self, lanes, **kw):
+        return self._getTargetClass()(lanes, **kw)
+
+    def test_weighted_turns(self):
+        high = DummyLane('a1', 'a2', 'a3', 'a4', 'a5')
+        low = DummyLane('b1', 'b2', 'b3')
+        queue = self._makeOne([(high, 2), (low, 1)])
+        self.assertEqual(
+            [name for index, name in queue],
+            ['a1', 'a2', 'b1', 'a3', 'a4', 'b2', 'a5', 'b3'])
+
+    def test_empty(self):
+        queue = self._makeOne([(DummyLane(), 1), (DummyLane(), 1)])
+        self.assertEqual(list(queue), [])
+
+    def test_picks_up_new_high_priority_entries(self):
+        high = DummyLane()
+        low = DummyLane('l1', 'l2', 'l3')
+        queue = self._makeOne([(high, 1), (low, 1)], refresh=0)
+        entries = iter(queue)
+        self.assertEqual(next(entries), (1, 'l1'))
+        high.pending.append('u1')
+        self.assertEqual(list(entries), [(0, 'u1'), (1, 'l2'), (1, 'l3')])
+
+    def test_refresh_limits_listing(self):
+        high = DummyLane()
+        low = DummyLane('l1', 'l2')
+        queue = self._makeOne([(high, 1), (low, 1)], refresh=3600)
+        entries = iter(queue)
+        self.assertEqual(next(entries), (1, 'l1'))
+        high.pending.append('u1')
+        self.assertEqual(next(entries), (1, 'l2'))
+        # relisted before giving up
+        self.assertEqual(list(entries), [(0, 'u1')])
+
+    def test_released_entries_wait_for_next_iteration(self):
+        lane = DummyLane('a1', 'a2')
+        queue = self._makeOne([(lane, 1)], refresh=0)
+        entries = iter(queue)
+        entry = next(entries)
+        queue.release(queue.claim(entry))
+        self.assertEqual(list(entries), [(0, 'a2')])
+        self.assertEqual(list(queue), [(0, 'a2'), (0, 'a1')])
+
+    def test_claim_many_by_lane(self):
+        high = DummyLane('a1', 'a2')
+        low = DummyLane('b1')
+        queue = self._makeOne([(high, 1), (low, 1)])
+        claims = queue.claim_many([(0, 'a1'), (1, 'b1'), (0, 'a2'),
+                                   (1, 'b1')])
+        self.assertEqual(claims, [(0, 'a1'), (1, 'b1'), (0, 'a2')])
+        self.assertEqual(queue.claim((0, 'a1')), None)
+
+    def test_delegates(self):
+        high = DummyLane('a1', 'a2', 'a3')
+        low = DummyLane('b1')
+        queue = self._makeOne([(high, 1), (low, 1)])
+        self.assertEqual(queue.read((1, 'b1')),
+                         ('sender@example.com', ('a@example.com',), b'b1'))
+        queue.complete(queue.claim((0, 'a1')))
+        queue.reject(queue.claim((0, 'a2')))
+        queue.release(queue.claim((1, 'b1')))
+        self.assertEqual(high.completed, ['a1'])
+        self.assertEqual(high.rejected, ['a2'])
+        self.assertEqual(low.released, ['b1'])
+        self.assertEqual(queue.attempts((0, 'a3')), 3)
+        queue.retry(queue.claim((0, 'a3')), 10)
+        self.assertEqual(high.retried, [('a3', 10, None)])
+        self.assertEqual(queue.recover(), 2)
+
+    def test_processor_drains_high_lane_first(self):
+        from pyramid_mailer.queue import QueueProcessor
+        high = DummyLane('a1', 'a2', 'a3')
+        low = DummyLane('b1', 'b2', 'b3')
+        queue = self._makeOne([(high, 3), (low, 1)])
+        mailer = DummyMailer()
+        processor = QueueProcessor(mailer, queue, workers=1, batch_size=2)
+        self.assertEqual(processor.send_messages(), 6)
+        self.assertEqual(
+            [message for fromaddr, toaddrs, message in mailer.sent],
+            [b'a1', b'a2', b'a3', b'b1', b'b2', b'b3'])
+
+
+class TestSQLiteQueue(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import SQLiteQueue
+        return SQLiteQueue
+
+    def _makeOne(self, **kw):
+        return self._getTargetClass()(
+            os.path.join(self.tempdir, 'queue.db'), **kw)
+
+    def _add(self, queue, count=1):
+        queue.add_many([
+            ('<%d@example.com>' % index, 'sender@example.com',
+             ['a@example.com', 'b@example.com'],
+             b'Subject: testing %d\r\n\r\nbody\r\n' % index)
+            for index in range(count)])
+
+    def test_add_many_group_commit(self):
+        queue = self._makeOne(commit_latency=0)
+        self.assertEqual(queue.committer.max_latency, 0)
+        self._add(queue, 2)
+        self._add(queue, 1)
+        self.assertEqual(len(list(queue)), 3)
+        self.assertEqual(queue.committer.flushes, 2)
+
+    def test_add_many_concurrent_group_commit(self):
+        queue = self._makeOne(commit_latency=10)
+        queue.committer.max_size = 4
+        threads = [threading.Thread(target=self._add, args=(queue,))
+                   for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(list(queue)), 4)
+        self.assertEqual(queue.committer.flushes, 1)
+
+    def test_read_compressed(self):
+        from pyramid_mailer.queue import compress_queued
+        queue = self._makeOne()
+        data = b'Subject: testing\r\n\r\nbody\r\n'
+        queue.add_many([('<0@example.com>', 'sender@example.com',
+                         ['a@example.com'], compress_queued(data, 'zlib'))])
+        [rowid] = queue.claim_many(list(queue))
+        self.assertEqual(queue.read(rowid),
+                         ('sender@example.com', ('a@example.com',), data))
+        fromaddr, toaddrs, chunks = queue.read(rowid, stream=True)
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_lanes(self):
+        default = self._makeOne()
+        urgent = self._makeOne(lane='urgent')
+        self._add(default, 2)
+        self._add(urgent, 1)
+        self.assertEqual(len(list(default)), 2)
+        [entry] = list(urgent)
+        urgent.claim(entry)
+        urgent.max_send_time = -1
+        self.assertEqual(default.recover(), 0)
+        self.assertEqual(urgent.recover(), 1)
+
+    def test_stats(self):
+        default = self._makeOne()
+        urgent = self._makeOne(lane='urgent')
+        self._add(default, 5)
+        self._add(urgent, 1)
+        first, second, third = default.claim_many(list(default)[:3])
+        default.complete(first)
+        default.retry(second, time.time() + 60)
+        default.reject(third)
+        stats = default.stats()
+        self.assertEqual(
+            [stats[state] for state in
+             ('queued', 'retrying', 'sending', 'dead', 'depth')],
+            [2, 1, 0, 1, 3])
+        self.assertTrue(time.time() - 60 < stats['oldest'] <= time.time())
+        self.assertEqual(urgent.stats()['queued'], 1)
+        default.recount()
+        self.assertEqual(default.stats(), stats)
+
+    def test_stats_of_existing_database(self):
+        queue = self._makeOne()
+        self._add(queue, 2)
+        queue.db.execute('DROP TABLE counts')
+        self.assertEqual(self._makeOne().stats()['queued'], 2)
+
+    def test_not_before(self):
+        queue = self._makeOne()
+        now = time.time()
+        queue.add_many([
+            ('<1@example.com>', 'sender@example.com', ['a@example.com'],
+             b'later', now + 3600),
+            ('<2@example.com>', 'sender@example.com', ['a@example.com'],
+             b'due', now - 1),
+            ])
+        [entry] = list(queue)
+        self.assertEqual(queue.read(entry)[2], b'due')
+        self.assertEqual(queue.promote(), 0)
+
+    def test_retry(self):
+        queue = self._makeOne()
+        self._add(queue, 1)
+        [entry] = list(queue)
+        [claimed] = queue.claim_many([entry])
+        self.assertEqual(queue.attempts(claimed), 0)
+        queue.retry(claimed, time.time() + 600)
+        self.assertEqual(list(queue), [])
+        self.assertEqual(queue.attempts(claimed), 1)
+        queue.retry(queue.claim(entry), time.time() - 1)
+        self.assertEqual(list(queue), [entry])
+        self.assertEqual(queue.attempts(entry), 2)
+
+    def test_retry_toaddrs(self):
+        queue = self._makeOne()
+        self._add(queue, 1)
+        [entry] = list(queue)
+        queue.retry(queue.claim(entry), time.time() - 1, ['b@example.com'])
+        self.assertEqual(queue.read(queue.claim(entry)),
+                         ('sender@example.com', ('b@example.com',),
+                          b'Subject: testing 0\r\n\r\nbody\r\n'))
+
+    def test_iter_pages(self):
+        from pyramid_mailer import queue as module
+        queue = self._makeOne()
+        self._add(queue, 3)
+        queue.add_many([
+            ('<late@example.com>', 'sender@example.com', ['a@example.com'],
+             b'Subject: late\r\n\r\nbody\r\n', 1)])
+        self._add(queue, 2)
+        ids = [row[0] for row in queue.db.execute(
+            'SELECT id FROM messages ORDER BY not_before, id')]
+        page = module._PAGE
+        module._PAGE = 2
+        try:
+            self.assertEqual(list(queue), ids)
+            entries = iter(queue)
+            self.assertEqual(next(entries), ids[0])
+            # claimed by another processor before the next page is listed
+            queue.claim_many(ids[2:4])
+            self.assertEqual(list(entries), [ids[1]] + ids[4:])
+        finally:
+            module._PAGE = page
+
+    def test_dedup(self):
+        queue = self._makeOne(dedup_ttl=3600)
+        self._add(queue, 2)
+        self._add(queue, 3)
+        self.assertEqual(len(list(queue)), 3)
+        queue.dedup_ttl = -1
+        self._add(queue, 1)
+        self.assertEqual(len(list(queue)), 4)
+
+    def test_dedup_without_id(self):
+        queue = self._makeOne(dedup_ttl=3600)
+        for attempt in range(2):
+            queue.add_many([
+                ('<0@example.com>', 'sender@example.com', ['a@example.com'],
+                 b'Subject: testing\r\n\r\nbody\r\n', None, None)])
+        self.assertEqual(len(list(queue)), 2)
+        ids = queue.db.execute('SELECT COUNT(*) FROM message_ids')
+        self.assertEqual(ids.fetchone()[0], 0)
+
+    def test_wal_mode(self):
+        queue = self._makeOne()
+        mode = queue.db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_add_many_and_read(self):
+        queue = self._makeOne()
+        self._add(queue, 3)
+        entries = list(queue)
+        self.assertEqual(len(entries), 3)
+        [claimed] = queue.claim_many(entries[:1])
+        self.assertEqual(queue.read(claimed), (
+            'sender@example.com', ('a@example.com', 'b@example.com'),
+            b'Subject: testing 0\r\n\r\nbody\r\n'))
+
+    def test_claim_many_once(self):
+        queue = self._makeOne()
+        self._add(queue, 3)
+        entries = list(queue)
+        self.assertEqual(queue.claim_many(entries[:2]), entries[:2])
+        self.assertEqual(queue.claim_many(entries), entries[2:])
+        self.assertEqual(queue.claim(entries[0]), None)
+        self.assertEqual(queue.claim_many([]), [])
+        self.assertEqual(list(queue), [])
+
+    def test_claim_from_other_thread(self):
+        queue = self._makeOne()
+        self._add(queue, 2)
+        entries = list(queue)
+        claimed = []
+        thread = threading.Thread(
+            target=lambda: claimed.extend(queue.claim_many(entries)))
+        thread.start()
+        thread.join()
+        self.assertEqual(claimed, entries)
+        self.assertEqual(queue.claim_many(entries), [])
+
+    def test_complete_release_reject(self):
+        queue = self._makeOne()
+        self._add(queue, 3)
+        first, second, third = queue.claim_many(list(queue))
+        queue.complete(first)
+        queue.release(second)
+        queue.reject(third)
+        self.assertEqual(list(queue), [second])
+        count = queue.db.execute(
+            'SELECT count(*) FROM messages WHERE rejected = 1').fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_recover(self):
+        queue = self._makeOne(max_send_time=-1)
+        self._add(queue, 2)
+        queue.claim_many(list(queue))
+        self.assertEqual(queue.recover(), 2)
+        self.assertEqual(len(list(queue)), 2)
+
+    def test_recover_keeps_recent_claims(self):
+        queue = self._makeOne()
+        self._add(queue, 2)
+        queue.claim_many(list(queue))
+        self.assertEqual(queue.recover(), 0)
+        self.assertEqual(list(queue), [])
+
+    def test_add_many_rolls_back(self):
+        queue = self._makeOne()
+        self.assertRaises(Exception, queue.add_many, [
+            ('<1@example.com>', 'sender@example.com', ['a@example.com'],
+             b'data'),
+            ('<2@example.com>', None, ['a@example.com'], b'data'),
+            ])
+        self.assertEqual(list(queue), [])
+
+    def test_processor(self):
+        from pyramid_mailer.queue import QueueProcessor
+        mailer = DummyMailer()
+        queue = self._makeOne()
+        self._add(queue, 25)
+        processor = QueueProcessor(mailer, queue, workers=3, batch_size=4)
+        self.assertEqual(processor.send_messages(), 25)
+        self.assertEqual(len(mailer.sent), 25)
+        self.assertEqual(list(queue), [])
+
+
+class TestQueueProcessor(_QueueTestBase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.queue import QueueProcessor
+        return QueueProcessor
+
+    def _makeOne(self, mailer, workers=1):
+        return self._getTargetClass()(mailer, self.queue_path, workers)
+
+    def test_send_messages(self):
+        mailer = DummyMailer()
+        processor = self._makeOne(mailer)
+        self._enqueue(recipients=('a@example.com', 'b@example.com'))
+        self.assertEqual(processor.send_messages(), 1)
+        [(fromaddr, toaddrs, message)] = mailer.sent
+        self.assertEqual(fromaddr, 'sender@example.com')
+        self.assertEqual(toaddrs, ('a@example.com', 'b@example.com'))
+        self.assertFalse(b'X-Actually' in message)
+        self.assertTrue(b'\r\nSubject: testing 0\r\n' in message)
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_send_messages_repoze_queue(self):
+        import transaction
+        from repoze.sendmail.delivery import QueuedMailDelivery
+        from pyramid_mailer.message import Message
+        tm = transaction.TransactionManager()
+        delivery = QueuedMailDelivery(self.queue_path, tm)
+        tm.begin()
+        delivery.send('sender@example.com', ['a@example.com'], Message(
+            subject='testing', sender='sender@example.com',
+            recipients=['a@example.com'], body='hello').to_message())
+        tm.commit()
+        mailer = DummyMailer()
+        self.assertEqual(self._makeOne(mailer).send_messages(), 1)
+        [(fromaddr, toaddrs, message)] = mailer.sent
+        self.assertEqual(toaddrs, ('a@example.com',))
+        self.assertEqual(message.count(b'\n'), message.count(b'\r\n'))
+
+    def test_send_messages_stream(self):
+        class StreamMailer(DummyMailer):
+            def send(self, fromaddr, toaddrs, chunks):
+                self.chunks = chunks
+                return DummyMailer.send(
+                    self, fromaddr, toaddrs, next(chunks))
+        mailer = StreamMailer()
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, stream=True)
+        self._enqueue(compression='zlib')
+        self.assertEqual(processor.send_messages(), 1)
+        [(fromaddr, toaddrs, headers)] = mailer.sent
+        self.assertEqual(toaddrs, ('a@example.com',))
+        self.assertTrue(b'\r\nSubject: testing 0\r\n' in headers)
+        # the rest of the stream was not read; its file has been closed
+        self.assertEqual(list(mailer.chunks), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_send_messages_many_workers(self):
+        mailer = DummyMailer()
+        self._enqueue(50)
+        processors = [self._makeOne(mailer, workers=4) for i in range(2)]
+        threads = [threading.Thread(target=processor.send_messages)
+                   for processor in processors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        subjects = sorted(
+            message.split(b'Subject: ')[1].split(b'\r\n')[0]
+            for fromaddr, toaddrs, message in mailer.sent)
+        self.assertEqual(
+            subjects,
+            sorted(b'testing %d' % index for index in range(50)))
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_permanent_error_rejects(self):
+        mailer = DummyMailer(smtplib.SMTPDataError(554, 'rejected'))
+        self._enqueue()
+        self.assertEqual(self._makeOne(mailer).send_messages(), 0)
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+        self.assertEqual(len(self._listdir('dead')), 1)
+
+    def test_login_refused_keeps_messages(self):
+        mailer = DummyMailer(smtplib.SMTPAuthenticationError(
+            535, 'authentication failed'))
+        self._enqueue(3)
+        names = self._listdir('new')
+        processor = self._makeOne(mailer)
+        self.assertEqual(processor.send_messages(), 0)
+        self.assertEqual(self._listdir('new'), names)
+        self.assertEqual(self._listdir('cur'), [])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.queue_path, 'dead')))
+        mailer.error = None
+        self.assertEqual(processor.send_messages(), 3)
+
+    def test_all_recipients_refused_permanently(self):
+        mailer = DummyMailer(smtplib.SMTPRecipientsRefused(
+            {'a@example.com': (550, 'unknown')}))
+        self._enqueue()
+        self._makeOne(mailer).send_messages()
+        self.assertEqual(len(self._listdir('dead')), 1)
+
+    def test_transient_error_retries_later(self):
+        mailer = DummyMailer(smtplib.SMTPDataError(451, 'try again'))
+        self._enqueue()
+        processor = self._makeOne(mailer)
+        before = time.time()
+        self.assertEqual(processor.send_messages(), 0)
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+        [bucket] = self._listdir('scheduled')
+        # retried after 30 to 60 seconds
+        self.assertTrue(before // 60 <= int(bucket) <= before // 60 + 2)
+        self.assertEqual(processor.queue.promote(now=before + 120), 1)
+        [name] = self._listdir('new')
+        self.assertTrue(name.endswith('.retry1'))
+
+    def _makeRefusingMailer(self, *refusals):
+        class RefusingMailer(DummyMailer):
+            def send(self, fromaddr, toaddrs, message):
+                DummyMailer.send(self, fromaddr, toaddrs, message)
+                return dict((addr, reply) for addr, reply in refusals[
+                    len(self.sent) - 1].items() if addr in toaddrs)
+        return RefusingMailer()
+
+    def test_temporarily_refused_recipients_retried(self):
+        mailer = self._makeRefusingMailer(
+            {'b@example.com': (450, 'busy'),
+             'c@example.com': (550, 'unknown')},
+            {})
+        self._enqueue(
+            recipients=('a@example.com', 'b@example.com', 'c@example.com'))
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, retry_delay=0)
+        self.assertEqual(processor.send_messages(), 1)
+        [name] = self._listdir('new')
+        self.assertTrue(name.endswith('.retry1'))
+        self.assertEqual(processor.send_messages(), 1)
+        self.assertEqual(
+            [toaddrs for fromaddr, toaddrs, message in mailer.sent],
+            [('a@example.com', 'b@example.com', 'c@example.com'),
+             ('b@example.com',)])
+        self.assertEqual(mailer.sent[0][2], mailer.sent[1][2])
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_temporarily_refused_recipients_max_attempts(self):
+        mailer = self._makeRefusingMailer(
+            {'b@example.com': (450, 'busy')},
+            {'b@example.com': (450, 'busy')})
+        self._enqueue(recipients=('a@example.com', 'b@example.com'))
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, retry_delay=0, max_attempts=2)
+        processor.send_messages()
+        processor.send_messages()
+        self.assertEqual(len(mailer.sent), 2)
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.queue_path, 'dead')))
+
+    def test_permanently_refused_recipients_completed(self):
+        mailer = self._makeRefusingMailer({'b@example.com': (550, 'no')})
+        self._enqueue(recipients=('a@example.com', 'b@example.com'))
+        self.assertEqual(self._makeOne(mailer).send_messages(), 1)
+        self.assertEqual(self._listdir('new'), [])
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_connection_error_retries(self):
+        import socket
+        mailer = DummyMailer(socket.error('refused'))
+        self._enqueue()
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, retry_delay=0)
+        processor.send_messages()
+        [name] = self._listdir('new')
+        self.assertTrue(name.endswith('.retry1'))
+
+    def test_max_attempts(self):
+        mailer = DummyMailer(smtplib.SMTPDataError(451, 'try again'))
+        self._enqueue()
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, retry_delay=0, max_attempts=3)
+        for attempt in range(3):
+            self.assertEqual(len(self._listdir('new')), 1)
+            processor.send_messages()
+        self.assertEqual(self._listdir('new'), [])
+        [name] = self._listdir('dead')
+        self.assertTrue(name.endswith('.retry2'))
+
+    def test_retry_delay(self):
+        processor = self._getTargetClass()(
+            None, self.queue_path, retry_delay=10, max_retry_delay=100)
+        for attempts, longest in [(1, 10), (2, 20), (4, 80), (5, 100),
+                                  (20, 100)]:
+            delay = processor._retry_delay(attempts)
+            self.assertTrue(longest / 2 <= delay <= longest)
+
+    def test_send_messages_in_batches(self):
+        mailer = DummyMailer()
+        self._enqueue(10)
+        processor = self._getTargetClass()(
+            mailer, self.queue_path, workers=2, batch_size=3)
+        self.assertEqual(processor.send_messages(), 10)
+        self.assertEqual(len(mailer.sent), 10)
+
+    def test_stop_releases_claimed_batch(self):
+        self._enqueue(3)
+        processor = self._getTargetClass()(
+            None, self.queue_path, batch_size=3)
+
+        class StoppingMailer(DummyMailer):
+            def send(self, fromaddr, toaddrs, message):
+                processor.stop()
+                return DummyMailer.send(self, fromaddr, toaddrs, message)
+        processor.mailer = StoppingMailer()
+        self.assertEqual(processor.send_messages(), 1)
+        self.assertEqual(len(self._listdir('new')), 2)
+        self.assertEqual(self._listdir('cur'), [])
+
+    def test_send_messages_promotes_due(self):
+        mailer = DummyMailer()
+        processor = self._makeOne(mailer)
+        self._enqueue(not_before=time.time() + 3600)
+        self.assertEqual(processor.send_messages(), 0)
+        [bucket] = self._listdir('scheduled')
+        directory = os.path.join(self.queue_path, 'scheduled', bucket)
+        [name] = os.listdir(directory)
+        # the time has come
+        os.rename(os.path.join(directory, name),
+                  os.path.join(directory, '1-' + name.partition('-')[2]))
+        os.rename(directory,
+                  os.path.join(self.queue_path, 'scheduled', '0'))
+        self.assertEqual(processor.send_messages(), 1)
+        self.assertEqual(len(mailer.sent), 1)
+
+    def test_run_until_stopped(self):
+        mailer = DummyMailer()
+        processor = self._makeOne(mailer)
+        self._enqueue()
+        thread = threading.Thread(target=processor.run, args=(0.01,))
+        thread.start()
+        processor.stop()
+        thread.join()
+        self.assertTrue(len(mailer.sent) <= 1)
+
+
+class Test_main(_QueueTestBase):
+
+    def _callFUT(self, argv):
+        from pyramid_mailer.queue import main
+        return main(argv)
+
+    def test_empty_queue(self):
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path})
+        self.assertEqual(self._callFUT(['pmailqp', config, '--workers', '2']),
+                         0)
+        self.assertEqual(self._listdir('new'), [])
+
+    def test_hosts_pool_size(self):
+        from pyramid_mailer import queue
+        processors = []
+
+        class DummyProcessor(object):
+            def __init__(self, pool, *args, **kw):
+                self.pool = pool
+                processors.append(self)
+
+            def send_messages(self):
+                return 0
+
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path,
+                                      'mail.hosts': 'mx1 mx2'})
+        original, queue.QueueProcessor = queue.QueueProcessor, DummyProcessor
+        try:
+            self.assertEqual(
+                self._callFUT(['pmailqp', config, '--workers', '3']), 0)
+        finally:
+            queue.QueueProcessor = original
+        [processor] = processors
+        self.assertEqual([host.pool.size for host in processor.pool.hosts],
+                         [3, 3])
+
+    def test_interval_interrupted(self):
+        from pyramid_mailer import queue
+        processors = []
+
+        class DummyProcessor(object):
+            stopped = False
+
+            def __init__(self, pool, *args, **kw):
+                self.pool = pool
+                processors.append(self)
+
+            def run(self, interval):
+                self.interval = interval
+                raise KeyboardInterrupt
+
+            def stop(self):
+                self.stopped = True
+
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path})
+        original, queue.QueueProcessor = queue.QueueProcessor, DummyProcessor
+        try:
+            self.assertEqual(
+                self._callFUT(['pmailqp', config, '--interval', '5']), 0)
+        finally:
+            queue.QueueProcessor = original
+        [processor] = processors
+        self.assertEqual(processor.interval, 5)
+        self.assertTrue(processor.stopped)
+
+    def test_retry_options(self):
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path})
+        self.assertEqual(self._callFUT(
+            ['pmailqp', config, '--retry-delay', '5', '--max-retry-delay',
+             '50', '--max-attempts', '0']), 0)
+
+    def test_sharded_queue(self):
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path,
+                                      'mail.queue_shards': '3'})
+        self.assertEqual(self._callFUT(['pmailqp', config]), 0)
+        self.assertEqual(sorted(os.listdir(self.queue_path)),
+                         ['00', '01', '02'])
+
+    def test_sqlite_queue(self):
+        path = os.path.join(self.tempdir, 'queue.db')
+        config = self._writeConfig(**{'mail.queue_path': path,
+                                      'mail.queue_backend': 'sqlite'})
+        self.assertEqual(
+            self._callFUT(['pmailqp', config, '--batch-size', '10']), 0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_lanes(self):
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path,
+                                      'mail.queue_lanes': 'urgent:5 bulk'})
+        self.assertEqual(self._callFUT(['pmailqp', config]), 0)
+        self.assertEqual(
+            sorted(os.listdir(self.queue_path)),
+            ['.bulk', '.urgent', 'cur', 'new', 'tmp'])
+
+    def test_no_queue_path(self):
+        import io
+        import sys
+        config = self._writeConfig(**{'mail.host': 'localhost'})
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            self.assertRaises(SystemExit, self._callFUT, ['pmailqp', config])
+            self.assertTrue('mail.queue_path' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+
+class Test_stat_main(_QueueTestBase):
+
+    def _callFUT(self, argv):
+        import io
+        from pyramid_mailer.queue import stat_main
+        out = io.StringIO()
+        self.assertEqual(stat_main(argv, out), 0)
+        return out.getvalue()
+
+    def test_counters(self):
+        from pyramid_mailer.queue import QueueCounters
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path,
+                                      'mail.queue_counters': 'true',
+                                      'mail.queue_lanes': 'urgent:5'})
+        self._enqueue(3, counters=QueueCounters(
+            os.path.join(self.queue_path, 'counts.db')))
+        lines = self._callFUT(['pmailqstat', config]).splitlines()
+        self.assertEqual(lines[0].split(), [
+            'lane', 'depth', 'queued', 'retrying', 'sending', 'dead',
+            'oldest'])
+        self.assertEqual(lines[1].split(),
+                         ['urgent', '0', '0', '0', '0', '0', '-'])
+        self.assertEqual(lines[2].split()[:3], ['default', '3', '3'])
+        self.assertTrue(lines[2].split()[-1].endswith('s'))
+
+    def test_json_recount(self):
+        import json
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path,
+                                      'mail.queue_counters': 'true'})
+        # queued without counting them
+        self._enqueue(2)
+        stats = json.loads(self._callFUT(['pmailqstat', config, '--json']))
+        self.assertEqual(stats['default']['queued'], 0)
+        stats = json.loads(self._callFUT(
+            ['pmailqstat', config, '--json', '--recount']))
+        self.assertEqual(stats['default']['queued'], 2)
+
+    def test_sqlite_queue(self):
+        import json
+        path = os.path.join(self.tempdir, 'queue.db')
+        config = self._writeConfig(**{'mail.queue_path': path,
+                                      'mail.queue_backend': 'sqlite'})
+        stats = json.loads(self._callFUT(
+            ['pmailqstat', config, '--json', '--recount']))
+        self.assertEqual(stats['default']['depth'], 0)
+
+    def test_listed_without_counters(self):
+        import json
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path})
+        self._enqueue(2)
+        stats = json.loads(self._callFUT(['pmailqstat', config, '--json']))
+        self.assertEqual(stats['default']['queued'], 2)
+
+    def test_no_queue_path(self):
+        import io
+        import sys
+        config = self._writeConfig(**{'mail.host': 'localhost'})
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            self.assertRaises(SystemExit, self._callFUT,
+                              ['pmailqstat', config])
+            self.assertTrue('mail.queue_path' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+    def test_recount_without_counters(self):
+        import io
+        import sys
+        config = self._writeConfig(**{'mail.queue_path': self.queue_path})
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            self.assertRaises(SystemExit, self._callFUT,
+                              ['pmailqstat', config, '--recount'])
+            self.assertTrue('mail.queue_counters' in sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+
+
+class Test_age(unittest.TestCase):
+
+    def _callFUT(self, seconds):
+        from pyramid_mailer.queue import _age
+        return _age(seconds)
+
+    def test_it(self):
+        self.assertEqual(self._callFUT(42.5), '42s')
+        self.assertEqual(self._callFUT(125), '2m5s')
+        self.assertEqual(self._callFUT(7500), '2h5m')
+        self.assertEqual(self._callFUT(3 * 86400 + 4 * 3600), '3d4h')
@@ -0,0 +1,69 @@
+import unittest
+
+
+class TestRecipientRouter(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from pyramid_mailer.routing import RecipientRouter
+        return RecipientRouter
+
+    def _makeOne(self, routes=None, default='default'):
+        if routes is None:
+            routes = [('example.com', 'internal'),
+                      ('*.example.com', 'internal-sub'),
+                      ('*.eu.example.com', 'europe'),
+                      ('gmail.com', 'google'),
+                      ('googlemail.com', 'google')]
+        return self._getTargetClass()(routes, default=default)
+
+    def test_exact(self):
+        router = self._makeOne()
+        self.assertEqual(router.route('a@example.com'), 'internal')
+        self.assertEqual(router.route('a@Gmail.COM'), 'google')
+
+    def test_subdomain(self):
+        router = self._makeOne()
+        self.assertEqual(router.route('a@mx.example.com'), 'internal-sub')
+        self.assertEqual(router.route('a@eu.example.com'), 'internal-sub')
+
+    def test_longest_suffix(self):
+        router = self._makeOne()
+        self.assertEqual(router.route('a@de.eu.example.com'), 'europe')
+
+    def test_default(self):
+        router = self._makeOne()
+        self.assertEqual(router.route('a@example.org'), 'default')
+        self.assertEqual(router.route('a@notexample.com'), 'default')
+
+    def test_catch_all(self):
+        router = self._makeOne([('gmail.com', 'google'), ('*', 'other')])
+        self.assertEqual(router.default, 'other')
+        self.assertEqual(router.route('a@example.org'), 'other')
+
+    def test_display_name(self):
+        router = self._makeOne()
+        self.assertEqual(router.route('Tester <a@example.com>'), 'internal')
+
+    def test_first_route_wins(self):
+        router = self._makeOne([('example.com', 'one'),
+                                ('example.com', 'two')])
+        self.assertEqual(router.route('a@example.com'), 'one')
+
+    def test_invalid_patterns(self):
+        for pattern in ('', '*.', 'a*.example.com', 'user@example.com'):
+            self.assertRaises(ValueError, self._makeOne, [(pattern, 'x')])
+
+    def test_split(self):
+        router = self._makeOne()
+        groups = router.split([
+            'a@gmail.com', 'b@example.org', 'c@example.com',
+            'd@googlemail.com', 'e@GMAIL.com'])
+        self.assertEqual(groups, [
+            ('google', ['a@gmail.com', 'd@googlemail.com', 'e@GMAIL.com']),
+            ('default', ['b@example.org']),
+            ('internal', ['c@example.com']),
+        ])
+
+    def test_split_empty(self):
+        router = self._makeOne()
+        self.assertEqual(router.split([]), [])
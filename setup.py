@@ -40,6 +40,7 @@ setup(
     ],
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.6',
     install_requires=[
         'pyramid',
         'repoze.sendmail>=4.1',
@@ -51,6 +52,12 @@ setup(
         'docs':docs_extras,
         },
     test_suite='pyramid_mailer',
+    entry_points={
+        'console_scripts': [
+            'pmailqp = pyramid_mailer.queue:main',
+            'pmailqstat = pyramid_mailer.queue:stat_main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
@@ -58,8 +65,6 @@ setup(
         "Topic :: Communications :: Email",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",